@@ -0,0 +1,290 @@
+"""Offline batch jobs that only use otherwise idle GPU time.
+
+A batch is a JSONL upload of completion/generate/image requests. Everything
+about it lives in Redis, so a restarted API picks up where it left off:
+
+    batch:{id}            hash: status, owner, counters, per-queue cursors
+    batch:{id}:requests   list: the uploaded lines, in order
+    batch:{id}:inflight   hash: worker task ID -> {"index", "queue", "sent_at", "attempt"}
+    batch:{id}:results    list: one JSON result per finished line, in completion order
+    batches:active        list: batch IDs still running, oldest first
+
+One dispatcher (a Redis lease elects it among API replicas) feeds a batch line
+to a worker queue only while that queue is empty and fewer than
+BATCH_MAX_IN_FLIGHT batch tasks are out on it. Interactive requests are pushed
+behind at most that many batch tasks.
+
+Text lines wait on the low-priority lane (gpu_tasks:low) and may be preempted
+and pushed back there. A line's retry timeout only runs while it is off the
+lane, so waiting behind interactive traffic never triggers a duplicate.
+"""
+import os
+import time
+import uuid
+import asyncio
+import logging
+import orjson
+from scheduler import tokens_generated, low_queue, SJF_QUEUES
+
+logger = logging.getLogger(__name__)
+
+BATCH_TTL = int(os.getenv("BATCH_TTL", "86400"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))
+BATCH_MAX_IN_FLIGHT = int(os.getenv("BATCH_MAX_IN_FLIGHT", "1"))
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "0.25"))
+BATCH_ATTEMPTS = 2  # a line whose task vanished (worker restart, expired result) is sent once more
+BATCH_SCAN = 100  # lines read per cursor advance
+
+ACTIVE_BATCHES = "batches:active"
+DISPATCH_LEASE = "batches:dispatcher"
+
+# Batch line endpoint -> (worker queue, worker endpoint, seconds before a dispatched line is retried)
+BATCH_ENDPOINTS = {
+    "completion": ("gpu_tasks", "completion", 300),
+    "generate": ("gpu_tasks", "generate", 300),
+    "generate-image": ("sd_tasks", "sd_generation", 600),
+}
+BATCH_QUEUES = sorted({queue for queue, _, _ in BATCH_ENDPOINTS.values()})
+
+def dumps(obj) -> str:
+    return orjson.dumps(obj).decode()
+
+class BatchRunner:
+    """Stores batches and feeds their lines to idle worker queues"""
+
+    def __init__(self, redis_client, scheduler, on_image_result=None):
+        self.redis = redis_client
+        self.scheduler = scheduler
+        self.on_image_result = on_image_result  # async hook for image results, e.g. to keep their blobs
+        self.instance = uuid.uuid4().hex
+        self.task = None
+
+    async def submit(self, lines, owner) -> dict:
+        """Store validated lines ({"endpoint", "body", "custom_id"?}) as a new batch"""
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        now = time.time()
+        key = f"batch:{batch_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={
+                "status": "queued",
+                "owner": owner,
+                "total": len(lines),
+                "completed": 0,
+                "failed": 0,
+                "tokens": 0,
+                "created_at": now,
+                **{f"cursor:{queue}": 0 for queue in BATCH_QUEUES},
+            })
+            for start in range(0, len(lines), 1000):
+                pipe.rpush(f"{key}:requests", *(dumps(line) for line in lines[start:start + 1000]))
+            for suffix in ("", ":requests"):
+                pipe.expire(f"{key}{suffix}", BATCH_TTL)
+            pipe.rpush(ACTIVE_BATCHES, batch_id)
+            await pipe.execute()
+        logger.info(f"Batch {batch_id} queued with {len(lines)} requests")
+        return await self.state(batch_id)
+
+    async def state(self, batch_id):
+        """Progress and throughput of a batch, or None"""
+        meta = await self.redis.hgetall(f"batch:{batch_id}")
+        if not meta:
+            return None
+        completed, failed, tokens = int(meta["completed"]), int(meta["failed"]), int(meta["tokens"])
+        state = {
+            "batch_id": batch_id,
+            "status": meta["status"],
+            "total": int(meta["total"]),
+            "completed": completed,
+            "failed": failed,
+            "in_flight": await self.redis.hlen(f"batch:{batch_id}:inflight"),
+            "created_at": float(meta["created_at"]),
+        }
+        if meta.get("started_at"):
+            started = float(meta["started_at"])
+            finished = float(meta["finished_at"]) if meta.get("finished_at") else time.time()
+            elapsed = max(finished - started, 1e-6)
+            state.update({
+                "started_at": started,
+                "elapsed_seconds": round(elapsed, 3),
+                "requests_per_second": round((completed + failed) / elapsed, 4),
+                "tokens_generated": tokens,
+                "tokens_per_second": round(tokens / elapsed, 2),
+            })
+        if meta.get("finished_at"):
+            state["finished_at"] = float(meta["finished_at"])
+        return state
+
+    async def owner(self, batch_id):
+        return await self.redis.hget(f"batch:{batch_id}", "owner")
+
+    async def results(self, batch_id, chunk=BATCH_SCAN):
+        """Yield stored result lines (parsed) in chunks, without loading the whole batch"""
+        start = 0
+        while True:
+            rows = await self.redis.lrange(f"batch:{batch_id}:results", start, start + chunk - 1)
+            if not rows:
+                return
+            for row in rows:
+                yield orjson.loads(row)
+            start += len(rows)
+
+    def start(self):
+        """Start the dispatcher loop; call from a running event loop"""
+        if self.task is None:
+            self.task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try:
+                if await self._hold_lease():
+                    await self.step()
+            except Exception as e:
+                logger.error(f"Error running batches: {e}")
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+
+    async def _hold_lease(self) -> bool:
+        """One dispatcher across API replicas; the lease lapses if its holder dies"""
+        lease_ttl = max(int(BATCH_POLL_INTERVAL * 10), 5)
+        if await self.redis.set(DISPATCH_LEASE, self.instance, nx=True, ex=lease_ttl):
+            return True
+        if await self.redis.get(DISPATCH_LEASE) == self.instance:
+            await self.redis.expire(DISPATCH_LEASE, lease_ttl)
+            return True
+        return False
+
+    async def step(self):
+        """Collect finished lines, then top up idle queues from the oldest batches"""
+        batch_ids = await self.redis.lrange(ACTIVE_BATCHES, 0, -1)
+        if not batch_ids:
+            return
+        in_flight = {queue: 0 for queue in BATCH_QUEUES}
+        queued = await self.queued_low()
+        for batch_id in batch_ids:
+            for entry in await self.collect(batch_id, queued):
+                in_flight[entry["queue"]] += 1
+
+        idle = {}
+        for queue in BATCH_QUEUES:
+            idle[queue] = BATCH_MAX_IN_FLIGHT - in_flight[queue] if await self.scheduler.depth(queue) == 0 else 0
+
+        for batch_id in batch_ids:
+            if any(idle.values()):
+                for queue in BATCH_QUEUES:
+                    while idle[queue] > 0 and await self.dispatch_next(batch_id, queue):
+                        idle[queue] -= 1
+            await self.finish_if_done(batch_id)
+
+    async def queued_low(self):
+        """IDs of tasks waiting on the low-priority lanes (not started, or preempted)"""
+        ids = set()
+        for queue in BATCH_QUEUES:
+            if queue in SJF_QUEUES:
+                ids.update(orjson.loads(raw)["id"] for raw in await self.redis.lrange(low_queue(queue), 0, -1))
+        return ids
+
+    async def collect(self, batch_id, queued=()):
+        """Store results of finished lines; returns the entries still in flight.
+
+        Entries of tasks in `queued` restart their timeout, which thus counts from when a worker last took them.
+        """
+        key = f"batch:{batch_id}"
+        inflight = await self.redis.hgetall(f"{key}:inflight")
+        if not inflight:
+            return []
+        task_ids = list(inflight)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for task_id in task_ids:
+                pipe.get(f"result:{task_id}")
+            raws = await pipe.execute()
+
+        pending = []
+        now = time.time()
+        for task_id, raw in zip(task_ids, raws):
+            entry = orjson.loads(inflight[task_id])
+            line = orjson.loads(await self.redis.lindex(f"{key}:requests", entry["index"]))
+            if raw is None:
+                timeout = BATCH_ENDPOINTS[line["endpoint"]][2]
+                if task_id in queued:
+                    entry["sent_at"] = now
+                    await self.redis.hset(f"{key}:inflight", task_id, dumps(entry))
+                if now - entry["sent_at"] < timeout:
+                    pending.append(entry)
+                elif entry["attempt"] < BATCH_ATTEMPTS:
+                    logger.warning(f"Batch {batch_id} line {entry['index']} timed out, sending it again")
+                    await self.redis.hdel(f"{key}:inflight", task_id)
+                    await self.send(batch_id, entry["index"], line, entry["attempt"] + 1)
+                    pending.append(entry)
+                else:
+                    await self.store_result(batch_id, task_id, entry, line, {"error": "Timed out"})
+                continue
+            await self.store_result(batch_id, task_id, entry, line, orjson.loads(raw))
+        return pending
+
+    async def store_result(self, batch_id, task_id, entry, line, result):
+        data = result.get("data")
+        error = result.get("error") or (data.get("error") if isinstance(data, dict) else None)
+        if not error and line["endpoint"] == "generate-image" and self.on_image_result:
+            await self.on_image_result(data)
+        row = {"index": entry["index"], "custom_id": line.get("custom_id"), "endpoint": line["endpoint"]}
+        row.update({"status": "failed", "error": error} if error else {"status": "done", "result": data})
+        key = f"batch:{batch_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(f"{key}:results", dumps(row))
+            pipe.expire(f"{key}:results", BATCH_TTL)
+            pipe.hdel(f"{key}:inflight", task_id)
+            pipe.hincrby(key, "failed" if error else "completed", 1)
+            pipe.hincrby(key, "tokens", 0 if error else tokens_generated(data))
+            pipe.delete(f"result:{task_id}")
+            await pipe.execute()
+
+    async def dispatch_next(self, batch_id, queue) -> bool:
+        """Send the batch's next line for `queue`, advancing its cursor past other queues' lines"""
+        key = f"batch:{batch_id}"
+        cursor = int(await self.redis.hget(key, f"cursor:{queue}") or 0)
+        while True:
+            lines = await self.redis.lrange(f"{key}:requests", cursor, cursor + BATCH_SCAN - 1)
+            if not lines:
+                await self.redis.hset(key, f"cursor:{queue}", cursor)
+                return False
+            for offset, raw in enumerate(lines):
+                line = orjson.loads(raw)
+                if BATCH_ENDPOINTS[line["endpoint"]][0] == queue:
+                    await self.redis.hset(key, f"cursor:{queue}", cursor + offset + 1)
+                    await self.send(batch_id, cursor + offset, line, 1)
+                    return True
+            cursor += len(lines)
+
+    async def send(self, batch_id, index, line, attempt):
+        queue, worker_endpoint, _ = BATCH_ENDPOINTS[line["endpoint"]]
+        task_id = str(uuid.uuid4())
+        now = time.time()
+        key = f"batch:{batch_id}"
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hsetnx(key, "started_at", now)
+            pipe.hset(key, "status", "running")
+            pipe.hset(f"{key}:inflight", task_id, dumps({"index": index, "queue": queue, "sent_at": now, "attempt": attempt}))
+            pipe.expire(f"{key}:inflight", BATCH_TTL)
+            await self.scheduler.enqueue(queue, {
+                "id": task_id,
+                "endpoint": worker_endpoint,
+                "data": line["body"],
+                "timestamp": now,
+                "request_id": f"{batch_id}:{index}",
+                "batch": batch_id,
+                "priority": "low",
+            }, pipe=pipe)
+            await pipe.execute()
+
+    async def finish_if_done(self, batch_id):
+        key = f"batch:{batch_id}"
+        meta = await self.redis.hgetall(key)
+        if not meta:
+            await self.redis.lrem(ACTIVE_BATCHES, 0, batch_id)  # expired
+            return
+        if int(meta["completed"]) + int(meta["failed"]) < int(meta["total"]):
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, mapping={"status": "done", "finished_at": time.time()})
+            pipe.lrem(ACTIVE_BATCHES, 0, batch_id)
+            await pipe.execute()
+        logger.info(f"Batch {batch_id} finished: {meta['completed']} done, {meta['failed']} failed")
@@ -0,0 +1,220 @@
+"""JSON schema to GBNF compilation for structured /completion output.
+
+llama-server constrains generation with a GBNF grammar. Rather than having
+clients hand-write one and resend it on every call, the API compiles a JSON
+schema once and keeps the grammar under an ID derived from the schema:
+
+    grammar:{id}   the compiled GBNF text, kept GRAMMAR_TTL seconds after last use
+
+A request may then send `json_schema` (compiled on first sight) or just the
+`grammar_id`. Supported schema keywords: type (including lists), properties,
+required, items, minItems/maxItems, minLength/maxLength, enum, const,
+anyOf/oneOf and $ref into $defs/definitions. Objects with `properties` only
+produce those properties, required ones first; number ranges, string
+patterns and formats are not enforced.
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+GRAMMAR_TTL = int(os.getenv("GRAMMAR_TTL", str(30 * 86400)))
+GRAMMAR_LOCAL_CACHE = 256  # compiled grammars also kept in process
+GRAMMAR_VERSION = 1  # part of every grammar ID; bump when the compiler's output changes
+
+PRIMITIVES = {
+    "space": '" "?',
+    "boolean": '("true" | "false") space',
+    "null": '"null" space',
+    "integral-part": '[0] | [1-9] [0-9]{0,15}',
+    "integer": '"-"? integral-part space',
+    "number": '"-"? integral-part ("." [0-9]{1,16})? ([eE] [-+]? [0-9]{1,4})? space',
+    "char": '[^"\\\\\\x7F\\x00-\\x1F] | [\\\\] (["\\\\/bfnrt] | "u" [0-9a-fA-F]{4})',
+    "string": '"\\"" char* "\\"" space',
+    "value": 'object | array | string | number | boolean | null',
+    "object": '"{" space (string ":" space value ("," space string ":" space value)*)? "}" space',
+    "array": '"[" space (value ("," space value)*)? "]" space',
+}
+# Rules each primitive needs besides itself
+PRIMITIVE_DEPS = {
+    "boolean": ["space"], "null": ["space"], "integer": ["integral-part", "space"],
+    "number": ["integral-part", "space"], "string": ["char", "space"],
+    "value": ["object", "array", "string", "number", "boolean", "null"],
+    "object": ["string", "value", "space"], "array": ["value", "space"],
+}
+
+def literal(text):
+    """GBNF string literal"""
+    return '"' + text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n").replace("\r", "\\r").replace("\t", "\\t") + '"'
+
+def json_literal(value):
+    return literal(json.dumps(value, ensure_ascii=False, separators=(",", ":"))) + " space"
+
+def repeat(item, low, high):
+    """GBNF for `item` low..high times, comma-separated"""
+    if high is not None and high < low:
+        raise ValueError(f"Maximum count {high} is below minimum {low}")
+    if high is not None and high <= 0:
+        return ""
+    rest = f'("," space {item})'
+    if low <= 0:
+        tail = f"{{0,{high - 1}}}" if high is not None else "*"
+        return f"({item} {rest}{tail})?"
+    tail = f"{{{low - 1},{high - 1}}}" if high is not None else f"{{{low - 1},}}"
+    return f"{item} {rest}{tail}"
+
+class SchemaConverter:
+    def __init__(self, schema):
+        self.schema = schema
+        self.rules = OrderedDict()
+        self.refs = {}
+
+    def convert(self):
+        self.rules["root"] = None  # keep root first
+        self.rules["root"] = self.visit(self.schema, "root")
+        self.primitive("space")  # literals end in it too
+        return "\n".join(f"{name} ::= {body}" for name, body in self.rules.items()) + "\n"
+
+    def add_rule(self, name, body):
+        name = re.sub(r"[^a-zA-Z0-9-]+", "-", name).strip("-") or "rule"
+        if name in PRIMITIVES:
+            name = f"{name}-"
+        key, n = name, 1
+        while key in self.rules and self.rules[key] != body:
+            n += 1
+            key = f"{name}{n}"
+        self.rules[key] = body
+        return key
+
+    def primitive(self, name):
+        if name not in self.rules:
+            self.rules[name] = PRIMITIVES[name]
+            for dep in PRIMITIVE_DEPS.get(name, []):
+                self.primitive(dep)
+        return name
+
+    def ref(self, target):
+        """Rule for a $ref, resolved once so recursive schemas terminate"""
+        if target not in self.refs:
+            if not target.startswith("#/"):
+                raise ValueError(f"Only local $refs are supported, got {target}")
+            node = self.schema
+            for part in target[2:].split("/"):
+                if not isinstance(node, dict) or part not in node:
+                    raise ValueError(f"Unresolvable $ref {target}")
+                node = node[part]
+            name = self.add_rule(f"ref-{target.rsplit('/', 1)[-1]}", "")
+            self.refs[target] = name
+            self.rules[name] = self.visit(node, name)
+        return self.refs[target]
+
+    def visit(self, schema, name):
+        """GBNF expression matching `schema`; sub-schemas become rules named after `name`"""
+        if schema is True or schema == {}:
+            return self.primitive("value")
+        if not isinstance(schema, dict):
+            raise ValueError(f"Unsupported schema: {schema!r}")
+        if "$ref" in schema:
+            return self.ref(schema["$ref"])
+        if "const" in schema:
+            return json_literal(schema["const"])
+        if "enum" in schema:
+            return "(" + " | ".join(json_literal(value) for value in schema["enum"]) + ")"
+        for keyword in ("anyOf", "oneOf"):
+            if keyword in schema:
+                return "(" + " | ".join(self.add_rule(f"{name}-{i}", self.visit(alt, f"{name}-{i}")) for i, alt in enumerate(schema[keyword])) + ")"
+        if "allOf" in schema:
+            raise ValueError("allOf is not supported")
+
+        schema_type = schema.get("type")
+        if isinstance(schema_type, list):
+            return "(" + " | ".join(self.visit({**schema, "type": t}, f"{name}-{t}") for t in schema_type) + ")"
+        if schema_type == "object" or "properties" in schema:
+            return self.object(schema, name)
+        if schema_type == "array" or "items" in schema:
+            item = schema.get("items", {})
+            item_rule = self.add_rule(f"{name}-item", self.visit(item, f"{name}-item"))
+            body = repeat(item_rule, schema.get("minItems", 0), schema.get("maxItems"))
+            return f'"[" space {body} "]" space'
+        if schema_type == "string":
+            if "minLength" in schema or "maxLength" in schema:
+                low, high = schema.get("minLength", 0), schema.get("maxLength")
+                if high is not None and high < low:
+                    raise ValueError(f"maxLength {high} is below minLength {low}")
+                self.primitive("char")
+                self.primitive("space")
+                return f'"\\"" char{{{low},{"" if high is None else high}}} "\\"" space'
+            return self.primitive("string")
+        if schema_type in ("number", "integer", "boolean", "null"):
+            return self.primitive(schema_type)
+        if schema_type is None:
+            return self.primitive("value")
+        raise ValueError(f"Unsupported type: {schema_type}")
+
+    def object(self, schema, name):
+        properties = schema.get("properties") or {}
+        if not properties:
+            return self.primitive("object")
+        required = [key for key in properties if key in set(schema.get("required", []))]
+        optional = [key for key in properties if key not in required]
+        pairs = {}
+        for key in properties:
+            value = self.add_rule(f"{name}-{key}", self.visit(properties[key], f"{name}-{key}"))
+            pairs[key] = self.add_rule(f"{name}-{key}-kv", f'{json_literal(key)} ":" space {value}')
+        body = ' "," space '.join(pairs[key] for key in required)
+        if required:
+            body += "".join(f' ("," space {pairs[key]})?' for key in optional)
+        elif optional:
+            # Any subset of the optional properties, in order: pick the first present one, then the rest
+            alternatives = [pairs[key] + "".join(f' ("," space {pairs[later]})?' for later in optional[i + 1:]) for i, key in enumerate(optional)]
+            body = "(" + " | ".join(alternatives) + ")?"
+        return f'"{{" space {body} "}}" space'
+
+def schema_to_gbnf(schema) -> str:
+    """GBNF grammar accepting JSON documents that match `schema`; ValueError if unsupported"""
+    return SchemaConverter(schema).convert()
+
+def schema_id(schema) -> str:
+    canonical = json.dumps(schema, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return "g_" + hashlib.sha256(f"{GRAMMAR_VERSION}:{canonical}".encode()).hexdigest()[:24]
+
+class GrammarStore:
+    """Compiled grammars in Redis, shared by API replicas, with a small in-process cache"""
+
+    def __init__(self, redis_client):
+        self.redis = redis_client
+        self.local = OrderedDict()
+
+    def _remember(self, grammar_id, grammar):
+        self.local[grammar_id] = grammar
+        self.local.move_to_end(grammar_id)
+        while len(self.local) > GRAMMAR_LOCAL_CACHE:
+            self.local.popitem(last=False)
+
+    async def compile(self, schema):
+        """(grammar ID, grammar) for a schema, compiling it only the first time"""
+        grammar_id = schema_id(schema)
+        grammar = await self.get(grammar_id)
+        if grammar is None:
+            grammar = schema_to_gbnf(schema)
+            await self.redis.set(f"grammar:{grammar_id}", grammar, ex=GRAMMAR_TTL)
+            self._remember(grammar_id, grammar)
+            logger.info(f"Compiled grammar {grammar_id}: {len(grammar)} bytes")
+        return grammar_id, grammar
+
+    async def get(self, grammar_id):
+        """Grammar text, or None; refreshes its TTL"""
+        grammar = self.local.get(grammar_id)
+        if grammar is not None:
+            self.local.move_to_end(grammar_id)
+            if not await self.redis.expire(f"grammar:{grammar_id}", GRAMMAR_TTL):
+                await self.redis.set(f"grammar:{grammar_id}", grammar, ex=GRAMMAR_TTL)  # expired elsewhere; keep it shared
+            return grammar
+        grammar = await self.redis.getex(f"grammar:{grammar_id}", ex=GRAMMAR_TTL)
+        if grammar is not None:
+            self._remember(grammar_id, grammar)
+        return grammar
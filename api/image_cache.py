@@ -0,0 +1,134 @@
+"""Disk cache for deterministic Stable Diffusion results.
+
+A txt2img request with a fixed seed always produces the same image on the same
+checkpoint, so results are stored under a hash of the generation parameters,
+the output encoding and the active checkpoint. Entries are single files
+(`<key>.bin`: a length-prefixed JSON header, then the image and optional
+thumbnail bytes) evicted least-recently-used once the directory exceeds its
+size bound. File mtimes record recency, so the LRU order survives restarts.
+"""
+import os
+import json
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Request fields that determine the generated pixels and their encoding
+CACHE_KEY_FIELDS = (
+    "prompt", "negative_prompt", "steps", "cfg_scale", "width", "height", "sampler_name",
+    "seed", "batch_size", "n_iter", "output_format", "quality", "max_size", "thumbnail_size",
+    "override_settings",
+)
+
+class ImageCache:
+    """Seeded SD results on disk with an LRU bound on total size"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> file size, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.unlink(path)  # interrupted write
+            elif name.endswith(".bin"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.total_bytes += size
+        logger.info(f"Image cache at {self.directory}: {len(self.entries)} entries, {self.total_bytes / 1e6:.1f} MB")
+        self._evict()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    @staticmethod
+    def key(request: dict, checkpoint: str) -> str:
+        """Content key for a request on a checkpoint"""
+        fields = {name: request.get(name) for name in CACHE_KEY_FIELDS}
+        # A pinned checkpoint is keyed by its normalized name alone, so "x.safetensors [hash]" and "x.safetensors" share entries
+        overrides = {k: v for k, v in (fields["override_settings"] or {}).items() if k != "sd_model_checkpoint"}
+        fields["override_settings"] = overrides or None
+        fields["checkpoint"] = checkpoint
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Cached entry {"image", "media_type", "thumbnail", "info"} or None; blocking, run in a thread"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+        try:
+            with open(self._path(key), "rb") as f:
+                (header_len,) = struct.unpack(">I", f.read(4))
+                header = json.loads(f.read(header_len))
+                image = f.read(header["image_bytes"])
+                thumbnail = f.read(header["thumbnail_bytes"]) if header.get("thumbnail_bytes") else None
+            os.utime(self._path(key))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Dropping unreadable image cache entry {key}: {e}")
+            self._remove(key)
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return {"image": image, "media_type": header["media_type"], "thumbnail": thumbnail, "info": header.get("info", "")}
+
+    def put(self, key, image, media_type, thumbnail=None, info=""):
+        """Store an entry and evict the least recently used ones over the size bound; blocking"""
+        header = json.dumps({
+            "media_type": media_type,
+            "image_bytes": len(image),
+            "thumbnail_bytes": len(thumbnail) if thumbnail else 0,
+            "info": info,
+        }).encode()
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(struct.pack(">I", len(header)))
+            f.write(header)
+            f.write(image)
+            if thumbnail:
+                f.write(thumbnail)
+        os.replace(tmp_path, path)  # readers never see a partial entry
+
+        size = os.path.getsize(path)
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+        self._evict()
+
+    def _remove(self, key):
+        with self.lock:
+            self.total_bytes -= self.entries.pop(key, 0)
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.entries:
+                    return
+                key = next(iter(self.entries))
+            self._remove(key)
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes, "hits": self.hits, "misses": self.misses}
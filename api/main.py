@@ -1,27 +1,60 @@
 import os
-import json
 import logging
 import time
 import uuid
 import asyncio
+import gzip
+import io
+import glob
+import hashlib
+import hmac
+import base64
+import queue
+import socket
+import ipaddress
+import threading
+import contextvars
 import httpx
+import orjson
+import numpy as np
 from datetime import datetime, timezone
-from fastapi import FastAPI, HTTPException, Request, Depends
+from urllib.parse import urlsplit
+from fastapi import FastAPI, HTTPException, Request, Depends, Header
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse, Response
+from pydantic import BaseModel, Field
 from typing import List, Dict, Any, Optional, Union
 from redis import Redis
 import redis.asyncio as redis
 
+from a1111_pool import A1111Pool, checkpoint_name, pool_urls
+from batches import BatchRunner, BATCH_MAX_REQUESTS, BATCH_TTL
+from grammars import GrammarStore
+from scheduler import Scheduler, low_queue
+from image_cache import ImageCache
+from vector_index import VectorIndex
+from logsetup import configure_logging, dropped_records, request_id_var, set_request_id, truncate
+
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("api")
 logger = logging.getLogger(__name__)
 
 def get_iso_timestamp():
     """Generate ISO 8601 timestamp in Ollama format"""
     return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
 
+def dumps(obj) -> str:
+    """Compact JSON encoding via orjson (logit_bias uses integer keys)"""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+def sse_frame(payload) -> str:
+    """Server-sent event frame, as used by Unity clients"""
+    return f"data: {dumps(payload)}\n\n"
+
+def ndjson_frame(payload) -> str:
+    """Newline-delimited JSON frame, as used by Ollama clients"""
+    return f"{dumps(payload)}\n"
+
 app = FastAPI(
     title="LLaMA API Service",
     docs_url="/docs",
@@ -33,11 +66,126 @@ redis_url = os.getenv("REDIS_URL", "redis://localhost:6379")
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PASS = os.getenv("REDIS_PASS", "")
 A1111_URL = os.getenv("A1111_URL", "http://velesio-gpu:7860")  # Internal container URL
+sd_pool = A1111Pool(pool_urls(A1111_URL))  # A1111_URLS lists several image nodes
 if not os.getenv("REDIS_URL"):
     redis_url = f"redis://:{REDIS_PASS}@{REDIS_HOST}:6379"
 redis_pass = os.getenv("REDIS_PASS", None)
 redis_conn = Redis.from_url(redis_url, password=redis_pass)
 redis_client = redis.from_url(redis_url, password=redis_pass, decode_responses=True)
+scheduler = Scheduler(redis_client)
+blob_client = redis.from_url(redis_url, password=redis_pass)  # raw image bytes written by the SD worker
+
+# Generated images: SD workers store bytes under blob:{sha256}; the API serves them raw or via signed URLs
+IMAGE_URL_TTL = int(os.getenv("IMAGE_URL_TTL", "300"))
+
+def image_url_secret() -> bytes:
+    """Key for signed image URLs, the same on every replica configured alike.
+
+    IMAGE_URL_SECRET if set, else derived from API_TOKENS, which every replica already shares.
+    Only a replica with neither falls back to a random key, and its URLs fail on any other replica.
+    """
+    if os.getenv("IMAGE_URL_SECRET"):
+        return os.getenv("IMAGE_URL_SECRET").encode()
+    tokens = sorted(token for token in os.getenv("API_TOKENS", "").split(",") if token)
+    if tokens:
+        return hmac.new(",".join(tokens).encode(), b"velesio image URLs", hashlib.sha256).digest()
+    logger.warning("Neither IMAGE_URL_SECRET nor API_TOKENS is set; image URLs are signed with a per-process key")
+    return os.urandom(32)
+
+IMAGE_URL_SECRET = image_url_secret()
+
+# Seeded SD requests are deterministic per checkpoint; cache them on disk in front of sd_tasks
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+image_cache = ImageCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES) if IMAGE_CACHE_DIR else None
+background_tasks = set()
+
+# Retrieval collections embedded through the workers' embed path (see vector_index.py)
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "")
+vector_index = VectorIndex(VECTOR_INDEX_DIR) if VECTOR_INDEX_DIR else None
+EMBED_BATCH = 64  # inputs per embed task when indexing documents
+
+# Traffic capture (opt-in): sanitized request envelopes for offline replay with bench/replay.py
+TRAFFIC_CAPTURE_DIR = os.getenv("TRAFFIC_CAPTURE_DIR", "")
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.getenv("TRAFFIC_CAPTURE_MAX_BYTES", str(64 * 1024 * 1024)))
+TRAFFIC_CAPTURE_BACKUPS = int(os.getenv("TRAFFIC_CAPTURE_BACKUPS", "5"))
+TRAFFIC_CAPTURE_REDACT = os.getenv("TRAFFIC_CAPTURE_REDACT", "false").lower() == "true"
+TRAFFIC_CAPTURE_SKIP = {"/health", "/docs", "/redoc", "/openapi.json"}
+TRAFFIC_CAPTURE_HEADERS = {"accept"}
+
+class TrafficRecorder:
+    """Writes request envelopes to rotating gzip JSONL files from a background thread"""
+
+    def __init__(self, directory, max_bytes, backups, redact):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.redact = redact
+        self.dropped = 0
+        self.queue = queue.Queue(maxsize=10000)
+        self.file = None
+        self.raw = None
+        self.rotations = 0
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._writer, name="traffic-capture", daemon=True).start()
+
+    def record(self, envelope):
+        """Queue an envelope without blocking the event loop; drop it if the writer is behind"""
+        try:
+            self.queue.put_nowait(envelope)
+        except queue.Full:
+            self.dropped += 1
+
+    def sanitize_body(self, body):
+        """Strip inline images and optionally mask text while keeping its length"""
+        if isinstance(body, dict):
+            clean = {}
+            for key, value in body.items():
+                if key == "images" and isinstance(value, list):
+                    clean[key] = []
+                    clean["_omitted_images"] = len(value)
+                else:
+                    clean[key] = self.sanitize_body(value)
+            return clean
+        if isinstance(body, list):
+            return [self.sanitize_body(v) for v in body]
+        if isinstance(body, str) and self.redact:
+            return "".join(c if c.isspace() else "x" for c in body)
+        return body
+
+    def _open(self):
+        # Milliseconds and a rotation counter keep names unique, and "xb" never truncates an existing file
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}{int(now * 1000) % 1000:03d}"
+        name = f"capture-{stamp}-{os.getpid()}-{self.rotations:04d}.jsonl.gz"
+        self.rotations += 1
+        self.raw = open(os.path.join(self.directory, name), "xb")
+        self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode="wb", compresslevel=6), encoding="utf-8")
+        files = sorted(glob.glob(os.path.join(self.directory, "capture-*.jsonl.gz")))
+        for old in files[:-(self.backups + 1)]:
+            os.remove(old)
+
+    def _writer(self):
+        while True:
+            envelope = self.queue.get()
+            try:
+                # The raw offset is the compressed size on disk, short of what zlib still buffers
+                if self.file is None or self.raw.tell() >= self.max_bytes:
+                    if self.file:
+                        self.file.close()
+                        self.raw.close()
+                    self._open()
+                self.file.write(dumps(envelope) + "\n")
+                # Flush when idle so a crash loses at most the in-flight burst
+                if self.queue.empty():
+                    self.file.flush()
+            except Exception as e:
+                logger.error(f"Traffic capture write failed: {e}")
+
+traffic_recorder = None
+if TRAFFIC_CAPTURE_DIR:
+    traffic_recorder = TrafficRecorder(TRAFFIC_CAPTURE_DIR, TRAFFIC_CAPTURE_MAX_BYTES, TRAFFIC_CAPTURE_BACKUPS, TRAFFIC_CAPTURE_REDACT)
+    logger.info(f"Traffic capture enabled, writing to {TRAFFIC_CAPTURE_DIR}")
 
 # Authentication setup
 security = HTTPBearer()
@@ -76,9 +224,62 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    logger.info(f"Valid token authenticated: {token[:10]}...")
+    logger.info(f"Valid token authenticated: {token[:10]}...", extra={"event": "auth"})
     return token  # Return the validated token
 
+@app.middleware("http")
+async def correlate_request(request: Request, call_next):
+    """Tag the request (and the tasks it enqueues) with a correlation ID for the logs"""
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    set_request_id(request_id[:64])
+    try:
+        request_timeout_var.set(float(request.headers["x-request-timeout"]))
+    except (KeyError, ValueError):
+        request_timeout_var.set(None)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id[:64]
+    return response
+
+# Tasks carry an absolute deadline: past it nobody waits for the result, so workers drop them unrun.
+# Clients can shorten an endpoint's timeout with X-Request-Timeout (seconds).
+request_timeout_var = contextvars.ContextVar("request_timeout", default=None)
+
+def request_timeout(default: float) -> float:
+    """Endpoint timeout, shortened by the client's X-Request-Timeout"""
+    client_timeout = request_timeout_var.get()
+    return min(default, max(client_timeout, 0.0)) if client_timeout is not None else default
+
+def task_deadline(timeout: float) -> float:
+    return time.time() + request_timeout(timeout)
+
+async def capture_traffic(request: Request, call_next):
+    """Record the arrival time and sanitized envelope of each request"""
+    if request.url.path in TRAFFIC_CAPTURE_SKIP:
+        return await call_next(request)
+    arrived = time.time()
+    raw_body = await request.body()
+    response = await call_next(request)
+
+    try:
+        body = orjson.loads(raw_body) if raw_body else None
+    except ValueError:
+        body = None
+    auth = request.headers.get("authorization", "")
+    traffic_recorder.record({
+        "t": arrived,
+        "method": request.method,
+        "path": request.url.path,
+        "query": request.url.query,
+        "client": hashlib.sha256(auth.encode()).hexdigest()[:12] if auth else None,
+        "headers": {k: v for k, v in request.headers.items() if k in TRAFFIC_CAPTURE_HEADERS},
+        "body": traffic_recorder.sanitize_body(body),
+        "status": response.status_code,
+    })
+    return response
+
+if traffic_recorder:
+    app.middleware("http")(capture_traffic)
+
 class Prompt(BaseModel):
     text: str
 
@@ -127,6 +328,9 @@ class OllamaChatRequest(BaseModel):
     format: Optional[str] = None  # json
     options: Optional[Dict[str, Any]] = None
     keep_alive: Optional[Union[str, int]] = None  # Accept both "5m" and 300
+    stream_flush_ms: Optional[int] = None  # token coalescing window on the worker, 0 disables
+    stream_flush_bytes: Optional[int] = None
+    session_id: Optional[str] = None  # send only the new messages; history is kept server-side
 
 # Ollama Generate (completion) model
 class OllamaGenerateRequest(BaseModel):
@@ -142,6 +346,8 @@ class OllamaGenerateRequest(BaseModel):
     raw: Optional[bool] = False
     keep_alive: Optional[Union[str, int]] = None  # Accept both "5m" and 300
     context: Optional[List[int]] = None
+    stream_flush_ms: Optional[int] = None  # token coalescing window on the worker, 0 disables
+    stream_flush_bytes: Optional[int] = None
 
 # Ollama Embeddings model
 class OllamaEmbedRequest(BaseModel):
@@ -150,6 +356,9 @@ class OllamaEmbedRequest(BaseModel):
     truncate: Optional[bool] = True
     options: Optional[Dict[str, Any]] = None
     keep_alive: Optional[Union[str, int]] = None  # Accept both "5m" and 300
+    encoding_format: Optional[str] = "float"  # float (JSON lists) or base64 (packed little-endian floats)
+    dtype: Optional[str] = "float32"  # float32 or float16, for base64
+    normalize: Optional[bool] = False  # scale vectors to unit length
 
 # CompletionRequest - same as ChatRequest but for completion endpoint
 class CompletionRequest(BaseModel):
@@ -179,6 +388,11 @@ class CompletionRequest(BaseModel):
     logit_bias: Optional[Dict[int, str]] = None
     n_probs: Optional[int] = 0
     cache_prompt: Optional[bool] = True
+    stream_flush_ms: Optional[int] = None  # token coalescing window on the worker, 0 disables
+    stream_flush_bytes: Optional[int] = None
+    session_id: Optional[str] = None  # prompt is appended to the session's transcript
+    json_schema: Optional[Dict[str, Any]] = None  # compiled to a GBNF grammar once, see grammars.py
+    grammar_id: Optional[str] = None  # a grammar compiled earlier, instead of resending it
 
 class SlotRequest(BaseModel):
     id_slot: int
@@ -196,6 +410,12 @@ class SDGenerationRequest(BaseModel):
     seed: Optional[int] = -1
     batch_size: Optional[int] = 1
     n_iter: Optional[int] = 1
+    response_format: Optional[str] = "base64"  # base64 (JSON, legacy), binary (raw image body) or url
+    output_format: Optional[str] = "png"  # png, webp or jpeg, encoded on the SD worker
+    quality: Optional[int] = 90  # webp/jpeg quality, 1-100
+    max_size: Optional[int] = None  # downscale so the longest side is at most this many pixels
+    thumbnail_size: Optional[int] = None  # also return a thumbnail bounded by this size
+    override_settings: Optional[Dict[str, Any]] = None  # A1111 per-request settings, e.g. sd_model_checkpoint
 
 # Unity LLM endpoints
 @app.get("/props")
@@ -208,15 +428,14 @@ async def get_props(token: str = Depends(verify_token)):
         task_data = {
             "endpoint": "props",
             "data": {},
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(30),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Props task {task_id} added to Redis queue")
         
@@ -226,7 +445,7 @@ async def get_props(token: str = Depends(verify_token)):
             logger.error(f"Props task error: {result['error']}")
             raise HTTPException(status_code=500, detail=result["error"])
         
-        logger.info(f"Props result: {result.get('data', {})}")
+        logger.info(f"Props result: {truncate(result.get('data', {}))}", extra={"event": "payload"})
         return result.get("data", {})
             
     except Exception as e:
@@ -248,15 +467,14 @@ async def get_template_post(token: str = Depends(verify_token)):
         task_data = {
             "endpoint": "template",
             "data": {},
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(30),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Template task {task_id} added to Redis queue")
         
@@ -266,7 +484,7 @@ async def get_template_post(token: str = Depends(verify_token)):
             logger.error(f"Template task error: {result['error']}")
             raise HTTPException(status_code=500, detail=result["error"])
         
-        logger.info(f"Template result: {result.get('data', {})}")
+        logger.info(f"Template result: {truncate(result.get('data', {}))}", extra={"event": "payload"})
         return result.get("data", {})
             
     except Exception as e:
@@ -283,15 +501,14 @@ async def tokenize(request: TokenizeRequest, token: str = Depends(verify_token))
         task_data = {
             "endpoint": "tokenize",
             "data": request.dict(),
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(30),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Tokenize task {task_id} added to Redis queue")
         
@@ -301,7 +518,7 @@ async def tokenize(request: TokenizeRequest, token: str = Depends(verify_token))
             logger.error(f"Tokenize task error: {result['error']}")
             raise HTTPException(status_code=500, detail=result["error"])
         
-        logger.info(f"Tokenize result: {result.get('data', {})}")
+        logger.info(f"Tokenize result: {truncate(result.get('data', {}))}", extra={"event": "payload"})
         return result.get("data", {})
             
     except Exception as e:
@@ -310,6 +527,7 @@ async def tokenize(request: TokenizeRequest, token: str = Depends(verify_token))
 
 async def wait_for_result(task_id: str, timeout: int = 300):
     """Wait for a result from Redis with timeout"""
+    timeout = request_timeout(timeout)
     start_time = time.time()
     
     while time.time() - start_time < timeout:
@@ -317,352 +535,347 @@ async def wait_for_result(task_id: str, timeout: int = 300):
         result_data = await redis_client.get(result_key)
         
         if result_data:
-            result = json.loads(result_data)
+            result = orjson.loads(result_data)
             await redis_client.delete(result_key)  # Clean up
+            await scheduler.observe(task_id, result.get("data"))
             return result
         
         await asyncio.sleep(0.1)  # Check every 100ms
     
     return {"error": "Request timeout"}
 
-async def stream_completion_response(task_id: str):
-    """Stream completion response as it arrives from GPU worker"""
-    logger.info(f"Starting stream for task {task_id}")
+# Upper bound on stream entries read per poll
+STREAM_READ_BATCH = 1000
+STREAM_RESUME_TTL = int(os.getenv("STREAM_RESUME_TTL", "120"))  # seconds a finished stream stays replayable
+STREAM_META_TTL = 600  # matches the worker's TTL on stream:{id}
+
+async def register_stream(task_id: str, token: str, kind: str, model: str = ""):
+    """Make a streaming task addressable by ID for reconnects and spectators (GET /streams/{task_id})"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset(f"stream:{task_id}:meta", mapping={"owner": task_owner(token), "kind": kind, "model": model})
+        pipe.expire(f"stream:{task_id}:meta", STREAM_META_TTL)
+        await pipe.execute()
+
+async def stream_meta(task_id: str, token: str) -> dict:
+    """Metadata of a stream owned by `token`, or {} if it is unknown or expired"""
+    meta = await redis_client.hgetall(f"stream:{task_id}:meta")
+    return meta if meta.get("owner") == task_owner(token) else {}
+
+def parse_event_id(last_event_id: Optional[str]):
+    """(task ID, entry, frame) from an SSE event ID "{task_id}:{entry}.{frame}", or None"""
+    try:
+        task_id, position = last_event_id.rsplit(":", 1)
+        entry, frame = position.split(".")
+        return task_id, int(entry), int(frame)
+    except (AttributeError, ValueError):
+        return None
+
+async def read_stream(task_id: str, cursor: int, base: int):
+    """(base, entries from `cursor` on, raw result or None) for a stream.
+
+    Entries are numbered from the start of the stream, but the worker trims the list to its
+    newest STREAM_RESUME_WINDOW entries and keeps the trimmed count as `base` in the meta hash.
+    The read is retried when `base` moved since the caller's last read. If `cursor` < base,
+    the entries it points at are gone and the caller gets none.
+    """
+    while True:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hget(f"stream:{task_id}:meta", "base")
+            pipe.lrange(f"stream:{task_id}", max(cursor - base, 0), cursor - base + STREAM_READ_BATCH - 1)
+            pipe.get(f"result:{task_id}")
+            current, entries, result_data = await pipe.execute()
+        current = int(current or 0)
+        if current == base:
+            return base, entries if cursor >= base else [], result_data
+        base = current
+
+def stream_headers(task_id: str) -> dict:
+    return {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",  # Disable nginx buffering if behind nginx
+        "X-Task-Id": task_id,
+    }
+
+async def relay_stream(task_id: str, final_frame, error_frame, label: str, on_result=None,
+                       event_ids=False, resume=None, from_oldest=False):
+    """Forward the wire-ready frames pushed by the GPU worker verbatim, then close the stream.
+
+    final_frame(data, frames_sent, elapsed) builds the closing frame for workers that did not
+    stream their own ("streamed" unset in the result); error_frame(message) formats errors.
+    on_result(data) is awaited with a successful result, e.g. to record a session turn; it runs
+    once per task however many clients are attached.
+
+    The worker's entries are read, not popped, so any number of readers can follow a stream and a
+    reader can start over. With event_ids, every SSE frame gets an `id: {task_id}:{entry}.{frame}`
+    line; resume=(entry, frame) skips everything up to and including that frame. Only the newest
+    STREAM_RESUME_WINDOW entries are kept (see read_stream): a reader whose position was trimmed
+    gets an error frame, or with from_oldest starts at the oldest entry still kept.
+    """
+    logger.info(f"Starting {label} stream for task {task_id}")
     
-    timeout = 300  # 5 minutes timeout
+    timeout = request_timeout(300)  # 5 minutes unless the client asked for less
     start_time = time.time()
-    chunks_sent = False
-    last_chunk_count = 0
-    total_tokens_sent = 0
-    last_progress_log = 0
+    stream_key = f"stream:{task_id}"
+    result_key = f"result:{task_id}"
+    cursor, skip = resume or (0, -1)  # next entry to read; frames of it already delivered
+    base = 0  # entries trimmed from the head of the list
+    chunks_sent = 0
+    last_progress_log = start_time
+
+    def frames(entries, first):
+        nonlocal skip
+        if not event_ids:
+            return "".join(entries)
+        out = []
+        for index, entry in enumerate(entries, first):
+            for n, frame in enumerate(entry.split("\n\n")[:-1]):
+                if n > skip:
+                    out.append(f"id: {task_id}:{index}.{n}\n{frame}\n\n")
+            skip = -1
+        return "".join(out)
     
     while time.time() - start_time < timeout:
         try:
-            # Check for streaming updates first (priority for real-time streaming)
-            stream_key = f"stream:{task_id}"
-            # Get only new chunks since last check
-            current_chunk_count = await redis_client.llen(stream_key)
+            # Read everything pushed since the last poll and check for the result in one round trip
+            base, entries, result_data = await read_stream(task_id, cursor, base)
+            if cursor < base and from_oldest and not chunks_sent:
+                cursor, skip = base, -1
+                base, entries, result_data = await read_stream(task_id, cursor, base)
+            if cursor < base:
+                logger.warning(f"Task {task_id}: {label} reader at entry {cursor} fell behind the resume window (oldest kept: {base})")
+                yield error_frame(f"Stream position {cursor} is no longer available; entries from {base} on are kept")
+                return
             
-            if current_chunk_count > last_chunk_count:
-                # Get only the new chunks
-                new_chunks = await redis_client.lrange(stream_key, last_chunk_count, current_chunk_count - 1)
+            if entries:
+                chunks_sent += len(entries)
+                cursor += len(entries)
+                yield frames(entries, cursor - len(entries))
                 
-                if new_chunks:
-                    # Process each new streaming chunk immediately
-                    for chunk_data in new_chunks:
-                        try:
-                            chunk = json.loads(chunk_data)
-                            chunk_json = json.dumps(chunk)
-                            yield f"data: {chunk_json}\n\n"
-                            chunks_sent = True
-                            total_tokens_sent += 1
-                            # Very small delay to ensure proper streaming
-                            await asyncio.sleep(0.001)
-                        except json.JSONDecodeError:
-                            logger.error(f"Invalid JSON in stream chunk: {chunk_data}")
-                    
-                    # Log progress every 50 tokens or every 10 seconds
-                    current_time = time.time()
-                    if (total_tokens_sent - last_progress_log >= 50) or (current_time - start_time > last_progress_log + 10):
-                        logger.info(f"Task {task_id}: streaming progress - {total_tokens_sent} tokens sent, {current_time - start_time:.1f}s elapsed")
-                        last_progress_log = total_tokens_sent
-                    
-                    last_chunk_count = current_chunk_count
-            
-            # Check for final result
-            result_key = f"result:{task_id}"
-            result_data = await redis_client.get(result_key)
+                current_time = time.time()
+                if current_time - last_progress_log >= 10:
+                    logger.info(f"Task {task_id}: streaming progress - {chunks_sent} chunks sent, {current_time - start_time:.1f}s elapsed", extra={"event": "progress"})
+                    last_progress_log = current_time
             
             if result_data:
-                result = json.loads(result_data)
+                # Frames pushed between the read and the result read
+                while True:
+                    base, entries, _ = await read_stream(task_id, cursor, base)
+                    if not entries:
+                        break
+                    chunks_sent += len(entries)
+                    cursor += len(entries)
+                    yield frames(entries, cursor - len(entries))
+                if cursor < base:
+                    yield error_frame(f"Stream position {cursor} is no longer available; entries from {base} on are kept")
+                    return
+                
+                result = orjson.loads(result_data)
                 elapsed_time = time.time() - start_time
-                logger.info(f"Task {task_id} completed: {total_tokens_sent} tokens, {elapsed_time:.1f}s duration")
+                logger.info(f"Task {task_id} completed: {chunks_sent} chunks, {elapsed_time:.1f}s duration")
                 
                 if result.get("error"):
-                    error_response = {"error": result["error"]}
-                    error_json = json.dumps(error_response)
-                    yield f"data: {error_json}\n\n"
+                    yield error_frame(result["error"])
                 else:
-                    # Send final stop signal if we sent chunks
                     response_data = result.get("data", {})
-                    if chunks_sent and response_data.get("stop", False):
-                        # Send final stop signal
-                        final_chunk = {
-                            "content": "",
-                            "multimodal": response_data.get("multimodal", False),
-                            "slot_id": response_data.get("slot_id", 0),
-                            "stop": True
-                        }
-                        final_json = json.dumps(final_chunk)
-                        yield f"data: {final_json}\n\n"
-                    elif not chunks_sent:
-                        # No streaming chunks were sent, send the complete result
-                        response_json = json.dumps(response_data)
-                        yield f"data: {response_json}\n\n"
+                    await scheduler.observe(task_id, response_data)  # only counts once, see Scheduler.watched
+                    # The original request and a reconnect both carry the hook; record once
+                    if on_result and await redis_client.set(f"stream:{task_id}:delivered", 1, nx=True, ex=STREAM_META_TTL):
+                        await on_result(response_data)
+                    if not response_data.get("streamed") and not (resume and cursor == resume[0]):
+                        # (a reader resuming after the last entry already has the closing frame)
+                        closing = final_frame(response_data, cursor > 0, elapsed_time)
+                        if closing:
+                            yield f"id: {task_id}:{cursor}.0\n{closing}" if event_ids else closing
                 
-                # Clean up
-                await redis_client.delete(result_key)
-                await redis_client.delete(stream_key)
+                # Keep the finished stream a little longer for clients that reconnect
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    pipe.expire(result_key, STREAM_RESUME_TTL)
+                    pipe.expire(stream_key, STREAM_RESUME_TTL)
+                    await pipe.execute()
                 return
             
-            await asyncio.sleep(0.05)  # Check every 50ms for new tokens
+            if not entries:
+                await asyncio.sleep(0.05)  # Check every 50ms for new tokens
             
         except Exception as e:
-            logger.error(f"Error in stream for task {task_id}: {e}")
-            error_response = {"error": f"Streaming error: {str(e)}"}
-            error_json = json.dumps(error_response)
-            yield f"data: {error_json}\n\n"
+            logger.error(f"Error in {label} stream for task {task_id}: {e}")
+            yield error_frame(f"Streaming error: {str(e)}")
             return
     
     # Timeout reached
-    logger.error(f"Timeout reached for task {task_id} after {time.time() - start_time:.1f}s")
-    timeout_response = {"error": "Request timeout"}
-    timeout_json = json.dumps(timeout_response)
-    yield f"data: {timeout_json}\n\n"
+    logger.error(f"Timeout reached for {label} task {task_id} after {time.time() - start_time:.1f}s")
+    yield error_frame("Request timeout")
+
+def stream_completion_response(task_id: str, on_result=None, resume=None, from_oldest=False):
+    """Stream completion response as SSE as it arrives from GPU worker"""
+    def final_frame(response_data, chunks_sent, elapsed_time):
+        if chunks_sent and response_data.get("stop", False):
+            # Send final stop signal
+            return sse_frame({
+                "content": "",
+                "multimodal": response_data.get("multimodal", False),
+                "slot_id": response_data.get("slot_id", 0),
+                "stop": True
+            })
+        if not chunks_sent:
+            # No streaming chunks were sent, send the complete result
+            return sse_frame(response_data)
+        return None
+
+    return relay_stream(task_id, final_frame, lambda error: sse_frame({"error": error}), "completion", on_result,
+                        event_ids=True, resume=resume, from_oldest=from_oldest)
 
-async def stream_chat_response(task_id: str, model: str):
+def stream_chat_response(task_id: str, model: str, on_result=None, from_oldest=False):
     """Stream chat response in Ollama format as it arrives from GPU worker"""
-    logger.info(f"Starting Ollama chat stream for task {task_id}")
-    
-    timeout = 300  # 5 minutes timeout
-    start_time = time.time()
-    chunks_sent = False
-    last_chunk_count = 0
-    total_tokens_sent = 0
-    last_progress_log = 0
-    
-    while time.time() - start_time < timeout:
-        try:
-            # Check for streaming updates first
-            stream_key = f"stream:{task_id}"
-            current_chunk_count = await redis_client.llen(stream_key)
-            
-            if current_chunk_count > last_chunk_count:
-                # Get only the new chunks
-                new_chunks = await redis_client.lrange(stream_key, last_chunk_count, current_chunk_count - 1)
-                
-                if new_chunks:
-                    # Process each new streaming chunk immediately
-                    for chunk_data in new_chunks:
-                        try:
-                            chunk = json.loads(chunk_data)
-                            # Convert to Ollama chat format
-                            ollama_chunk = {
-                                "model": model,
-                                "created_at": get_iso_timestamp(),
-                                "message": {
-                                    "role": "assistant",
-                                    "content": chunk.get("content", "")
-                                },
-                                "done": False
-                            }
-                            chunk_json = json.dumps(ollama_chunk)
-                            yield f"{chunk_json}\n"
-                            chunks_sent = True
-                            total_tokens_sent += 1
-                            await asyncio.sleep(0.001)
-                        except json.JSONDecodeError:
-                            logger.error(f"Invalid JSON in stream chunk: {chunk_data}")
-                    
-                    # Log progress
-                    current_time = time.time()
-                    if (total_tokens_sent - last_progress_log >= 50) or (current_time - start_time > last_progress_log + 10):
-                        logger.info(f"Task {task_id}: streaming progress - {total_tokens_sent} tokens sent, {current_time - start_time:.1f}s elapsed")
-                        last_progress_log = total_tokens_sent
-                    
-                    last_chunk_count = current_chunk_count
-            
-            # Check for final result
-            result_key = f"result:{task_id}"
-            result_data = await redis_client.get(result_key)
-            
-            if result_data:
-                result = json.loads(result_data)
-                elapsed_time = time.time() - start_time
-                logger.info(f"Task {task_id} completed: {total_tokens_sent} tokens, {elapsed_time:.1f}s duration")
-                
-                if result.get("error"):
-                    error_response = {
-                        "model": model,
-                        "created_at": get_iso_timestamp(),
-                        "message": {
-                            "role": "assistant",
-                            "content": ""
-                        },
-                        "done": True,
-                        "error": result["error"]
-                    }
-                    yield f"{json.dumps(error_response)}\n"
-                else:
-                    # Send final done signal
-                    response_data = result.get("data", {})
-                    final_response = {
-                        "model": model,
-                        "created_at": get_iso_timestamp(),
-                        "message": {
-                            "role": "assistant",
-                            "content": "" if chunks_sent else response_data.get("content", "")
-                        },
-                        "done": True,
-                        "total_duration": int(elapsed_time * 1e9),  # Convert to nanoseconds
-                        "load_duration": response_data.get("load_duration", 0),
-                        "prompt_eval_count": response_data.get("prompt_eval_count", 0),
-                        "prompt_eval_duration": response_data.get("prompt_eval_duration", 0),
-                        "eval_count": response_data.get("eval_count", total_tokens_sent),
-                        "eval_duration": response_data.get("eval_duration", 0)
-                    }
-                    yield f"{json.dumps(final_response)}\n"
-                
-                # Clean up
-                await redis_client.delete(result_key)
-                await redis_client.delete(stream_key)
-                return
-            
-            await asyncio.sleep(0.05)  # Check every 50ms for new tokens
-            
-        except Exception as e:
-            logger.error(f"Error in chat stream for task {task_id}: {e}")
-            error_response = {
-                "model": model,
-                "created_at": get_iso_timestamp(),
-                "message": {
-                    "role": "assistant",
-                    "content": ""
-                },
-                "done": True,
-                "error": f"Streaming error: {str(e)}"
-            }
-            yield f"{json.dumps(error_response)}\n"
-            return
-    
-    # Timeout reached
-    logger.error(f"Timeout reached for chat task {task_id} after {time.time() - start_time:.1f}s")
-    timeout_response = {
-        "model": model,
-        "created_at": get_iso_timestamp(),
-        "message": {
-            "role": "assistant",
-            "content": ""
-        },
-        "done": True,
-        "error": "Request timeout"
-    }
-    yield f"{json.dumps(timeout_response)}\n"
+    def final_frame(response_data, chunks_sent, elapsed_time):
+        return ndjson_frame({
+            "model": model,
+            "created_at": get_iso_timestamp(),
+            "message": {
+                "role": "assistant",
+                "content": "" if chunks_sent else response_data.get("content", "")
+            },
+            "done": True,
+            "total_duration": int(elapsed_time * 1e9),  # Convert to nanoseconds
+            "load_duration": response_data.get("load_duration", 0),
+            "prompt_eval_count": response_data.get("prompt_eval_count", 0),
+            "prompt_eval_duration": response_data.get("prompt_eval_duration", 0),
+            "eval_count": response_data.get("eval_count", 0),
+            "eval_duration": response_data.get("eval_duration", 0)
+        })
+
+    def error_frame(error):
+        return ndjson_frame({
+            "model": model,
+            "created_at": get_iso_timestamp(),
+            "message": {
+                "role": "assistant",
+                "content": ""
+            },
+            "done": True,
+            "error": error
+        })
+
+    return relay_stream(task_id, final_frame, error_frame, "chat", on_result, from_oldest=from_oldest)
 
-async def stream_generate_response(task_id: str, model: str):
+def stream_generate_response(task_id: str, model: str, from_oldest=False):
     """Stream generate response in Ollama format as it arrives from GPU worker"""
-    logger.info(f"Starting Ollama generate stream for task {task_id}")
-    
-    timeout = 300  # 5 minutes timeout
-    start_time = time.time()
-    chunks_sent = False
-    last_chunk_count = 0
-    total_tokens_sent = 0
-    last_progress_log = 0
-    
-    while time.time() - start_time < timeout:
-        try:
-            # Check for streaming updates first
-            stream_key = f"stream:{task_id}"
-            current_chunk_count = await redis_client.llen(stream_key)
-            
-            if current_chunk_count > last_chunk_count:
-                # Get only the new chunks
-                new_chunks = await redis_client.lrange(stream_key, last_chunk_count, current_chunk_count - 1)
-                
-                if new_chunks:
-                    # Process each new streaming chunk immediately
-                    for chunk_data in new_chunks:
-                        try:
-                            chunk = json.loads(chunk_data)
-                            # Convert to Ollama generate format
-                            ollama_chunk = {
-                                "model": model,
-                                "created_at": get_iso_timestamp(),
-                                "response": chunk.get("content", ""),
-                                "done": False
-                            }
-                            chunk_json = json.dumps(ollama_chunk)
-                            yield f"{chunk_json}\n"
-                            chunks_sent = True
-                            total_tokens_sent += 1
-                            await asyncio.sleep(0.001)
-                        except json.JSONDecodeError:
-                            logger.error(f"Invalid JSON in stream chunk: {chunk_data}")
-                    
-                    # Log progress
-                    current_time = time.time()
-                    if (total_tokens_sent - last_progress_log >= 50) or (current_time - start_time > last_progress_log + 10):
-                        logger.info(f"Task {task_id}: streaming progress - {total_tokens_sent} tokens sent, {current_time - start_time:.1f}s elapsed")
-                        last_progress_log = total_tokens_sent
-                    
-                    last_chunk_count = current_chunk_count
-            
-            # Check for final result
-            result_key = f"result:{task_id}"
-            result_data = await redis_client.get(result_key)
-            
-            if result_data:
-                result = json.loads(result_data)
-                elapsed_time = time.time() - start_time
-                logger.info(f"Task {task_id} completed: {total_tokens_sent} tokens, {elapsed_time:.1f}s duration")
-                
-                if result.get("error"):
-                    error_response = {
-                        "model": model,
-                        "created_at": get_iso_timestamp(),
-                        "response": "",
-                        "done": True,
-                        "error": result["error"]
-                    }
-                    yield f"{json.dumps(error_response)}\n"
-                else:
-                    # Send final done signal
-                    response_data = result.get("data", {})
-                    final_response = {
-                        "model": model,
-                        "created_at": get_iso_timestamp(),
-                        "response": "" if chunks_sent else response_data.get("response", ""),
-                        "done": True,
-                        "context": response_data.get("context", []),
-                        "total_duration": int(elapsed_time * 1e9),  # Convert to nanoseconds
-                        "load_duration": response_data.get("load_duration", 0),
-                        "prompt_eval_count": response_data.get("prompt_eval_count", 0),
-                        "prompt_eval_duration": response_data.get("prompt_eval_duration", 0),
-                        "eval_count": response_data.get("eval_count", total_tokens_sent),
-                        "eval_duration": response_data.get("eval_duration", 0)
-                    }
-                    yield f"{json.dumps(final_response)}\n"
-                
-                # Clean up
-                await redis_client.delete(result_key)
-                await redis_client.delete(stream_key)
-                return
-            
-            await asyncio.sleep(0.05)  # Check every 50ms for new tokens
-            
-        except Exception as e:
-            logger.error(f"Error in generate stream for task {task_id}: {e}")
-            error_response = {
-                "model": model,
-                "created_at": get_iso_timestamp(),
-                "response": "",
-                "done": True,
-                "error": f"Streaming error: {str(e)}"
-            }
-            yield f"{json.dumps(error_response)}\n"
-            return
-    
-    # Timeout reached
-    logger.error(f"Timeout reached for generate task {task_id} after {time.time() - start_time:.1f}s")
-    timeout_response = {
-        "model": model,
-        "created_at": get_iso_timestamp(),
-        "response": "",
-        "done": True,
-        "error": "Request timeout"
+    def final_frame(response_data, chunks_sent, elapsed_time):
+        return ndjson_frame({
+            "model": model,
+            "created_at": get_iso_timestamp(),
+            "response": "" if chunks_sent else response_data.get("response", ""),
+            "done": True,
+            "context": response_data.get("context", []),
+            "total_duration": int(elapsed_time * 1e9),  # Convert to nanoseconds
+            "load_duration": response_data.get("load_duration", 0),
+            "prompt_eval_count": response_data.get("prompt_eval_count", 0),
+            "prompt_eval_duration": response_data.get("prompt_eval_duration", 0),
+            "eval_count": response_data.get("eval_count", 0),
+            "eval_duration": response_data.get("eval_duration", 0)
+        })
+
+    def error_frame(error):
+        return ndjson_frame({
+            "model": model,
+            "created_at": get_iso_timestamp(),
+            "response": "",
+            "done": True,
+            "error": error
+        })
+
+    return relay_stream(task_id, final_frame, error_frame, "generate", from_oldest=from_oldest)
+
+# Server-side sessions: persona and history live in Redis so clients send only the new turn
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+SESSION_MAX_TTL = int(os.getenv("SESSION_MAX_TTL", str(7 * 86400)))  # longest idle TTL a client may ask for
+
+class SessionRequest(BaseModel):
+    kind: Optional[str] = "chat"  # chat (messages for /chat) or completion (raw prompt text for /completion)
+    system: Optional[str] = None  # persona: system message for chat, prompt prefix for completion
+    id_slot: Optional[int] = -1  # llama.cpp slot holding this conversation's cache
+    ttl: Optional[int] = Field(None, gt=0, le=SESSION_MAX_TTL)  # idle seconds before the session expires
+
+async def open_session(session_id: str, token: str, kind: str) -> dict:
+    """Session meta and history, checked against the caller; refreshes the TTL"""
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(f"session:{session_id}")
+        pipe.lrange(f"session:{session_id}:messages", 0, -1)
+        meta, messages = await pipe.execute()
+    if not meta or meta.get("owner") != task_owner(token):
+        raise HTTPException(status_code=404, detail="Session not found")
+    if meta["kind"] != kind:
+        raise HTTPException(status_code=400, detail=f"Session {session_id} is a {meta['kind']} session")
+    ttl = int(meta["ttl"])
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.expire(f"session:{session_id}", ttl)
+        pipe.expire(f"session:{session_id}:messages", ttl)
+        await pipe.execute()
+    return {"id": session_id, "meta": meta, "messages": [orjson.loads(m) for m in messages]}
+
+async def record_turn(session: dict, entries: List[dict]):
+    """Append a finished turn to the session history"""
+    key = f"session:{session['id']}"
+    ttl = int(session["meta"]["ttl"])
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(f"{key}:messages", *(dumps(entry) for entry in entries))
+        pipe.ltrim(f"{key}:messages", -SESSION_MAX_MESSAGES, -1)
+        pipe.hset(key, "updated_at", time.time())
+        pipe.expire(key, ttl)
+        pipe.expire(f"{key}:messages", ttl)
+        await pipe.execute()
+
+def session_slot(session: dict, data: dict):
+    """Pin the request to the session's llama.cpp slot unless it names one"""
+    id_slot = int(session["meta"]["id_slot"])
+    if id_slot >= 0 and data.get("id_slot", -1) < 0:
+        data["id_slot"] = id_slot
+
+@app.post("/sessions")
+async def create_session(request: SessionRequest, token: str = Depends(verify_token)):
+    """Start a conversation whose history is kept server-side"""
+    if request.kind not in ("chat", "completion"):
+        raise HTTPException(status_code=400, detail="kind must be chat or completion")
+    session_id = f"sess_{uuid.uuid4().hex}"
+    ttl = request.ttl or SESSION_TTL
+    now = time.time()
+    await redis_client.hset(f"session:{session_id}", mapping={
+        "owner": task_owner(token),
+        "kind": request.kind,
+        "system": request.system or "",
+        "id_slot": request.id_slot,
+        "ttl": ttl,
+        "created_at": now,
+        "updated_at": now,
+    })
+    await redis_client.expire(f"session:{session_id}", ttl)
+    return {"session_id": session_id, "kind": request.kind, "ttl": ttl}
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str, token: str = Depends(verify_token)):
+    meta = await redis_client.hgetall(f"session:{session_id}")
+    if not meta or meta.get("owner") != task_owner(token):
+        raise HTTPException(status_code=404, detail="Session not found")
+    session = await open_session(session_id, token, meta["kind"])
+    return {
+        "session_id": session_id,
+        "kind": meta["kind"],
+        "system": meta["system"],
+        "id_slot": int(meta["id_slot"]),
+        "ttl": int(meta["ttl"]),
+        "created_at": float(meta["created_at"]),
+        "updated_at": float(meta["updated_at"]),
+        "messages": session["messages"],
     }
-    yield f"{json.dumps(timeout_response)}\n"
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str, token: str = Depends(verify_token)):
+    if await redis_client.hget(f"session:{session_id}", "owner") != task_owner(token):
+        raise HTTPException(status_code=404, detail="Session not found")
+    await redis_client.delete(f"session:{session_id}", f"session:{session_id}:messages")
+    return {"deleted": session_id}
 
 @app.post("/chat")
 async def chat(request: OllamaChatRequest, token: str = Depends(verify_token)):
@@ -670,40 +883,55 @@ async def chat(request: OllamaChatRequest, token: str = Depends(verify_token)):
     logger.info(f"Chat request received for model: {request.model}")
     
     try:
+        data = request.dict(exclude={"session_id"})
+        on_result = None
+        if request.session_id:
+            session = await open_session(request.session_id, token, "chat")
+            new_messages = [{k: v for k, v in m.items() if v is not None} for m in data["messages"]]
+            persona = [{"role": "system", "content": session["meta"]["system"]}] if session["meta"]["system"] else []
+            data["messages"] = persona + session["messages"] + new_messages
+            data["include_content"] = True
+            session_slot(session, data)
+
+            async def on_result(result_data):
+                reply = (result_data.get("message") or {}).get("content", result_data.get("content", ""))
+                await record_turn(session, new_messages + [{"role": "assistant", "content": reply}])
+
         # Create task for Redis
         task_data = {
             "endpoint": "chat",
-            "data": request.dict(),
-            "timestamp": time.time()
+            "data": data,
+            "stream_format": "ndjson",
+            "timestamp": time.time(),
+            "deadline": task_deadline(300),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Chat task {task_id} added to Redis queue")
         
         # Check if streaming is requested
         if request.stream:
+            await register_stream(task_id, token, "chat", request.model)
             return StreamingResponse(
-                stream_chat_response(task_id, request.model),
+                stream_chat_response(task_id, request.model, on_result),
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
+                headers=stream_headers(task_id)
             )
         else:
             # Wait for result
             result = await wait_for_result(task_id)
             if result.get("error"):
                 raise HTTPException(status_code=500, detail=result["error"])
+            if on_result and not result["data"].get("error"):
+                await on_result(result["data"])
             return result["data"]
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in chat: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -718,28 +946,25 @@ async def generate(request: OllamaGenerateRequest, token: str = Depends(verify_t
         task_data = {
             "endpoint": "generate",
             "data": request.dict(),
-            "timestamp": time.time()
+            "stream_format": "ndjson",
+            "timestamp": time.time(),
+            "deadline": task_deadline(300),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Generate task {task_id} added to Redis queue")
         
         # Check if streaming is requested
         if request.stream:
+            await register_stream(task_id, token, "generate", request.model)
             return StreamingResponse(
                 stream_generate_response(task_id, request.model),
                 media_type="text/event-stream",
-                headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"
-                }
+                headers=stream_headers(task_id)
             )
         else:
             # Wait for result
@@ -762,15 +987,14 @@ async def list_models(token: str = Depends(verify_token)):
         task_data = {
             "endpoint": "tags",
             "data": {},
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(30),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Tags task {task_id} added to Redis queue")
         
@@ -788,21 +1012,24 @@ async def list_models(token: str = Depends(verify_token)):
 async def generate_embeddings(request: OllamaEmbedRequest, token: str = Depends(verify_token)):
     """Generate embeddings from a model"""
     logger.info(f"Embed request received for model: {request.model}")
+    if request.encoding_format not in ("float", "base64"):
+        raise HTTPException(status_code=400, detail="encoding_format must be float or base64")
+    if request.dtype not in ("float32", "float16"):
+        raise HTTPException(status_code=400, detail="dtype must be float32 or float16")
     
     try:
         # Create task for Redis
         task_data = {
             "endpoint": "embed",
             "data": request.dict(),
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(60),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Embed task {task_id} added to Redis queue")
         
@@ -810,75 +1037,165 @@ async def generate_embeddings(request: OllamaEmbedRequest, token: str = Depends(
         result = await wait_for_result(task_id, timeout=60)
         if result.get("error"):
             raise HTTPException(status_code=500, detail=result["error"])
-        return result["data"]
+        if result["data"].get("error"):
+            raise HTTPException(status_code=500, detail=result["data"]["error"])
+        # Serialized by orjson directly; FastAPI's encoder would walk every float
+        return Response(content=orjson.dumps(result["data"]), media_type="application/json")
             
     except Exception as e:
         logger.error(f"Error in embed: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+# Structured output: JSON schemas compiled to GBNF once and referenced by ID
+grammar_store = GrammarStore(redis_client)
+
+class GrammarRequest(BaseModel):
+    json_schema: Dict[str, Any]
+
+async def resolve_grammar(data: dict) -> Optional[str]:
+    """Replace a request's json_schema or grammar_id with the grammar text; returns the grammar ID"""
+    schema, grammar_id = data.pop("json_schema", None), data.pop("grammar_id", None)
+    if schema is not None and grammar_id:
+        raise HTTPException(status_code=400, detail="Send json_schema or grammar_id, not both")
+    if schema is not None:
+        try:
+            grammar_id, data["grammar"] = await grammar_store.compile(schema)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Cannot compile json_schema: {e}")
+    elif grammar_id:
+        data["grammar"] = await grammar_store.get(grammar_id)
+        if data["grammar"] is None:
+            raise HTTPException(status_code=404, detail=f"Unknown grammar_id {grammar_id}; send the json_schema again")
+    return grammar_id
+
+@app.post("/grammars")
+async def create_grammar(request: GrammarRequest, token: str = Depends(verify_token)):
+    """Compile a JSON schema to a GBNF grammar; the returned ID stands in for it on /completion"""
+    data = request.dict()
+    grammar_id = await resolve_grammar(data)
+    return {"grammar_id": grammar_id, "grammar": data["grammar"]}
+
+@app.get("/grammars/{grammar_id}")
+async def get_grammar(grammar_id: str, token: str = Depends(verify_token)):
+    grammar = await grammar_store.get(grammar_id)
+    if grammar is None:
+        raise HTTPException(status_code=404, detail="Grammar not found")
+    return {"grammar_id": grammar_id, "grammar": grammar}
+
 @app.post("/completion")
-async def completion(request: CompletionRequest, token: str = Depends(verify_token)):
-    """Handle completion requests with streaming support"""
+async def completion(request: CompletionRequest, response: Response, token: str = Depends(verify_token),
+                     last_event_id: Optional[str] = Header(None)):
+    """Handle completion requests with streaming support.
+
+    A streaming request that sends Last-Event-ID from an earlier stream reattaches to that task
+    and resumes after the given frame instead of generating again.
+    """
     logger.info(f"Completion request received: {request.prompt[:50]}...")
     
     try:
+        data = request.dict(exclude={"session_id"})
+        grammar_id = await resolve_grammar(data)
+        on_result = None
+        if request.session_id:
+            session = await open_session(request.session_id, token, "completion")
+            data["prompt"] = session["meta"]["system"] + "".join(m["content"] for m in session["messages"]) + request.prompt
+            data["include_content"] = True
+            session_slot(session, data)
+
+            async def on_result(result_data):
+                await record_turn(session, [
+                    {"role": "prompt", "content": request.prompt},
+                    {"role": "completion", "content": result_data.get("content", "")},
+                ])
+
+        resumed = parse_event_id(last_event_id) if request.stream else None
+        if resumed and (await stream_meta(resumed[0], token)).get("kind") == "completion":
+            logger.info(f"Resuming stream {resumed[0]} after {resumed[1]}.{resumed[2]}")
+            return StreamingResponse(
+                stream_completion_response(resumed[0], on_result, resume=resumed[1:]),
+                media_type="text/event-stream",
+                headers=stream_headers(resumed[0]),
+            )
+
         # Create task for Redis
         task_data = {
             "endpoint": "completion",
-            "data": request.dict(),
-            "timestamp": time.time()
+            "data": data,
+            "stream_format": "sse",
+            "timestamp": time.time(),
+            "deadline": task_deadline(300),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Task {task_id} added to Redis queue")
         
         # Check if streaming is requested
         if request.stream:
+            await register_stream(task_id, token, "completion")
             return StreamingResponse(
-                stream_completion_response(task_id),
+                stream_completion_response(task_id, on_result),
                 media_type="text/event-stream",
                 headers={
-                    "Cache-Control": "no-cache",
-                    "Connection": "keep-alive",
-                    "X-Accel-Buffering": "no"  # Disable nginx buffering if behind nginx
+                    **stream_headers(task_id),
+                    **({"X-Grammar-Id": grammar_id} if grammar_id else {}),
                 }
             )
         else:
+            if grammar_id:
+                response.headers["X-Grammar-Id"] = grammar_id
             # Wait for result
             result = await wait_for_result(task_id)
             if result.get("error"):
                 raise HTTPException(status_code=500, detail=result["error"])
+            if on_result and not result["data"].get("error"):
+                await on_result(result["data"])
             return result["data"]
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in completion: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/streams/{task_id}")
+async def attach_stream(task_id: str, token: str = Depends(verify_token), last_event_id: Optional[str] = Header(None)):
+    """Follow a running or recently finished stream read-only, from the start or after Last-Event-ID"""
+    meta = await stream_meta(task_id, token)
+    if not meta:
+        raise HTTPException(status_code=404, detail="Stream not found")
+    resumed = parse_event_id(last_event_id)
+    resume = resumed[1:] if resumed and resumed[0] == task_id else None
+    # Without a resume point, a late spectator starts at the oldest entry still kept
+    if meta["kind"] == "completion":
+        frames = stream_completion_response(task_id, resume=resume, from_oldest=resume is None)
+    elif meta["kind"] == "chat":
+        frames = stream_chat_response(task_id, meta["model"], from_oldest=True)
+    else:
+        frames = stream_generate_response(task_id, meta["model"], from_oldest=True)
+    return StreamingResponse(frames, media_type="text/event-stream", headers=stream_headers(task_id))
+
 @app.post("/slots")
 async def handle_slots(request: SlotRequest, token: str = Depends(verify_token)):
     """Handle slot operations (save/restore cache) via Redis async tasks"""
     try:
-        logger.info(f"Creating slots task: {request.dict()}")
+        logger.info(f"Creating slots task: {truncate(request.dict())}", extra={"event": "payload"})
         
         # Create task for Redis
         task_data = {
             "endpoint": "slots",
             "data": request.dict(),
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "deadline": task_deadline(30),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("gpu_tasks", json.dumps({
-            "id": task_id,
-            **task_data
-        }))
+        await scheduler.enqueue("gpu_tasks", {"id": task_id, **task_data}, task_owner(token))
         
         logger.info(f"Slots task {task_id} added to Redis queue")
         
@@ -888,29 +1205,159 @@ async def handle_slots(request: SlotRequest, token: str = Depends(verify_token))
             logger.error(f"Slots task error: {result['error']}")
             raise HTTPException(status_code=500, detail=result["error"])
         
-        logger.info(f"Slots result: {result.get('data', {})}")
+        logger.info(f"Slots result: {truncate(result.get('data', {}))}", extra={"event": "payload"})
         return result.get("data", {})
             
     except Exception as e:
         logger.error(f"Error in slots endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error in slots: {str(e)}")
 
+def sign_blob(digest: str, expires: int) -> str:
+    return hmac.new(IMAGE_URL_SECRET, f"{digest}:{expires}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def image_media_type(data: bytes) -> str:
+    """Media type from the image signature"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    return "image/png"
+
+async def load_image(data: dict) -> bytes:
+    """Image bytes for an SD result, from its blob or from a legacy base64 worker result"""
+    if "image_base64" in data:
+        return base64.b64decode(data["image_base64"])
+    if "content" in data["image"]:
+        return data["image"]["content"]  # served from the image cache
+    image = await blob_client.get(f"blob:{data['image']['blob']}")
+    if image is None:
+        raise HTTPException(status_code=410, detail="Generated image expired before it was read")
+    return image
+
+async def hold_blob(ref: dict, ttl: int, content=None):
+    """Keep an image blob for at least `ttl` seconds, uploading `content` if the key is gone.
+
+    nx/gt: a blob a job or batch keeps for longer is never overwritten or shortened.
+    """
+    key = f"blob:{ref['blob']}"
+    if content is not None and await blob_client.set(key, content, ex=ttl, nx=True):
+        return
+    await blob_client.expire(key, ttl, gt=True)
+
+async def image_response(data: dict, response_format: str):
+    """Shape an SD result as the client asked: raw bytes, a short-lived URL or legacy base64 JSON"""
+    if response_format == "url" and "image" in data:
+        expires = int(time.time()) + IMAGE_URL_TTL
+        response = {"expires_at": expires, "info": data.get("info", {})}
+        for name, prefix in (("image", ""), ("thumbnail", "thumbnail_")):
+            if name not in data:
+                continue
+            digest = data[name]["blob"]
+            # Keep the blob alive at least as long as the URL is valid
+            await hold_blob(data[name], IMAGE_URL_TTL + 60, data[name].get("content"))
+            response[f"{prefix}url"] = f"{app.root_path}/blobs/{digest}?expires={expires}&sig={sign_blob(digest, expires)}"
+            response[f"{prefix}media_type"] = data[name]["media_type"]
+            response[f"{prefix}bytes"] = data[name]["bytes"]
+        return response
+
+    image = await load_image(data)
+    if response_format == "binary":
+        # Generation info would not fit in a header reliably; clients needing it use url or base64
+        headers = {"ETag": f'"{data["image"]["blob"]}"'} if "image" in data else {}
+        return Response(content=image, media_type=image_media_type(image), headers=headers)
+    response = {"image_base64": base64.b64encode(image).decode(), "info": data.get("info", {})}
+    if "thumbnail" in data:
+        response["thumbnail_base64"] = base64.b64encode(await load_image({"image": data["thumbnail"]})).decode()
+    return response
+
+def active_checkpoint(request: SDGenerationRequest) -> Optional[str]:
+    """Checkpoint a request will run on: its pinned one, else the one loaded on every image node"""
+    pinned = (request.override_settings or {}).get("sd_model_checkpoint")
+    return checkpoint_name(pinned) or sd_pool.shared_checkpoint()
+
+def generated_on(info, checkpoint) -> bool:
+    """Whether A1111's generation info names `checkpoint`; the pool's view of loaded models can be stale"""
+    try:
+        parsed = info if isinstance(info, dict) else orjson.loads(info)
+        model = parsed["sd_model_name"]
+    except (TypeError, ValueError, KeyError):
+        return False
+    return bool(model) and os.path.splitext(os.path.basename(checkpoint))[0] == model
+
+def cached_image_result(entry: dict) -> dict:
+    """Image cache entry in the shape of an SD worker result"""
+    def ref(content, media_type):
+        return {"blob": hashlib.sha256(content).hexdigest(), "media_type": media_type, "bytes": len(content), "content": content}
+
+    data = {"image": ref(entry["image"], entry["media_type"]), "info": entry["info"]}
+    if entry["thumbnail"]:
+        data["thumbnail"] = ref(entry["thumbnail"], entry["media_type"])
+    return data
+
+async def cache_image_result(key: str, data: dict):
+    """Copy a fresh SD result into the image cache"""
+    try:
+        image = await load_image(data)
+        thumbnail = await load_image({"image": data["thumbnail"]}) if "thumbnail" in data else None
+        media_type = data["image"]["media_type"] if "image" in data else image_media_type(image)
+        await asyncio.to_thread(image_cache.put, key, image, media_type, thumbnail, data.get("info", ""))
+    except Exception as e:
+        logger.warning(f"Failed to cache image {key}: {e}")
+
+@app.on_event("startup")
+async def start_sd_pool():
+    sd_pool.start()
+
+@app.get("/blobs/{digest}")
+async def get_blob(digest: str, expires: int, sig: str):
+    """Serve a generated image by signed URL; no bearer token so it can be handed to an image loader"""
+    if expires < time.time() or not hmac.compare_digest(sig, sign_blob(digest, expires)):
+        raise HTTPException(status_code=403, detail="Invalid or expired image URL")
+    image = await blob_client.get(f"blob:{digest}")
+    if image is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    return Response(content=image, media_type=image_media_type(image), headers={
+        "Cache-Control": f"private, max-age={max(0, expires - int(time.time()))}, immutable",
+        "ETag": f'"{digest}"',
+    })
+
+def validate_image_request(request: SDGenerationRequest):
+    if request.response_format not in ("base64", "binary", "url"):
+        raise HTTPException(status_code=400, detail="response_format must be base64, binary or url")
+    if request.output_format.lower() not in ("png", "webp", "jpeg", "jpg"):
+        raise HTTPException(status_code=400, detail="output_format must be png, webp or jpeg")
+    if not 1 <= request.quality <= 100:
+        raise HTTPException(status_code=400, detail="quality must be between 1 and 100")
+
 @app.post("/generate-image")
 async def generate_image(request: SDGenerationRequest, token: str = Depends(verify_token)):
     """Generate images using Stable Diffusion via Redis async tasks"""
+    validate_image_request(request)
     try:
         logger.info(f"SD generation request: {request.prompt[:50]}...")
         
+        cache_key = None
+        if image_cache and request.seed is not None and request.seed != -1:
+            checkpoint = active_checkpoint(request)
+            if checkpoint:
+                cache_key = ImageCache.key(request.dict(), checkpoint)
+                entry = await asyncio.to_thread(image_cache.get, cache_key)
+                if entry:
+                    logger.info(f"SD image cache hit {cache_key[:12]}")
+                    return await image_response(cached_image_result(entry), request.response_format)
+        
         # Create task for Redis
         task_data = {
             "endpoint": "sd_generation",
-            "data": request.dict(),
-            "timestamp": time.time()
+            "data": request.dict(exclude={"response_format"}, exclude_none=True),
+            "timestamp": time.time(),
+            "deadline": task_deadline(600),
+            "request_id": request_id_var.get()
         }
         
         # Add to Redis queue specifically for SD tasks
         task_id = str(uuid.uuid4())
-        await redis_client.lpush("sd_tasks", json.dumps({
+        await redis_client.lpush("sd_tasks", dumps({
             "id": task_id,
             **task_data
         }))
@@ -923,13 +1370,427 @@ async def generate_image(request: SDGenerationRequest, token: str = Depends(veri
             logger.error(f"SD generation error: {result['error']}")
             raise HTTPException(status_code=500, detail=result["error"])
         
+        data = result.get("data", {})
+        if data.get("error"):
+            raise HTTPException(status_code=500, detail=data["error"])
+        
         logger.info(f"SD generation completed for task {task_id}")
-        return result.get("data", {})
+        if cache_key and not generated_on(data.get("info"), checkpoint):
+            # A swap since the last health check ran it on another checkpoint; don't file it under this one
+            logger.info(f"SD task {task_id} ran on another checkpoint than {checkpoint}; not caching it")
+            cache_key = None
+        if cache_key:
+            # Off the response path; the blobs outlive this by SD_BLOB_TTL
+            task = asyncio.create_task(cache_image_result(cache_key, data))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        return await image_response(data, request.response_format)
             
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in generate-image: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
 
+# Submit-and-poll jobs: the API answers 202 with a task ID and keeps no coroutine or connection per
+# job. State lives in task:{id} hashes; one loop moves finished results into them and fires webhooks.
+TASK_TTL = int(os.getenv("TASK_TTL", "86400"))
+TASK_POLL_INTERVAL = float(os.getenv("TASK_POLL_INTERVAL", "0.5"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_TIMEOUT = float(os.getenv("WEBHOOK_TIMEOUT", "10"))
+WEBHOOK_RETRIES = int(os.getenv("WEBHOOK_RETRIES", "3"))
+PENDING_TASKS = "tasks:pending"
+
+def task_owner(token: str) -> str:
+    """Tasks are only visible to the token that submitted them"""
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+# Hosts that may receive webhooks even though they resolve to internal addresses
+WEBHOOK_ALLOWED_HOSTS = {host.strip().lower() for host in os.getenv("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()}
+
+async def webhook_url_error(webhook_url: str) -> Optional[str]:
+    """Why the API must not call a webhook URL, or None.
+
+    Clients choose the URL, so hosts resolving to loopback, private, link-local or other
+    non-public addresses (Redis, admin ports, cloud metadata) are refused unless allow-listed.
+    """
+    try:
+        parts = urlsplit(webhook_url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+    except ValueError:
+        parts = None
+    if not parts or parts.scheme not in ("http", "https") or not parts.hostname:
+        return "webhook_url must be an http(s) URL"
+    host = parts.hostname.lower()
+    if host in WEBHOOK_ALLOWED_HOSTS:
+        return None
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        return f"webhook_url host {host} does not resolve"
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            return f"webhook_url host {host} resolves to a non-public address; add it to WEBHOOK_ALLOWED_HOSTS to allow it"
+    return None
+
+async def validate_webhook_url(webhook_url: Optional[str]):
+    if webhook_url:
+        error = await webhook_url_error(webhook_url)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+
+async def submit_task(queue_name: str, endpoint: str, worker_endpoint: str, data: dict, token: str,
+                      webhook_url: Optional[str] = None, response_format: str = "") -> dict:
+    """Record a job, enqueue it for the workers and return its handle"""
+    task_id = str(uuid.uuid4())
+    now = time.time()
+    envelope = {
+        "id": task_id,
+        "endpoint": worker_endpoint,
+        "data": data,
+        "timestamp": now,
+        "request_id": request_id_var.get()
+    }
+    if request_timeout_var.get() is not None:
+        envelope["deadline"] = task_deadline(TASK_TTL)  # jobs only expire if the client says so
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(f"task:{task_id}", mapping={
+            "status": "queued",
+            "endpoint": endpoint,
+            "owner": task_owner(token),
+            "created_at": now,
+            "webhook_url": webhook_url or "",
+            "response_format": response_format,
+        })
+        pipe.expire(f"task:{task_id}", TASK_TTL)
+        pipe.sadd(PENDING_TASKS, task_id)
+        await scheduler.enqueue(queue_name, envelope, task_owner(token), pipe)
+        await pipe.execute()
+    logger.info(f"Async {endpoint} task {task_id} added to Redis {queue_name} queue")
+    return {"task_id": task_id, "status": "queued", "status_url": f"{app.root_path}/tasks/{task_id}"}
+
+async def keep_blobs(data: dict, ttl: int = TASK_TTL):
+    """Extend the image blobs of a finished job to its lifetime (cache hits carry their bytes)"""
+    for name in ("image", "thumbnail"):
+        ref = data.get(name)
+        if not ref:
+            continue
+        await hold_blob(ref, ttl, ref.pop("content", None))
+
+async def finish_task(task_id: str, result: dict, meta: dict):
+    """Store a worker result in the task record, then hand it to the webhook"""
+    data = result.get("data")
+    error = result.get("error") or (data.get("error") if isinstance(data, dict) else None)
+    if not error and meta.get("endpoint") == "generate-image":
+        await keep_blobs(data)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(f"task:{task_id}", mapping={
+            "status": "failed" if error else "done",
+            "finished_at": time.time(),
+            "result": dumps({"error": error} if error else {"data": data}),
+        })
+        pipe.expire(f"task:{task_id}", TASK_TTL)
+        pipe.delete(f"result:{task_id}")
+        await pipe.execute()
+    logger.info(f"Async task {task_id} {'failed' if error else 'done'}")
+    if meta.get("webhook_url"):
+        task = asyncio.create_task(deliver_webhook(task_id, meta["webhook_url"]))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def claim_result(task_id: str, raw: str) -> bool:
+    """Finish a task whose result has arrived; SREM makes exactly one API replica do it"""
+    if not await redis_client.srem(PENDING_TASKS, task_id):
+        return False
+    await finish_task(task_id, orjson.loads(raw), await redis_client.hgetall(f"task:{task_id}"))
+    return True
+
+async def task_view(task_id: str, meta: dict) -> dict:
+    """Public form of a task record, as returned by GET /tasks/{id} and posted to webhooks"""
+    view = {
+        "task_id": task_id,
+        "status": meta["status"],
+        "endpoint": meta["endpoint"],
+        "created_at": float(meta["created_at"]),
+    }
+    if meta.get("finished_at"):
+        view["finished_at"] = float(meta["finished_at"])
+    if meta.get("result"):
+        result = orjson.loads(meta["result"])
+        if "error" in result:
+            view["error"] = result["error"]
+        elif meta["endpoint"] == "generate-image":
+            # Images go out as fresh signed URLs unless base64 was asked for; a JSON body cannot carry binary
+            response_format = "base64" if meta.get("response_format") == "base64" else "url"
+            view["result"] = await image_response(result["data"], response_format)
+        else:
+            view["result"] = result["data"]
+    return view
+
+async def deliver_webhook(task_id: str, url: str):
+    """POST the finished task to its webhook, retrying with backoff; signed when WEBHOOK_SECRET is set"""
+    meta = await redis_client.hgetall(f"task:{task_id}")
+    if not meta:
+        return
+    try:
+        body = dumps(await task_view(task_id, meta))
+    except HTTPException as e:
+        body = dumps({"task_id": task_id, "status": "failed", "endpoint": meta["endpoint"], "error": e.detail})
+    headers = {"Content-Type": "application/json", "X-Velesio-Task-ID": task_id}
+    if WEBHOOK_SECRET:
+        signature = hmac.new(WEBHOOK_SECRET.encode(), body.encode(), hashlib.sha256).hexdigest()
+        headers["X-Velesio-Signature"] = f"sha256={signature}"
+    # Checked again on delivery: the host's DNS may have changed since submission
+    error = await webhook_url_error(url)
+    if error:
+        logger.warning(f"Webhook for task {task_id} refused: {error}")
+        await redis_client.hset(f"task:{task_id}", "webhook_status", "refused")
+        return
+    status = "failed"
+    async with httpx.AsyncClient(timeout=WEBHOOK_TIMEOUT) as client:
+        for attempt in range(WEBHOOK_RETRIES):
+            try:
+                response = await client.post(url, content=body, headers=headers)
+                if response.status_code < 300:
+                    status = "delivered"
+                    break
+                logger.warning(f"Webhook for task {task_id} returned {response.status_code}")
+            except httpx.HTTPError as e:
+                logger.warning(f"Webhook for task {task_id} failed: {e}")
+            if attempt + 1 < WEBHOOK_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+    await redis_client.hset(f"task:{task_id}", "webhook_status", status)
+
+async def finish_tasks_loop():
+    """Poll the results of all pending jobs in one pipeline per tick"""
+    while True:
+        try:
+            task_ids = list(await redis_client.smembers(PENDING_TASKS))
+            if task_ids:
+                async with redis_client.pipeline(transaction=False) as pipe:
+                    for task_id in task_ids:
+                        pipe.get(f"result:{task_id}")
+                        pipe.exists(f"task:{task_id}")
+                    replies = await pipe.execute()
+                for task_id, raw, exists in zip(task_ids, replies[::2], replies[1::2]):
+                    if raw is not None:
+                        await claim_result(task_id, raw)
+                    elif not exists:
+                        await redis_client.srem(PENDING_TASKS, task_id)  # record expired, result never came
+        except Exception as e:
+            logger.error(f"Error finishing async tasks: {e}")
+        await asyncio.sleep(TASK_POLL_INTERVAL)
+
+@app.on_event("startup")
+async def start_task_finisher():
+    task = asyncio.create_task(finish_tasks_loop())
+    background_tasks.add(task)
+
+@app.post("/tasks/completion", status_code=202)
+async def submit_completion(request: CompletionRequest, webhook_url: Optional[str] = None, token: str = Depends(verify_token)):
+    """Queue a completion and return its task ID at once; poll /tasks/{id} or wait for the webhook"""
+    await validate_webhook_url(webhook_url)
+    data = request.dict(exclude={"session_id"})
+    await resolve_grammar(data)
+    data["stream"] = False  # the result is collected whole
+    return await submit_task("gpu_tasks", "completion", "completion", data, token, webhook_url)
+
+@app.post("/tasks/generate-image", status_code=202)
+async def submit_image(request: SDGenerationRequest, webhook_url: Optional[str] = None, token: str = Depends(verify_token)):
+    """Queue an image generation and return its task ID at once"""
+    validate_image_request(request)
+    await validate_webhook_url(webhook_url)
+    return await submit_task(
+        "sd_tasks", "generate-image", "sd_generation",
+        request.dict(exclude={"response_format"}, exclude_none=True),
+        token, webhook_url, request.response_format,
+    )
+
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str, token: str = Depends(verify_token)):
+    """Status of an async job, with its result once done"""
+    meta = await redis_client.hgetall(f"task:{task_id}")
+    if not meta or meta.get("owner") != task_owner(token):
+        raise HTTPException(status_code=404, detail="Task not found")
+    if meta["status"] == "queued":
+        # Don't wait for the next finisher tick if the worker is already done
+        raw = await redis_client.get(f"result:{task_id}")
+        if raw is not None and await claim_result(task_id, raw):
+            meta = await redis_client.hgetall(f"task:{task_id}")
+    return await task_view(task_id, meta)
+
+# Offline batches: JSONL uploads run line by line at the lowest priority, see batches.py
+BATCH_MODELS = {"completion": CompletionRequest, "generate": OllamaGenerateRequest, "generate-image": SDGenerationRequest}
+
+async def keep_batch_blobs(data: dict):
+    await keep_blobs(data, BATCH_TTL)
+
+batch_runner = BatchRunner(redis_client, scheduler, on_image_result=keep_batch_blobs)
+
+@app.on_event("startup")
+async def start_batch_runner():
+    batch_runner.start()
+
+def parse_batch_line(number: int, text: str) -> dict:
+    """Validate one uploaded line into {"endpoint", "body", "custom_id"}"""
+    try:
+        line = orjson.loads(text)
+        model = BATCH_MODELS[line["endpoint"]]
+        request = model(**line["body"])
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Line {number}: needs an endpoint ({', '.join(BATCH_MODELS)}) and a body")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Line {number}: {e}")
+    if isinstance(request, SDGenerationRequest):
+        validate_image_request(request)
+        body = request.dict(exclude={"response_format"}, exclude_none=True)
+    else:
+        body = request.dict()
+        body["stream"] = False
+    return {"endpoint": line["endpoint"], "body": body, "custom_id": line.get("custom_id")}
+
+@app.post("/batches", status_code=202)
+async def submit_batch(request: Request, token: str = Depends(verify_token)):
+    """Queue a JSONL file of requests to run when the GPUs are otherwise idle"""
+    body = await request.body()
+    lines = [parse_batch_line(number, text) for number, text in enumerate(body.decode().splitlines(), 1) if text.strip()]
+    if not lines:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(lines) > BATCH_MAX_REQUESTS:
+        raise HTTPException(status_code=400, detail=f"Batches are limited to {BATCH_MAX_REQUESTS} requests")
+    for line in lines:
+        if line["endpoint"] == "completion":
+            await resolve_grammar(line["body"])
+    return await batch_runner.submit(lines, task_owner(token))
+
+async def owned_batch(batch_id: str, token: str):
+    if await batch_runner.owner(batch_id) != task_owner(token):
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+@app.get("/batches/{batch_id}")
+async def get_batch(batch_id: str, token: str = Depends(verify_token)):
+    """Progress and throughput of a batch"""
+    await owned_batch(batch_id, token)
+    return await batch_runner.state(batch_id)
+
+@app.get("/batches/{batch_id}/results")
+async def get_batch_results(batch_id: str, token: str = Depends(verify_token)):
+    """Finished lines as JSONL, in completion order; images are inlined as base64"""
+    await owned_batch(batch_id, token)
+
+    async def rows():
+        async for row in batch_runner.results(batch_id):
+            if row["endpoint"] == "generate-image" and row["status"] == "done":
+                try:
+                    row["result"] = await image_response(row["result"], "base64")
+                except HTTPException as e:
+                    row.update({"status": "failed", "error": e.detail})
+                    row.pop("result")
+            yield dumps(row) + "\n"
+
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+class CollectionDocument(BaseModel):
+    id: Optional[str] = None  # generated when omitted
+    text: str
+    metadata: Optional[Dict[str, Any]] = None
+
+class AddDocumentsRequest(BaseModel):
+    documents: List[CollectionDocument]
+    model: Optional[str] = None  # embedding model; required when creating the collection
+
+class SearchRequest(BaseModel):
+    collection: str
+    query: Optional[str] = None
+    vector: Optional[List[float]] = None  # search with a precomputed embedding instead of `query`
+    k: Optional[int] = 5
+    probes: Optional[int] = None  # IVF lists to scan, for large collections
+
+def require_vector_index():
+    if vector_index is None:
+        raise HTTPException(status_code=503, detail="Vector search is disabled; set VECTOR_INDEX_DIR")
+    return vector_index
+
+async def embed_batch(model: str, texts: List[str]) -> List[np.ndarray]:
+    """One embed task, returned as packed float32 so no float lists are built"""
+    task_id = str(uuid.uuid4())
+    await scheduler.enqueue("gpu_tasks", {
+        "id": task_id,
+        "endpoint": "embed",
+        "data": {"model": model, "input": texts, "encoding_format": "base64", "dtype": "float32", "normalize": True},
+        "timestamp": time.time(),
+        "deadline": task_deadline(60),
+        "request_id": request_id_var.get()
+    })
+    result = await wait_for_result(task_id, timeout=60)
+    error = result.get("error") or result.get("data", {}).get("error")
+    if error:
+        raise HTTPException(status_code=500, detail=f"Embedding failed: {error}")
+    return [np.frombuffer(base64.b64decode(vector), dtype="<f4") for vector in result["data"]["embeddings"]]
+
+async def embed_texts(model: str, texts: List[str]) -> np.ndarray:
+    """Embed texts through the GPU workers in parallel batches"""
+    batches = await asyncio.gather(*(embed_batch(model, texts[i:i + EMBED_BATCH]) for i in range(0, len(texts), EMBED_BATCH)))
+    return np.vstack([vector for batch in batches for vector in batch])
+
+@app.post("/collections/{name}/documents")
+async def add_documents(name: str, request: AddDocumentsRequest, token: str = Depends(verify_token)):
+    """Embed documents and add them to a collection, creating it on first use"""
+    index = require_vector_index()
+    owner = task_owner(token)
+    collection = index.get(owner, name)
+    model = collection.meta["model"] if collection else request.model
+    if not model:
+        raise HTTPException(status_code=400, detail="model is required to create a collection")
+    if not request.documents:
+        raise HTTPException(status_code=400, detail="No documents")
+    documents = [{"id": doc.id or uuid.uuid4().hex, "text": doc.text, "metadata": doc.metadata} for doc in request.documents]
+    ids = [doc["id"] for doc in documents]
+    if len(set(ids)) != len(ids) or (collection and collection.ids.intersection(ids)):
+        raise HTTPException(status_code=400, detail="Document ids must be unique within a collection")
+
+    vectors = await embed_texts(model, [doc["text"] for doc in documents])
+    try:
+        collection = collection or index.create(owner, name, model)
+        await asyncio.to_thread(collection.add, documents, vectors)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logger.info(f"Added {len(documents)} documents to collection {name}")
+    return {"collection": name, "added": len(documents), "ids": ids, **collection.stats()}
+
+@app.get("/collections")
+async def list_collections(token: str = Depends(verify_token)):
+    """The caller's collections; every token only sees its own"""
+    return require_vector_index().stats(task_owner(token))
+
+@app.delete("/collections/{name}")
+async def delete_collection(name: str, token: str = Depends(verify_token)):
+    if not require_vector_index().drop(task_owner(token), name):
+        raise HTTPException(status_code=404, detail="Collection not found")
+    return {"deleted": name}
+
+@app.post("/search")
+async def search(request: SearchRequest, token: str = Depends(verify_token)):
+    """Top-k documents of a collection by cosine similarity to a query text or vector"""
+    collection = require_vector_index().get(task_owner(token), request.collection)
+    if collection is None:
+        raise HTTPException(status_code=404, detail="Collection not found")
+    if (request.query is None) == (request.vector is None):
+        raise HTTPException(status_code=400, detail="Give exactly one of query or vector")
+    if not 1 <= request.k <= 1000:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 1000")
+
+    query = np.asarray(request.vector, dtype=np.float32) if request.vector is not None else (await embed_texts(collection.meta["model"], [request.query]))[0]
+    started = time.perf_counter()
+    try:
+        results = await asyncio.to_thread(collection.search, query, request.k, request.probes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"collection": request.collection, "results": results, "search_ms": round((time.perf_counter() - started) * 1000, 3)}
+
 @app.get("/")
 def root(token: str = Depends(verify_token)):
     return {
@@ -937,9 +1798,14 @@ def root(token: str = Depends(verify_token)):
         "status": "running",
         "endpoints": {
             "ollama": ["/chat", "/generate", "/tags", "/embed"],
-            "llama_cpp": ["/completion", "/template", "/tokenize", "/slots"],
-            "stable_diffusion": ["/generate-image", "/sdapi/v1/txt2img", "/sdapi/v1/options"],
-            "admin": ["/health"]
+            "llama_cpp": ["/completion", "/chat", "/embed", "/template", "/tokenize", "/slots"],
+            "streams": ["/streams/{task_id}"],
+            "stable_diffusion": ["/generate-image", "/blobs/{digest}", "/sdapi/v1/txt2img", "/sdapi/v1/options"],
+            "sessions": ["/sessions", "/sessions/{session_id}"],
+            "grammars": ["/grammars", "/grammars/{grammar_id}"],
+            "retrieval": ["/collections", "/collections/{name}/documents", "/search"],
+            "async": ["/tasks/completion", "/tasks/generate-image", "/tasks/{task_id}", "/batches", "/batches/{batch_id}"],
+            "admin": ["/health", "/metrics"]
         },
         "architecture": "Distributed Redis async task-based worker system",
         "authentication": "Authentication required for all endpoints except /health, use a Bearer token"
@@ -948,17 +1814,53 @@ def root(token: str = Depends(verify_token)):
 @app.get("/health")
 def health_check():
     """Health check endpoint that doesn't require authentication"""
-    return {"status": "healthy", "timestamp": time.time()}
+    health = {"status": "healthy", "timestamp": time.time(), "log_records_dropped": dropped_records()}
+    if image_cache:
+        health["image_cache"] = image_cache.stats()
+    health["sd_backends"] = sd_pool.state()
+    health["scheduler"] = scheduler.policy
+    if vector_index:
+        health["vector_collections"] = len(vector_index.collections)
+    return health
+
+@app.get("/metrics")
+async def metrics(token: str = Depends(verify_token)):
+    """Prometheus exposition of worker counters (Redis hashes metrics:{component}) and API state"""
+    lines = []
+    typed = set()
+
+    def sample(name, value, kind="counter"):
+        base = name.split("{")[0]
+        if base not in typed:
+            typed.add(base)
+            lines.append(f"# TYPE {base} {kind}")
+        lines.append(f"{name} {value}")
+
+    async for key in redis_client.scan_iter("metrics:*"):
+        component = key.split(":", 1)[1]
+        for field, value in sorted((await redis_client.hgetall(key)).items()):
+            sample(f"velesio_{component}_{field}", value)
+
+    sample("velesio_api_log_records_dropped_total", dropped_records())
+    if image_cache:
+        stats = image_cache.stats()
+        sample("velesio_api_image_cache_hits_total", stats["hits"])
+        sample("velesio_api_image_cache_misses_total", stats["misses"])
+        sample("velesio_api_image_cache_bytes", stats["bytes"], "gauge")
+    for queue in ("gpu_tasks", "sd_tasks"):
+        sample(f'velesio_api_queue_depth{{queue="{queue}"}}', await scheduler.depth(queue), "gauge")
+    sample(f'velesio_api_queue_depth{{queue="{low_queue("gpu_tasks")}"}}', await redis_client.llen(low_queue("gpu_tasks")), "gauge")
+    for backend in sd_pool.backends:
+        sample(f'velesio_api_sd_backend_healthy{{url="{backend.url}"}}', int(backend.healthy), "gauge")
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
 
 # A1111 WebUI API Proxy Endpoints for Unity compatibility
 @app.get("/sdapi/v1/sd-models")
 async def get_sd_models(token: str = Depends(verify_token)):
     """Proxy endpoint for A1111 WebUI sd-models API"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{A1111_URL}/sdapi/v1/sd-models", timeout=30.0)
-            response.raise_for_status()
-            return response.json()
+        response = await sd_pool.request("GET", "/sdapi/v1/sd-models", timeout=30.0)
+        return response.json()
     except Exception as e:
         logger.error(f"Error proxying sd-models request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error connecting to SD service: {str(e)}")
@@ -967,10 +1869,8 @@ async def get_sd_models(token: str = Depends(verify_token)):
 async def get_sd_models_alt(token: str = Depends(verify_token)):
     """Alternative proxy endpoint for A1111 WebUI sd-models API"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{A1111_URL}/sdapi/v1/sd-models", timeout=30.0)
-            response.raise_for_status()
-            return response.json()
+        response = await sd_pool.request("GET", "/sdapi/v1/sd-models", timeout=30.0)
+        return response.json()
     except Exception as e:
         logger.error(f"Error proxying sd-models request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error connecting to SD service: {str(e)}")
@@ -979,14 +1879,9 @@ async def get_sd_models_alt(token: str = Depends(verify_token)):
 async def txt2img_proxy(request: dict, token: str = Depends(verify_token)):
     """Proxy endpoint for A1111 WebUI txt2img API"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{A1111_URL}/sdapi/v1/txt2img", 
-                json=request,
-                timeout=300.0
-            )
-            response.raise_for_status()
-            return response.json()
+        pinned = (request.get("override_settings") or {}).get("sd_model_checkpoint")
+        response = await sd_pool.request("POST", "/sdapi/v1/txt2img", checkpoint=pinned, json=request, timeout=300.0)
+        return response.json()
     except Exception as e:
         logger.error(f"Error proxying txt2img request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error generating image: {str(e)}")
@@ -995,26 +1890,20 @@ async def txt2img_proxy(request: dict, token: str = Depends(verify_token)):
 async def get_options(token: str = Depends(verify_token)):
     """Proxy endpoint for A1111 WebUI options API"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{A1111_URL}/sdapi/v1/options", timeout=30.0)
-            response.raise_for_status()
-            return response.json()
+        response = await sd_pool.request("GET", "/sdapi/v1/options", timeout=30.0)
+        return response.json()
     except Exception as e:
         logger.error(f"Error proxying options request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error connecting to SD service: {str(e)}")
 
 @app.post("/sdapi/v1/options")
 async def set_options(request: dict, token: str = Depends(verify_token)):
-    """Proxy endpoint for A1111 WebUI options API"""
+    """Proxy endpoint for A1111 WebUI options API; applied to every image node"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{A1111_URL}/sdapi/v1/options",
-                json=request,
-                timeout=30.0
-            )
-            response.raise_for_status()
-            return response.json()
+        responses = await sd_pool.broadcast("POST", "/sdapi/v1/options", json=request, timeout=300.0)
+        if "sd_model_checkpoint" in request:
+            await sd_pool.check_all()  # routing and image cache keys must follow the new checkpoint
+        return responses[0].json()
     except Exception as e:
         logger.error(f"Error proxying options request: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error setting options: {str(e)}")
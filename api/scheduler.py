@@ -0,0 +1,127 @@
+"""Dispatch order of gpu_tasks: FIFO, or shortest expected job first.
+
+With SCHEDULER_POLICY=fifo (the default) tasks are LPUSHed to the `gpu_tasks`
+list and workers BRPOP it. With SCHEDULER_POLICY=sjf they are ZADDed to the
+`gpu_tasks:sjf` sorted set and workers BZPOPMIN it, so the task with the
+lowest score runs next:
+
+    score = enqueue time + estimated cost / SJF_AGING_RATE
+
+The cost estimate is in generated-token equivalents. It counts the expected
+output, which is n_predict / num_predict capped by the client's recent
+average output length for that endpoint, plus the prompt at PREFILL_WEIGHT per
+token. A 20-token bark therefore overtakes a queued story, but a task never waits
+more than cost / SJF_AGING_RATE seconds longer than it would under FIFO: that
+is the aging that keeps long jobs from starving.
+
+    scheduler:output_tokens   hash: "{client}:{endpoint}" -> moving average of generated tokens
+
+Low-priority tasks (batch lines, envelope "priority": "low") go to the
+`gpu_tasks:low` list under either policy. Workers only take them when nothing
+else waits, and preempt them when interactive work arrives (see
+gpu/scheduling.py).
+
+Set the same SCHEDULER_POLICY on the API and the GPU workers.
+"""
+import os
+import time
+import logging
+import orjson
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "fifo").lower()
+SJF_AGING_RATE = float(os.getenv("SJF_AGING_RATE", "50"))  # cost tokens worth one second of waiting
+SJF_DEFAULT_TOKENS = int(os.getenv("SJF_DEFAULT_TOKENS", "256"))  # expected output with no n_predict and no history
+SJF_QUEUES = ("gpu_tasks",)
+PREFILL_WEIGHT = 0.05  # a prompt token costs a small fraction of a generated one
+CHARS_PER_TOKEN = 4
+HISTORY_KEY = "scheduler:output_tokens"
+HISTORY_WEIGHT = 0.2  # weight of the newest observation in the moving average
+GENERATING = ("completion", "chat", "generate")
+
+def sjf_queue(queue):
+    return f"{queue}:sjf"
+
+def low_queue(queue):
+    return f"{queue}:low"
+
+def tokens_generated(data) -> int:
+    """Generated token count from a llama.cpp or Ollama result"""
+    if not isinstance(data, dict):
+        return 0
+    return int(data.get("tokens_predicted") or data.get("eval_count") or 0)
+
+def prompt_chars(endpoint, data) -> int:
+    if endpoint == "chat":
+        return sum(len(m.get("content") or "") for m in data.get("messages") or [])
+    if endpoint == "embed":
+        inputs = data.get("input") or ""
+        return len(inputs) if isinstance(inputs, str) else sum(len(text) for text in inputs)
+    prompt = data.get("prompt") or ""
+    return len(prompt) if isinstance(prompt, str) else len(prompt) * CHARS_PER_TOKEN
+
+def requested_tokens(endpoint, data) -> int:
+    if endpoint == "completion":
+        return data.get("n_predict") or -1
+    return (data.get("options") or {}).get("num_predict") or -1
+
+class Scheduler:
+    def __init__(self, redis_client, policy=SCHEDULER_POLICY):
+        self.redis = redis_client
+        self.policy = policy
+        self.watched = OrderedDict()  # task ID -> history field, until its result is observed
+
+    async def estimate(self, envelope, client) -> float:
+        """Expected cost of a task in generated-token equivalents"""
+        endpoint, data = envelope["endpoint"], envelope.get("data") or {}
+        prompt_cost = PREFILL_WEIGHT * prompt_chars(endpoint, data) / CHARS_PER_TOKEN
+        if endpoint not in GENERATING:
+            return 1 + prompt_cost
+        requested = requested_tokens(endpoint, data)
+        history = await self.redis.hget(HISTORY_KEY, f"{client}:{endpoint}")
+        if history is not None:
+            expected = float(history) if requested <= 0 else min(requested, float(history))
+        else:
+            expected = requested if requested > 0 else SJF_DEFAULT_TOKENS
+        return expected + prompt_cost
+
+    async def enqueue(self, queue, envelope, client="", pipe=None):
+        """Queue a task envelope; with `pipe`, the write is added to that pipeline instead"""
+        if queue in SJF_QUEUES and envelope.get("priority") == "low":
+            queue = low_queue(queue)
+        if self.policy != "sjf" or queue not in SJF_QUEUES:
+            if pipe is not None:
+                pipe.lpush(queue, orjson.dumps(envelope).decode())
+            else:
+                await self.redis.lpush(queue, orjson.dumps(envelope).decode())
+            return
+        cost = await self.estimate(envelope, client)
+        envelope["cost"] = round(cost, 1)
+        if envelope["endpoint"] in GENERATING:
+            self.watched[envelope["id"]] = f"{client}:{envelope['endpoint']}"
+            while len(self.watched) > 10000:
+                self.watched.popitem(last=False)
+        entry = {orjson.dumps(envelope).decode(): (envelope.get("timestamp") or time.time()) + cost / SJF_AGING_RATE}
+        if pipe is not None:
+            pipe.zadd(sjf_queue(queue), entry)
+        else:
+            await self.redis.zadd(sjf_queue(queue), entry)
+
+    async def observe(self, task_id, data):
+        """Fold a finished task's output length into its client's average"""
+        field = self.watched.pop(task_id, None)
+        tokens = tokens_generated(data)
+        if field is None or not tokens:
+            return
+        previous = await self.redis.hget(HISTORY_KEY, field)
+        average = tokens if previous is None else (1 - HISTORY_WEIGHT) * float(previous) + HISTORY_WEIGHT * tokens
+        await self.redis.hset(HISTORY_KEY, field, round(average, 1))
+
+    async def depth(self, queue) -> int:
+        """Interactive tasks waiting on a queue, under either policy"""
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.llen(queue)
+            pipe.zcard(sjf_queue(queue))
+            return sum(await pipe.execute())
@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+from grammars import repeat, schema_to_gbnf
+
+def parse(grammar):
+    """Rule name -> body, checking every referenced rule is defined"""
+    rules = dict(line.split(" ::= ", 1) for line in grammar.strip().splitlines())
+    for body in rules.values():
+        bare = re.sub(r'"(?:\\.|[^"\\])*"|\[(?:\\.|[^\]\\])*\]|\{[0-9,]*\}', " ", body)
+        for name in re.findall(r"[a-zA-Z][a-zA-Z0-9-]*", bare):
+            assert name in rules, f"undefined rule {name}"
+    return rules
+
+def test_ref_recursion_terminates():
+    schema = {
+        "$defs": {"node": {
+            "type": "object",
+            "properties": {"value": {"type": "integer"}, "children": {"type": "array", "items": {"$ref": "#/$defs/node"}}},
+            "required": ["value"],
+        }},
+        "$ref": "#/$defs/node",
+    }
+    rules = parse(schema_to_gbnf(schema))
+    assert rules["root"] == "ref-node"
+    assert rules["ref-node-children-item"] == "ref-node"
+
+def test_unresolvable_ref():
+    with pytest.raises(ValueError):
+        schema_to_gbnf({"$ref": "#/$defs/missing"})
+
+def test_optional_only_object_allows_any_ordered_subset():
+    rules = parse(schema_to_gbnf({"type": "object", "properties": {"a": {"type": "string"}, "b": {"type": "boolean"}}}))
+    assert rules["root"] == '"{" space (root-a-kv ("," space root-b-kv)? | root-b-kv)? "}" space'
+
+def test_required_properties_come_first():
+    schema = {"type": "object", "properties": {"a": {"type": "string"}, "b": {"type": "integer"}}, "required": ["b"]}
+    rules = parse(schema_to_gbnf(schema))
+    assert rules["root"] == '"{" space root-b-kv ("," space root-a-kv)? "}" space'
+
+@pytest.mark.parametrize("bounds, body", [
+    ({}, '(root-item ("," space root-item)*)?'),
+    ({"minItems": 1, "maxItems": 3}, 'root-item ("," space root-item){0,2}'),
+    ({"minItems": 2}, 'root-item ("," space root-item){1,}'),
+    ({"maxItems": 2}, '(root-item ("," space root-item){0,1})?'),
+    ({"maxItems": 0}, ""),
+])
+def test_item_counts(bounds, body):
+    rules = parse(schema_to_gbnf({"type": "array", "items": {"type": "integer"}, **bounds}))
+    assert rules["root"] == f'"[" space {body} "]" space'
+
+def test_repeat_rejects_inverted_bounds():
+    with pytest.raises(ValueError):
+        repeat("item", 3, 1)
+    with pytest.raises(ValueError):
+        schema_to_gbnf({"type": "array", "minItems": 2, "maxItems": 1})
+    with pytest.raises(ValueError):
+        schema_to_gbnf({"type": "string", "minLength": 5, "maxLength": 2})
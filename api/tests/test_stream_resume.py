@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+main = pytest.importorskip("main")
+
+def sse(text):
+    return f'data: {{"content":"{text}"}}\n\n'
+
+@pytest.fixture
+def trimmed_stream(monkeypatch):
+    """A finished stream of 6 entries of which the worker kept the last 2"""
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(main, "redis_client", client)
+
+    async def setup():
+        await client.rpush("stream:t1", *(sse(f"e{i}") for i in range(4, 6)))
+        await client.hset("stream:t1:meta", mapping={"owner": "o", "kind": "completion", "base": 4})
+        await client.set("result:t1", main.dumps({"data": {"streamed": True}}))
+
+    asyncio.run(setup())
+    return client
+
+def relay(**kwargs):
+    async def collect():
+        return "".join([chunk async for chunk in main.stream_completion_response("t1", **kwargs)])
+    return asyncio.run(collect())
+
+def test_resume_inside_window_keeps_event_ids(trimmed_stream):
+    body = relay(resume=(4, 0))
+    assert body == f"id: t1:5.0\n{sse('e5')}"
+
+def test_resume_past_trimmed_entry_is_an_error(trimmed_stream):
+    body = relay(resume=(1, 0))
+    assert "e4" not in body and "e5" not in body
+    assert '"error":"Stream position 1 is no longer available; entries from 4 on are kept"' in body
+
+def test_late_spectator_starts_at_oldest_kept_entry(trimmed_stream):
+    body = relay(from_oldest=True)
+    assert body == f"id: t1:4.0\n{sse('e4')}id: t1:5.0\n{sse('e5')}"
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+import vector_index
+from vector_index import VectorIndex
+
+def clustered(n, dim=16, clusters=8, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return centers[rng.integers(clusters, size=n)] + 0.1 * rng.normal(size=(n, dim))
+
+def fill(collection, vectors, start=0):
+    docs = [{"id": f"d{start + i}", "text": f"doc {start + i}", "metadata": None} for i in range(len(vectors))]
+    collection.add(docs, vectors)
+
+def ids(hits):
+    return [hit["id"] for hit in hits]
+
+@pytest.fixture
+def ivf_threshold(monkeypatch):
+    monkeypatch.setattr(vector_index, "VECTOR_IVF_MIN", 400)
+
+def test_brute_force_below_threshold(tmp_path):
+    collection = VectorIndex(str(tmp_path)).create("owner", "docs", "m")
+    vectors = clustered(200)
+    fill(collection, vectors)
+    assert collection.stats()["index"] == "flat"
+    scores = vector_index.normalize(vectors) @ vector_index.normalize(vectors[7])
+    assert ids(collection.search(vectors[7], 5)) == [f"d{row}" for row in np.argsort(-scores)[:5]]
+
+def test_ivf_matches_brute_force(tmp_path, ivf_threshold):
+    collection = VectorIndex(str(tmp_path)).create("owner", "docs", "m")
+    vectors = clustered(500)
+    fill(collection, vectors)
+    assert collection.stats()["index"] == "ivf"
+    nlist = len(collection.ivf["centroids"])
+    brute = vector_index.normalize(vectors) @ vector_index.normalize(vectors[0])
+    expected = [f"d{row}" for row in np.argsort(-brute)[:10]]
+    # Probing every list scores every row, so the result is exact
+    assert ids(collection.search(vectors[0], 10, probes=nlist)) == expected
+    # The default probes still find a stored vector itself
+    for row in (0, 123, 499):
+        assert collection.search(vectors[row], 1)[0]["id"] == f"d{row}"
+
+def test_ivf_searches_rows_added_after_build(tmp_path, ivf_threshold):
+    collection = VectorIndex(str(tmp_path)).create("owner", "docs", "m")
+    fill(collection, clustered(500))
+    late = np.full((1, 16), 50.0)
+    fill(collection, late, start=500)
+    assert collection.ivf["built_count"] == 500
+    assert collection.search(late[0], 1, probes=1)[0]["id"] == "d500"
+
+def test_reload_keeps_index_and_owner_scope(tmp_path, ivf_threshold):
+    vectors = clustered(500)
+    fill(VectorIndex(str(tmp_path)).create("owner", "docs", "m"), vectors)
+    index = VectorIndex(str(tmp_path))
+    assert index.get("other", "docs") is None
+    assert list(index.stats("owner")) == ["docs"]
+    reloaded = index.get("owner", "docs")
+    assert reloaded.stats()["index"] == "ivf"
+    assert reloaded.search(vectors[42], 1)[0]["id"] == "d42"
+
+def test_dimension_mismatch(tmp_path):
+    collection = VectorIndex(str(tmp_path)).create("owner", "docs", "m")
+    fill(collection, clustered(10))
+    with pytest.raises(ValueError):
+        collection.search(np.ones(8), 1)
+
+def test_failed_add_rolls_back_both_files(tmp_path):
+    index = VectorIndex(str(tmp_path))
+    collection = index.create("owner", "docs", "m")
+    vectors = clustered(20)
+    fill(collection, vectors[:10])
+    sizes = [(tmp_path / "owner" / "docs" / name).stat().st_size for name in ("vectors.f32", "docs.jsonl")]
+    with pytest.raises(KeyError):
+        # The vectors are written before the second document turns out to have no ID
+        collection.add([{"id": "d10", "text": "ok"}, {"text": "no id"}], vectors[10:12])
+    assert [(tmp_path / "owner" / "docs" / name).stat().st_size for name in ("vectors.f32", "docs.jsonl")] == sizes
+    assert "d10" not in collection.ids
+    fill(collection, vectors[10:], start=10)
+    assert collection.search(vectors[15], 1)[0]["id"] == "d15"
+    assert VectorIndex(str(tmp_path)).get("owner", "docs").stats()["count"] == 20
+
+def test_load_repairs_rows_out_of_step(tmp_path):
+    fill(VectorIndex(str(tmp_path)).create("owner", "docs", "m"), clustered(10))
+    directory = tmp_path / "owner" / "docs"
+    with open(directory / "vectors.f32", "ab") as f:
+        f.write(np.ones((2, 16), dtype="<f4").tobytes())  # a crash after the vectors were written
+    with open(directory / "docs.jsonl", "ab") as f:
+        f.write(b'{"id": "d10", "te')  # and part of the first document
+    collection = VectorIndex(str(tmp_path)).get("owner", "docs")
+    assert collection.stats()["count"] == 10
+    assert (directory / "vectors.f32").stat().st_size == 10 * 16 * 4
+    assert "d10" not in collection.ids
+    fill(collection, clustered(1, seed=1), start=10)
+    assert collection.document(10)["id"] == "d10"
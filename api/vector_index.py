@@ -0,0 +1,267 @@
+"""Named vector collections with top-k search, persisted on disk.
+
+Collections are private to the client that created them. Each one is a
+directory VECTOR_INDEX_DIR/{owner}/{name}, where owner is the API's hash of the
+client's token:
+
+    meta.json      model, dimensions, count
+    vectors.f32    unit-length float32 rows, appended; read through np.memmap
+    docs.jsonl     one {"id", "text", "metadata"} line per row, in the same order
+    ivf.npz        optional inverted-file index: k-means centroids and row assignments
+
+Row N of vectors.f32 belongs to line N of docs.jsonl. An add that fails midway
+truncates both files back, and loading cuts them to the rows they both hold,
+so a crash cannot pair vectors with the wrong documents.
+
+Vectors are normalized when added, so the dot product is the cosine similarity.
+Small collections are searched brute force with one matrix-vector product. Once
+a collection reaches VECTOR_IVF_MIN rows, an IVF index is (re)built whenever it
+has doubled. A search then scores only the rows of the VECTOR_IVF_PROBES nearest
+centroids, plus rows added since the last build.
+"""
+import os
+import re
+import json
+import time
+import shutil
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VECTOR_IVF_MIN = int(os.getenv("VECTOR_IVF_MIN", "50000"))
+VECTOR_IVF_PROBES = int(os.getenv("VECTOR_IVF_PROBES", "8"))
+IVF_TRAIN_SAMPLE = 50000
+IVF_ITERATIONS = 10
+
+COLLECTION_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best])]
+
+def train_ivf(vectors, nlist):
+    """Spherical k-means on a sample; returns (centroids, assignment of every row)"""
+    rng = np.random.default_rng(0)
+    sample = vectors[rng.choice(len(vectors), min(len(vectors), IVF_TRAIN_SAMPLE), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(IVF_ITERATIONS):
+        nearest = np.argmax(sample @ centroids.T, axis=1)
+        for cluster in range(nlist):
+            members = sample[nearest == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    assignment = np.concatenate([
+        np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+        for start in range(0, len(vectors), 65536)
+    ]).astype(np.int32)
+    return centroids, assignment
+
+class Collection:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        with open(self._path("meta.json")) as f:
+            self.meta = json.load(f)
+        self.offsets = []  # byte offset of each line in docs.jsonl
+        ids = []
+        with open(self._path("docs.jsonl"), "rb") as f:
+            offset = 0
+            for line in f:
+                try:
+                    doc_id = json.loads(line)["id"] if line.endswith(b"\n") else None
+                except (ValueError, KeyError, TypeError):
+                    doc_id = None
+                if doc_id is None:
+                    break  # torn write; _repair drops it
+                self.offsets.append(offset)
+                ids.append(doc_id)
+                offset += len(line)
+        self._repair(offset)
+        self.ids = set(ids[:len(self.offsets)])
+        self.vectors = None
+        self.ivf = None
+        self._map()
+        if os.path.exists(self._path("ivf.npz")):
+            with np.load(self._path("ivf.npz")) as ivf:
+                self.ivf = self._ivf_lists(ivf["centroids"], ivf["assignment"])
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _repair(self, docs_size):
+        """Cut vectors.f32 and docs.jsonl to the rows both hold, e.g. after a crash mid-add"""
+        row_bytes = 4 * self.meta["dimensions"]
+        vector_rows = os.path.getsize(self._path("vectors.f32")) // row_bytes if row_bytes else 0
+        rows = min(len(self.offsets), vector_rows)
+        if rows == len(self.offsets) == vector_rows == self.meta["count"] \
+                and docs_size == os.path.getsize(self._path("docs.jsonl")) \
+                and rows * row_bytes == os.path.getsize(self._path("vectors.f32")):
+            return
+        logger.warning(f"Repairing {self.directory}: {len(self.offsets)} documents, {vector_rows} vectors; keeping {rows}")
+        os.truncate(self._path("docs.jsonl"), self.offsets[rows] if rows < len(self.offsets) else docs_size)
+        os.truncate(self._path("vectors.f32"), rows * row_bytes)
+        del self.offsets[rows:]
+        self.meta["count"] = rows
+        self._write_meta()
+
+    def _map(self):
+        """(Re)open the vectors read-only; the page cache keeps hot collections in memory"""
+        count, dim = len(self.offsets), self.meta["dimensions"]
+        self.vectors = np.memmap(self._path("vectors.f32"), dtype=np.float32, mode="r", shape=(count, dim)) if count else np.empty((0, dim or 0), dtype=np.float32)
+
+    @staticmethod
+    def _ivf_lists(centroids, assignment):
+        order = np.argsort(assignment, kind="stable")
+        bounds = np.searchsorted(assignment[order], np.arange(len(centroids) + 1))
+        return {"centroids": centroids, "order": order, "bounds": bounds, "built_count": len(assignment)}
+
+    def add(self, documents, vectors):
+        """Append documents with their embeddings; blocking, run in a thread"""
+        vectors = normalize(vectors)
+        with self.lock:
+            dimensions = self.meta["dimensions"]
+            if dimensions and vectors.shape[1] != dimensions:
+                raise ValueError(f"Collection holds {dimensions}-dim vectors, got {vectors.shape[1]}")
+            # Both files must grow by the same rows or not at all; a row count out of step
+            # would pair every later vector with the wrong document
+            sizes = {name: os.path.getsize(self._path(name)) for name in ("vectors.f32", "docs.jsonl")}
+            count, added = len(self.offsets), []
+            try:
+                self.meta["dimensions"] = int(vectors.shape[1])
+                with open(self._path("vectors.f32"), "ab") as f:
+                    f.write(vectors.astype("<f4").tobytes())
+                with open(self._path("docs.jsonl"), "ab") as f:
+                    offset = f.tell()
+                    for doc in documents:
+                        line = (json.dumps(doc, ensure_ascii=False) + "\n").encode()
+                        f.write(line)
+                        self.offsets.append(offset)
+                        if doc["id"] not in self.ids:
+                            self.ids.add(doc["id"])
+                            added.append(doc["id"])
+                        offset += len(line)
+                self.meta["count"] = len(self.offsets)
+                self._write_meta()
+                self._map()
+            except BaseException:
+                for name, size in sizes.items():
+                    os.truncate(self._path(name), size)
+                del self.offsets[count:]
+                self.ids.difference_update(added)
+                self.meta.update(dimensions=dimensions, count=count)
+                raise
+            if self.meta["count"] >= VECTOR_IVF_MIN and (self.ivf is None or self.meta["count"] >= 2 * self.ivf["built_count"]):
+                self._build_ivf()
+
+    def _build_ivf(self):
+        started = time.time()
+        nlist = max(1, int(np.sqrt(len(self.vectors))))
+        centroids, assignment = train_ivf(np.asarray(self.vectors), nlist)
+        tmp_path = self._path("ivf.tmp.npz")
+        np.savez(tmp_path, centroids=centroids, assignment=assignment)
+        os.replace(tmp_path, self._path("ivf.npz"))
+        self.ivf = self._ivf_lists(centroids, assignment)
+        logger.info(f"Built IVF index for {self.directory}: {nlist} lists over {len(assignment)} vectors in {time.time() - started:.1f}s")
+
+    def _write_meta(self):
+        tmp_path = self._path("meta.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._path("meta.json"))
+
+    def document(self, row):
+        with open(self._path("docs.jsonl"), "rb") as f:
+            f.seek(self.offsets[row])
+            return json.loads(f.readline())
+
+    def search(self, query, k, probes=None):
+        """Top-k documents by cosine similarity, as [{"id", "score", "text", "metadata"}]"""
+        with self.lock:
+            vectors, ivf = self.vectors, self.ivf
+        if not len(vectors):
+            return []
+        query = normalize(query)
+        if query.shape[-1] != vectors.shape[1]:
+            raise ValueError(f"Collection holds {vectors.shape[1]}-dim vectors, got {query.shape[-1]}")
+        if ivf is None:
+            scores = vectors @ query
+            rows = top_k(scores, k)
+            hits = zip(rows, scores[rows])
+        else:
+            nearest = top_k(ivf["centroids"] @ query, probes or VECTOR_IVF_PROBES)
+            candidates = np.sort(np.concatenate(
+                [ivf["order"][ivf["bounds"][c]:ivf["bounds"][c + 1]] for c in nearest]
+                + [np.arange(ivf["built_count"], len(vectors))]  # added since the last build
+            ))
+            scores = vectors[candidates] @ query
+            best = top_k(scores, k)
+            hits = zip(candidates[best], scores[best])
+        results = []
+        for row, score in hits:
+            doc = self.document(int(row))
+            results.append({"id": doc["id"], "score": float(score), "text": doc.get("text"), "metadata": doc.get("metadata")})
+        return results
+
+    def stats(self):
+        return {
+            "model": self.meta.get("model"),
+            "dimensions": self.meta["dimensions"],
+            "count": self.meta["count"],
+            "index": "ivf" if self.ivf else "flat",
+        }
+
+class VectorIndex:
+    """Named collections per owner under one directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.collections = {}  # (owner, name) -> Collection
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for owner in sorted(os.listdir(directory)):
+            if not os.path.isdir(os.path.join(directory, owner)):
+                continue
+            for name in sorted(os.listdir(os.path.join(directory, owner))):
+                if os.path.exists(os.path.join(directory, owner, name, "meta.json")):
+                    self.collections[(owner, name)] = Collection(os.path.join(directory, owner, name))
+        logger.info(f"Vector index at {directory}: {len(self.collections)} collections")
+
+    def get(self, owner, name):
+        return self.collections.get((owner, name))
+
+    def create(self, owner, name, model):
+        """Existing collection of `owner`, or a new empty one embedding with `model`"""
+        if not COLLECTION_NAME.match(name) or not COLLECTION_NAME.match(owner):
+            raise ValueError("Collection names are 1-64 letters, digits, '-' or '_'")
+        with self.lock:
+            if (owner, name) not in self.collections:
+                directory = os.path.join(self.directory, owner, name)
+                os.makedirs(directory, exist_ok=True)
+                for filename in ("vectors.f32", "docs.jsonl"):
+                    open(os.path.join(directory, filename), "ab").close()
+                with open(os.path.join(directory, "meta.json"), "w") as f:
+                    json.dump({"model": model, "dimensions": 0, "count": 0}, f)
+                self.collections[(owner, name)] = Collection(directory)
+            return self.collections[(owner, name)]
+
+    def drop(self, owner, name):
+        with self.lock:
+            collection = self.collections.pop((owner, name), None)
+        if collection:
+            shutil.rmtree(collection.directory, ignore_errors=True)
+        return collection is not None
+
+    def stats(self, owner):
+        return {name: collection.stats() for (key_owner, name), collection in self.collections.items() if key_owner == owner}
@@ -0,0 +1,236 @@
+"""
+Load generator for the API gateway.
+
+Drives `api/main.py` with a seeded, reproducible mix of streaming and
+non-streaming completions, metadata calls and image generations, then writes
+a JSON report (see `report.py`) with TTFT, inter-token latency, throughput
+and Redis commands per request.
+
+    python bench/loadgen.py --url http://localhost:8000 --token secure_token \\
+        --mix stream_completion=5,completion=2,metadata=2,image=1 \\
+        --requests 500 --concurrency 16 --seed 42 \\
+        --redis-url redis://:secure_redis_pass@localhost:6379 \\
+        --out bench/results/$(git rev-parse --short HEAD).json
+"""
+import argparse, asyncio, json, os, random, time
+import httpx
+from report import summarize, print_report
+
+# Request kinds and how their responses are framed
+STREAMING = {"stream_completion": "sse", "chat": "ndjson", "generate": "ndjson"}
+
+PROMPT_WORDS = (
+    "you are a grumpy innkeeper in a frontier town the player asks about rumours "
+    "of bandits on the east road describe the weather the price of ale and the "
+    "strange lights seen above the abandoned watchtower last night"
+).split()
+
+def make_prompt(rng, long_prompt):
+    """Chat-formatted prompt; most are short NPC barks, some carry long history"""
+    words = rng.randint(300, 900) if long_prompt else rng.randint(15, 60)
+    body = " ".join(rng.choice(PROMPT_WORDS) for _ in range(words))
+    return f"<|im_start|>system\nStay in character.<|im_end|>\n<|im_start|>user\n{body}<|im_end|>\n<|im_start|>assistant\n"
+
+def build_request(kind, rng, args):
+    """(method, path, json body) for one request of the given kind"""
+    long_prompt = rng.random() < args.long_fraction
+    n_predict = rng.choice([256, 512]) if long_prompt else rng.choice([16, 32, 64])
+    if kind in ("stream_completion", "completion"):
+        return "POST", "/completion", {
+            "prompt": make_prompt(rng, long_prompt),
+            "n_predict": n_predict,
+            "stream": kind == "stream_completion",
+            "seed": rng.randrange(2**31),
+        }
+    if kind in ("chat", "generate"):
+        text = make_prompt(rng, long_prompt)
+        body = {"model": args.model, "stream": True, "options": {"num_predict": n_predict, "seed": rng.randrange(2**31)}}
+        if kind == "chat":
+            body["messages"] = [{"role": "user", "content": text}]
+        else:
+            body["prompt"] = text
+        return "POST", f"/{kind}", body
+    if kind == "metadata":
+        choice = rng.choice(["props", "template", "tokenize"])
+        if choice == "tokenize":
+            return "POST", "/tokenize", {"content": make_prompt(rng, False)}
+        return "GET", f"/{choice}", None
+    if kind == "embed":
+        return "POST", "/embed", {"model": args.model, "input": [make_prompt(rng, False) for _ in range(rng.randint(1, 8))]}
+    if kind == "image":
+        size = rng.choice([256, 512])
+        body = {
+            "prompt": " ".join(rng.choice(PROMPT_WORDS) for _ in range(12)),
+            "steps": args.image_steps,
+            "width": size,
+            "height": size,
+            "seed": rng.choice([-1, rng.randrange(1000)]),
+        }
+        if args.checkpoints:
+            body["override_settings"] = {"sd_model_checkpoint": rng.choice(args.checkpoints.split(","))}
+        return "POST", "/generate-image", body
+    raise ValueError(f"Unknown request kind: {kind}")
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def build_schedule(args):
+    """Deterministic list of (arrival offset, kind, method, path, body)"""
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    schedule, clock = [], 0.0
+    for _ in range(args.requests):
+        kind = rng.choices(kinds, weights)[0]
+        if args.rate:
+            clock += rng.expovariate(args.rate)
+        method, path, body = build_request(kind, rng, args)
+        label = kind
+        if args.by_size and body and kind not in ("metadata", "embed", "image"):
+            n_predict = body.get("n_predict") or body.get("options", {}).get("num_predict", 0)
+            label = f"{kind}/{'long' if n_predict >= 256 else 'short'}"
+        schedule.append((clock, label, method, path, body))
+    return schedule
+
+def stream_events(line_iter, framing):
+    """Content-bearing events of an SSE or NDJSON stream"""
+    async def events():
+        async for line in line_iter:
+            if not line:
+                continue
+            if framing == "sse":
+                if not line.startswith("data: "):
+                    continue
+                line = line[6:]
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield event
+    return events()
+
+def event_text(event):
+    if "message" in event:
+        return event["message"].get("content", "")
+    return event.get("content") or event.get("response") or ""
+
+async def measure(client, kind, method, path, body, headers=None):
+    """Issue one request and time it; streaming responses are timed per token"""
+    sample = {"kind": kind, "path": path}
+    kind = kind.split("/")[0]  # --by-size labels
+    framing = STREAMING.get(kind) if body is None or body.get("stream", kind in STREAMING) else None
+    started = time.perf_counter()
+    try:
+        if framing:
+            last, gaps, tokens, size = None, [], 0, 0
+            async with client.stream(method, path, json=body, headers=headers) as response:
+                response.raise_for_status()
+                async for event in stream_events(response.aiter_lines(), framing):
+                    if event.get("error"):
+                        raise RuntimeError(event["error"])
+                    if not event_text(event):
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        sample["ttft"] = now - started
+                    else:
+                        gaps.append(now - last)
+                    last = now
+                    tokens += 1
+                    size += len(event_text(event))
+            sample.update(itl=gaps, tokens=tokens, bytes=size)
+        else:
+            response = await client.request(method, path, json=body, headers=headers)
+            response.raise_for_status()
+            sample["bytes"] = len(response.content)
+            if kind == "completion":
+                sample["tokens"] = len(response.json().get("content", "").split())
+    except Exception as e:
+        sample["error"] = f"{type(e).__name__}: {e}"
+    sample["latency"] = time.perf_counter() - started
+    return sample
+
+def redis_command_counts(redis_url):
+    """Cumulative per-command call counts from INFO commandstats"""
+    import redis
+    conn = redis.Redis.from_url(redis_url)
+    stats = conn.info("commandstats")
+    conn.close()
+    return {name.replace("cmdstat_", ""): data["calls"] for name, data in stats.items()}
+
+def diff_counts(before, after):
+    ops = {cmd: after.get(cmd, 0) - before.get(cmd, 0) for cmd in after}
+    # Our own INFO calls are not part of the workload
+    ops.pop("info", None)
+    return {cmd: n for cmd, n in ops.items() if n > 0}
+
+async def run(schedule, args, measure_fn=measure):
+    """Execute a schedule; open-loop when arrival offsets are set, else closed-loop"""
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    headers = {"Authorization": f"Bearer {args.token}"}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    samples = []
+
+    async with httpx.AsyncClient(base_url=args.url, headers=headers, limits=limits, timeout=args.timeout) as client:
+        started = time.perf_counter()
+
+        async def one(offset, kind, method, path, body):
+            delay = offset - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            async with semaphore:
+                samples.append(await measure_fn(client, kind, method, path, body))
+
+        await asyncio.gather(*(one(*item) for item in schedule))
+        wall = time.perf_counter() - started
+    return samples, wall
+
+def add_common_args(parser):
+    parser.add_argument("--url", default="http://localhost:8000", help="gateway base URL")
+    parser.add_argument("--token", default=os.getenv("BENCH_TOKEN", ""), help="API bearer token")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--redis-url", help="count Redis commands per request via INFO commandstats")
+    parser.add_argument("--label", default="", help="free-form tag stored in the report")
+    parser.add_argument("--out", help="write the JSON report here")
+
+def finish(samples, wall, args, redis_before, meta):
+    redis_ops = diff_counts(redis_before, redis_command_counts(args.redis_url)) if args.redis_url else None
+    report = summarize(samples, wall, redis_ops=redis_ops, meta={"label": args.label, **meta})
+    print_report(report)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API gateway")
+    add_common_args(parser)
+    parser.add_argument("--mix", default="stream_completion=5,completion=2,metadata=2,image=1",
+                        help="comma-separated kind=weight; kinds: stream_completion, completion, chat, generate, metadata, embed, image")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=0, help="open-loop Poisson arrivals per second (0 = closed loop)")
+    parser.add_argument("--long-fraction", type=float, default=0.1, help="share of requests with long prompts and outputs")
+    parser.add_argument("--image-steps", type=int, default=10)
+    parser.add_argument("--checkpoints", default="", help="comma-separated checkpoints pinned at random by image requests")
+    parser.add_argument("--model", default="mock", help="model name for Ollama-style requests")
+    parser.add_argument("--by-size", action="store_true", help="report short and long generations separately, e.g. stream_completion/long")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    schedule = build_schedule(args)
+    redis_before = redis_command_counts(args.redis_url) if args.redis_url else {}
+    samples, wall = asyncio.run(run(schedule, args))
+    finish(samples, wall, args, redis_before, {
+        "mix": args.mix, "requests": args.requests, "rate": args.rate,
+        "concurrency": args.concurrency, "seed": args.seed, "long_fraction": args.long_fraction,
+        "by_size": args.by_size,
+    })
+
+if __name__ == "__main__":
+    main()
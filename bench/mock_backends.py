@@ -0,0 +1,296 @@
+"""
+Local stand-ins for the inference backends used by the GPU workers.
+
+Each mock speaks just enough of the real wire protocol for `gpu/llm.py`,
+`gpu/ollama_llm.py` and `gpu/sd.py` to run unmodified against it:
+
+    python bench/mock_backends.py llama  --port 1337  --tps 80
+    python bench/mock_backends.py ollama --port 11434 --tps 80
+    python bench/mock_backends.py a1111  --port 7860  --image-seconds 2
+
+Generated text, embeddings and images are derived from a seeded RNG, so the
+same request always produces the same output and timings only depend on the
+configured rates.
+"""
+import argparse, asyncio, base64, hashlib, json, os, random, struct, time, zlib
+from datetime import datetime, timezone
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+WORDS = (
+    "the old blacksmith lifts his hammer and tells of dragons beyond the northern "
+    "pass where travellers vanish into mist and only ravens return with silver rings "
+    "so beware the road at dusk traveller for the forest remembers every name"
+).split()
+
+class MockConfig:
+    tokens_per_sec = 80.0
+    ttft_ms = 50.0
+    default_tokens = 128
+    embed_dim = 1024
+    image_seconds = 2.0
+    swap_seconds = 0.0
+    seed = 0
+
+config = MockConfig()
+
+def get_iso_timestamp():
+    """Generate ISO 8601 timestamp in Ollama format"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def compact(obj):
+    """JSON the way Ollama (Go) and llama-server write it"""
+    return json.dumps(obj, separators=(",", ":"))
+
+def request_rng(*parts):
+    """RNG seeded from the request content so outputs are reproducible"""
+    digest = hashlib.sha256(json.dumps([config.seed, *parts], sort_keys=True, default=str).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "little"))
+
+def generate_tokens(prompt, n_predict, seed=0):
+    """Deterministic token sequence for a prompt"""
+    rng = request_rng(prompt, seed)
+    count = n_predict if n_predict and n_predict > 0 else config.default_tokens
+    return [(" " if i else "") + rng.choice(WORDS) for i in range(count)]
+
+async def paced(tokens):
+    """Yield tokens at the configured rate after the time-to-first-token delay"""
+    await asyncio.sleep(config.ttft_ms / 1000)
+    interval = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0
+    for i, token in enumerate(tokens):
+        if i and interval:
+            await asyncio.sleep(interval)
+        yield i, token
+
+def fake_tokenize(text):
+    """Whitespace tokenizer standing in for the model vocabulary"""
+    return [int(hashlib.md5(w.encode()).hexdigest()[:6], 16) for w in text.split()]
+
+def fake_embedding(text):
+    """Unit-norm deterministic embedding for a piece of text"""
+    rng = request_rng("embed", text)
+    vec = [rng.gauss(0.0, 1.0) for _ in range(config.embed_dim)]
+    norm = sum(v * v for v in vec) ** 0.5 or 1.0
+    return [v / norm for v in vec]
+
+def solid_png(width, height, seed):
+    """Encode a solid-colour RGB PNG without needing PIL"""
+    rng = random.Random(seed)
+    pixel = bytes(rng.randrange(256) for _ in range(3))
+    raw = b"".join(b"\x00" + pixel * width for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+def build_llama_app():
+    """llama-server stand-in: /completion (SSE), /v1/embeddings, /props, /tokenize, /health"""
+    app = FastAPI(title="mock llama-server")
+
+    @app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @app.get("/props")
+    async def props():
+        return {
+            "default_generation_settings": {"n_ctx": 4096},
+            "total_slots": 1,
+            "chat_template": "{% for message in messages %}<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n{% endfor %}{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}",
+        }
+
+    @app.post("/api/show")
+    async def show():
+        return {"template": "chatml"}
+
+    @app.post("/tokenize")
+    async def tokenize(request: Request):
+        body = await request.json()
+        return {"tokens": fake_tokenize(body.get("content", ""))}
+
+    @app.post("/completion")
+    async def completion(request: Request):
+        body = await request.json()
+        prompt = body.get("prompt", "")
+        if isinstance(prompt, list):  # token IDs
+            n_prompt, prompt = len(prompt), " ".join(map(str, prompt))
+        else:
+            n_prompt = len(fake_tokenize(prompt))
+        tokens = generate_tokens(prompt, body.get("n_predict", -1), body.get("seed", 0))
+
+        if not body.get("stream", False):
+            async for _ in paced(tokens):
+                pass
+            return {"content": "".join(tokens), "stop": True, "tokens_predicted": len(tokens), "tokens_evaluated": n_prompt}
+
+        async def sse():
+            async for i, token in paced(tokens):
+                yield f"data: {compact({'content': token, 'stop': False})}\n\n"
+            final = {"content": "", "stop": True, "tokens_predicted": len(tokens), "tokens_evaluated": n_prompt}
+            yield f"data: {compact(final)}\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body.get("input", "")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text)} for i, text in enumerate(inputs)],
+            "usage": {"prompt_tokens": sum(len(fake_tokenize(text)) for text in inputs)},
+        }
+
+    return app
+
+def build_ollama_app():
+    """Ollama stand-in: /api/chat, /api/generate (NDJSON), /api/embed, /api/tags"""
+    app = FastAPI(title="mock ollama")
+
+    def final_stats(prompt, tokens, started):
+        return {
+            "total_duration": int((time.time() - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": len(fake_tokenize(prompt)),
+            "prompt_eval_duration": int(config.ttft_ms * 1e6),
+            "eval_count": len(tokens),
+            "eval_duration": int(len(tokens) / max(config.tokens_per_sec, 1e-9) * 1e9),
+        }
+
+    async def respond(body, prompt, frame):
+        options = body.get("options") or {}
+        tokens = generate_tokens(prompt, options.get("num_predict", -1), options.get("seed", 0))
+        model = body.get("model", "mock")
+        started = time.time()
+
+        if not body.get("stream", True):
+            async for _ in paced(tokens):
+                pass
+            return JSONResponse({"model": model, "created_at": get_iso_timestamp(), **frame("".join(tokens)), "done": True, **final_stats(prompt, tokens, started)})
+
+        async def ndjson():
+            async for _, token in paced(tokens):
+                yield compact({"model": model, "created_at": get_iso_timestamp(), **frame(token), "done": False}) + "\n"
+            yield compact({"model": model, "created_at": get_iso_timestamp(), **frame(""), "done": True, **final_stats(prompt, tokens, started)}) + "\n"
+
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": "mock:latest", "model": "mock:latest", "size": 0}]}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        return await respond(body, body.get("prompt", ""), lambda text: {"response": text})
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        prompt = "\n".join(m.get("content", "") for m in body.get("messages", []))
+        return await respond(body, prompt, lambda text: {"message": {"role": "assistant", "content": text}})
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        inputs = body.get("input", "")
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        return {
+            "model": body.get("model", "mock"),
+            "embeddings": [fake_embedding(text) for text in inputs],
+            "prompt_eval_count": sum(len(fake_tokenize(text)) for text in inputs),
+        }
+
+    return app
+
+def build_a1111_app():
+    """Automatic1111 stand-in: /sdapi/v1/txt2img, /sdapi/v1/options, /sdapi/v1/sd-models"""
+    app = FastAPI(title="mock a1111")
+    options = {"sd_model_checkpoint": "mock-model.safetensors"}
+
+    @app.get("/docs")
+    async def docs():
+        return {"status": "ok"}
+
+    @app.get("/sdapi/v1/sd-models")
+    async def sd_models():
+        return [{"title": "mock-model.safetensors", "model_name": "mock-model"}]
+
+    @app.get("/sdapi/v1/options")
+    async def get_options():
+        return options
+
+    async def load_checkpoint(checkpoint):
+        """Loading different weights costs swap_seconds, like a real checkpoint swap"""
+        if checkpoint and checkpoint != options["sd_model_checkpoint"]:
+            await asyncio.sleep(config.swap_seconds)
+            options["sd_model_checkpoint"] = checkpoint
+
+    @app.post("/sdapi/v1/options")
+    async def set_options(request: Request):
+        body = await request.json()
+        await load_checkpoint(body.pop("sd_model_checkpoint", None))
+        options.update(body)
+        return None
+
+    @app.post("/sdapi/v1/txt2img")
+    async def txt2img(request: Request):
+        body = await request.json()
+        width, height = int(body.get("width", 512)), int(body.get("height", 512))
+        steps = int(body.get("steps", 20))
+        count = int(body.get("batch_size", 1)) * int(body.get("n_iter", 1))
+        seed = int(body.get("seed", -1))
+        overrides = body.get("override_settings") or {}
+        previous = options["sd_model_checkpoint"]
+        await load_checkpoint(overrides.get("sd_model_checkpoint"))
+        if seed == -1:
+            seed = request_rng(body.get("prompt", ""), time.time_ns()).randrange(2**32)
+
+        # Batches amortise most of the per-call cost, like the real backend
+        scale = (steps / 20) * (1 + 0.25 * (count - 1))
+        await asyncio.sleep(config.image_seconds * scale)
+
+        images = [base64.b64encode(solid_png(width, height, seed + i)).decode() for i in range(count)]
+        info = {"seed": seed, "all_seeds": [seed + i for i in range(count)], "sd_model_checkpoint": options["sd_model_checkpoint"],
+                "sd_model_name": os.path.splitext(options["sd_model_checkpoint"].split(" [")[0])[0]}
+        if body.get("override_settings_restore_afterwards", True):
+            await load_checkpoint(previous)
+        return {"images": images, "parameters": body, "info": json.dumps(info)}
+
+    return app
+
+BUILDERS = {"llama": build_llama_app, "ollama": build_ollama_app, "a1111": build_a1111_app}
+DEFAULT_PORTS = {"llama": 1337, "ollama": 11434, "a1111": 7860}
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a mock inference backend")
+    parser.add_argument("kind", choices=sorted(BUILDERS))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--tps", type=float, default=config.tokens_per_sec, help="generated tokens per second per stream")
+    parser.add_argument("--ttft-ms", type=float, default=config.ttft_ms, help="delay before the first token")
+    parser.add_argument("--default-tokens", type=int, default=config.default_tokens, help="tokens generated when n_predict is -1")
+    parser.add_argument("--embed-dim", type=int, default=config.embed_dim)
+    parser.add_argument("--image-seconds", type=float, default=config.image_seconds, help="seconds per 20-step image")
+    parser.add_argument("--swap-seconds", type=float, default=config.swap_seconds, help="cost of loading a different checkpoint")
+    parser.add_argument("--seed", type=int, default=config.seed)
+    args = parser.parse_args()
+
+    config.tokens_per_sec = args.tps
+    config.ttft_ms = args.ttft_ms
+    config.default_tokens = args.default_tokens
+    config.embed_dim = args.embed_dim
+    config.image_seconds = args.image_seconds
+    config.swap_seconds = args.swap_seconds
+    config.seed = args.seed
+
+    uvicorn.run(BUILDERS[args.kind](), host=args.host, port=args.port or DEFAULT_PORTS[args.kind], log_level="warning")
+
+if __name__ == "__main__":
+    main()
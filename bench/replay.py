@@ -0,0 +1,89 @@
+"""
+Deterministic replay of traffic captured by the gateway.
+
+Enable capture on the API with `TRAFFIC_CAPTURE_DIR=/data/capture`, copy the
+`capture-*.jsonl.gz` files somewhere local, then re-issue them against any
+gateway (backed by the mocks or real GPUs) at the recorded pace:
+
+    python bench/replay.py /data/capture --url http://localhost:8000 --token bench --speed 1
+    python bench/replay.py /data/capture --speed 10     # 10x faster than recorded
+    python bench/replay.py /data/capture --speed max    # as fast as concurrency allows
+
+The report has the same shape as `loadgen.py`, so `report.py` can compare a
+replay before and after a scheduler or cache change.
+"""
+import argparse, asyncio, glob, gzip, json, os, zlib
+from loadgen import add_common_args, finish, redis_command_counts, run
+
+def read_capture(paths):
+    """Envelopes from capture files, tolerating a truncated tail from a crash"""
+    envelopes = []
+    for path in paths:
+        try:
+            with gzip.open(path, "rt") as f:
+                for line in f:
+                    try:
+                        envelopes.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        break
+        except (EOFError, OSError, zlib.error):
+            pass
+    return sorted(envelopes, key=lambda e: e["t"])
+
+def capture_files(sources):
+    paths = []
+    for source in sources:
+        if os.path.isdir(source):
+            paths.extend(sorted(glob.glob(os.path.join(source, "capture-*.jsonl.gz"))))
+        else:
+            paths.append(source)
+    return paths
+
+def request_kind(envelope):
+    """Map a captured request to the loadgen kind used for timing and reporting"""
+    path = envelope["path"].rstrip("/") or "/"
+    body = envelope.get("body") or {}
+    if path == "/completion":
+        return "stream_completion" if body.get("stream", True) else "completion"
+    if path in ("/chat", "/generate") and not body.get("stream", False):
+        return path.strip("/") + "_sync"
+    return path.strip("/") or "root"
+
+def build_schedule(envelopes, speed, include_failed):
+    """Arrival offsets scaled by the replay speed (0 = no pacing)"""
+    if not envelopes:
+        return []
+    t0 = envelopes[0]["t"]
+    schedule = []
+    for envelope in envelopes:
+        if not include_failed and envelope.get("status", 200) >= 400:
+            continue
+        offset = (envelope["t"] - t0) / speed if speed else 0.0
+        path = envelope["path"] + (f"?{envelope['query']}" if envelope.get("query") else "")
+        schedule.append((offset, request_kind(envelope), envelope["method"], path, envelope.get("body")))
+    return schedule
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured gateway traffic")
+    parser.add_argument("sources", nargs="+", help="capture directories or files")
+    add_common_args(parser)
+    parser.add_argument("--speed", default="1", help="replay speed multiplier, or 'max' for no pacing")
+    parser.add_argument("--limit", type=int, default=0, help="replay only the first N requests")
+    parser.add_argument("--include-failed", action="store_true", help="also replay requests that failed when captured")
+    args = parser.parse_args()
+
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+    envelopes = read_capture(capture_files(args.sources))
+    if args.limit:
+        envelopes = envelopes[:args.limit]
+    schedule = build_schedule(envelopes, speed, args.include_failed)
+    print(f"Replaying {len(schedule)} of {len(envelopes)} captured requests at speed {args.speed}")
+
+    redis_before = redis_command_counts(args.redis_url) if args.redis_url else {}
+    samples, wall = asyncio.run(run(schedule, args))
+    finish(samples, wall, args, redis_before, {
+        "replay": args.sources, "speed": args.speed, "requests": len(schedule), "concurrency": args.concurrency,
+    })
+
+if __name__ == "__main__":
+    main()
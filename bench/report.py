@@ -0,0 +1,133 @@
+"""
+Summaries and comparisons for benchmark runs.
+
+    python bench/report.py results/base.json                 # print one run
+    python bench/report.py results/base.json results/new.json  # compare two runs
+"""
+import json, math, os, subprocess, sys, time
+
+def percentile(values, pct):
+    """Nearest-rank percentile; None for an empty sample"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+def distribution(values):
+    """p50/p95/p99/mean of a sample in milliseconds"""
+    ms = [v * 1000 for v in values]
+    return {
+        "count": len(ms),
+        "mean": sum(ms) / len(ms) if ms else None,
+        "p50": percentile(ms, 50),
+        "p95": percentile(ms, 95),
+        "p99": percentile(ms, 99),
+    }
+
+def git_revision():
+    """Commit the run was made from, so reports can be lined up against history"""
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, timeout=5)
+        dirty = subprocess.run(["git", "status", "--porcelain"], cwd=root, capture_output=True, text=True, timeout=5)
+        return rev.stdout.strip() + ("-dirty" if dirty.stdout.strip() else "")
+    except Exception:
+        return "unknown"
+
+def summarize(samples, wall_seconds, redis_ops=None, meta=None):
+    """Aggregate per-request samples into the report written to disk"""
+    kinds = {}
+    for sample in samples:
+        kinds.setdefault(sample["kind"], []).append(sample)
+
+    def section(group):
+        ok = [s for s in group if not s.get("error")]
+        tokens = sum(s.get("tokens", 0) for s in ok)
+        return {
+            "requests": len(group),
+            "errors": len(group) - len(ok),
+            "latency_ms": distribution([s["latency"] for s in ok]),
+            "ttft_ms": distribution([s["ttft"] for s in ok if s.get("ttft") is not None]),
+            "itl_ms": distribution([gap for s in ok for gap in s.get("itl", [])]),
+            "tokens": tokens,
+            "bytes": sum(s.get("bytes", 0) for s in ok),
+        }
+
+    report = {
+        "meta": {"git": git_revision(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"), **(meta or {})},
+        "wall_seconds": wall_seconds,
+        "overall": section(samples),
+        "by_kind": {kind: section(group) for kind, group in sorted(kinds.items())},
+    }
+    completed = report["overall"]["requests"] - report["overall"]["errors"]
+    report["overall"]["requests_per_sec"] = completed / wall_seconds if wall_seconds else None
+    report["overall"]["tokens_per_sec"] = report["overall"]["tokens"] / wall_seconds if wall_seconds else None
+
+    if redis_ops is not None:
+        total = sum(redis_ops.values())
+        report["redis"] = {
+            "commands": total,
+            "ops_per_request": total / len(samples) if samples else None,
+            "by_command": dict(sorted(redis_ops.items(), key=lambda kv: -kv[1])),
+        }
+    return report
+
+def fmt(value, digits=1):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+def print_report(report, out=sys.stdout):
+    meta = report["meta"]
+    overall = report["overall"]
+    print(f"run {meta.get('label') or ''} @ {meta['git']} ({meta['created']})", file=out)
+    print(f"  {overall['requests']} requests, {overall['errors']} errors in {fmt(report['wall_seconds'])}s "
+          f"-> {fmt(overall['requests_per_sec'], 2)} req/s, {fmt(overall['tokens_per_sec'])} tok/s", file=out)
+    if "redis" in report:
+        print(f"  redis: {report['redis']['commands']} commands, {fmt(report['redis']['ops_per_request'])} per request", file=out)
+    print(f"  {'kind':<18}{'n':>6}{'err':>5}  {'lat p50/p95/p99 ms':<24}{'ttft p50/p95/p99 ms':<24}{'itl p50/p95/p99 ms':<24}", file=out)
+    for kind, section in report["by_kind"].items():
+        cols = [
+            "/".join(fmt(section[metric][p], 0) for p in ("p50", "p95", "p99"))
+            for metric in ("latency_ms", "ttft_ms", "itl_ms")
+        ]
+        print(f"  {kind:<18}{section['requests']:>6}{section['errors']:>5}  {cols[0]:<24}{cols[1]:<24}{cols[2]:<24}", file=out)
+
+def compare(base, new, out=sys.stdout):
+    """Print relative change of the headline numbers between two runs"""
+    def delta(a, b):
+        if a in (None, 0) or b is None:
+            return "-"
+        return f"{(b - a) / a * 100:+.1f}%"
+
+    print(f"base {base['meta']['git']} vs new {new['meta']['git']}", file=out)
+    for key in ("requests_per_sec", "tokens_per_sec"):
+        a, b = base["overall"].get(key), new["overall"].get(key)
+        print(f"  {key:<22}{fmt(a, 2):>10} -> {fmt(b, 2):>10}  {delta(a, b)}", file=out)
+    if "redis" in base and "redis" in new:
+        a, b = base["redis"]["ops_per_request"], new["redis"]["ops_per_request"]
+        print(f"  {'redis_ops_per_request':<22}{fmt(a, 2):>10} -> {fmt(b, 2):>10}  {delta(a, b)}", file=out)
+    for kind in sorted(set(base["by_kind"]) | set(new["by_kind"])):
+        if kind not in base["by_kind"] or kind not in new["by_kind"]:
+            continue
+        for metric in ("latency_ms", "ttft_ms", "itl_ms"):
+            for p in ("p50", "p99"):
+                a, b = base["by_kind"][kind][metric][p], new["by_kind"][kind][metric][p]
+                if a is None and b is None:
+                    continue
+                print(f"  {kind + ' ' + metric + ' ' + p:<40}{fmt(a):>10} -> {fmt(b):>10}  {delta(a, b)}", file=out)
+
+def main():
+    if len(sys.argv) not in (2, 3):
+        print(__doc__)
+        sys.exit(2)
+    runs = []
+    for path in sys.argv[1:]:
+        with open(path) as f:
+            runs.append(json.load(f))
+    if len(runs) == 1:
+        print_report(runs[0])
+    else:
+        compare(*runs)
+
+if __name__ == "__main__":
+    main()
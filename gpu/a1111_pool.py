@@ -0,0 +1,141 @@
+"""Pool of Automatic1111 backends shared by the SD worker and the API proxies.
+
+Backends come from A1111_URLS (comma-separated), falling back to A1111_URL.
+A background loop polls /sdapi/v1/options on each one, which doubles as the
+health check and tells us the loaded checkpoint. Requests go to the healthy
+backend with the fewest requests in flight; a request that pins a checkpoint
+prefers a backend that already has it loaded, unless that backend is more
+than A1111_AFFINITY_SLACK requests busier than the least-loaded one.
+
+The same file lives in api/ and gpu/ because each image builds from its own
+directory; tests/test_shared_copies.py fails when the copies differ.
+"""
+import os
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+import httpx
+
+logger = logging.getLogger(__name__)
+
+A1111_HEALTH_INTERVAL = float(os.getenv("A1111_HEALTH_INTERVAL", "10"))
+A1111_AFFINITY_SLACK = int(os.getenv("A1111_AFFINITY_SLACK", "1"))
+
+def checkpoint_name(title):
+    """Checkpoint title without A1111's " [hash]" suffix, so pinned names match loaded ones"""
+    return title.split(" [")[0] if title else title
+
+def pool_urls(default_url):
+    """Backend URLs from A1111_URLS, or the single A1111_URL"""
+    urls = [url.strip().rstrip("/") for url in os.getenv("A1111_URLS", "").split(",") if url.strip()]
+    return urls or [default_url.rstrip("/")]
+
+class A1111Backend:
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True  # optimistic until the first check says otherwise
+        self.in_flight = 0
+        self.checkpoint = None
+        self.last_check = 0.0
+        self.failures = 0
+
+    def has_checkpoint(self, checkpoint):
+        return self.checkpoint is not None and checkpoint_name(self.checkpoint) == checkpoint_name(checkpoint)
+
+    def state(self):
+        return {"url": self.url, "healthy": self.healthy, "in_flight": self.in_flight, "checkpoint": self.checkpoint, "failures": self.failures}
+
+class NoHealthyBackend(Exception):
+    pass
+
+class A1111Pool:
+    def __init__(self, urls):
+        self.backends = [A1111Backend(url) for url in urls]
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(300.0, connect=5.0))
+        self.health_task = None
+        self.rotation = 0
+
+    async def check(self, backend):
+        """Refresh health and loaded checkpoint of one backend"""
+        try:
+            response = await self.client.get(f"{backend.url}/sdapi/v1/options", timeout=5.0)
+            response.raise_for_status()
+            backend.checkpoint = response.json().get("sd_model_checkpoint")
+            if not backend.healthy:
+                logger.info(f"A1111 backend {backend.url} is healthy again")
+            backend.healthy = True
+        except Exception as e:
+            if backend.healthy:
+                logger.warning(f"A1111 backend {backend.url} failed its health check: {e}")
+            backend.healthy = False
+        backend.last_check = time.time()
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    async def _health_loop(self):
+        while True:
+            await self.check_all()
+            await asyncio.sleep(A1111_HEALTH_INTERVAL)
+
+    def start(self):
+        """Start the background health checks; call from a running event loop"""
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self._health_loop())
+
+    def pick(self, checkpoint=None):
+        """Least-loaded healthy backend, preferring one that has `checkpoint` loaded"""
+        candidates = [b for b in self.backends if b.healthy] or self.backends
+        if not candidates:
+            raise NoHealthyBackend("No A1111 backends configured")
+        least = min(b.in_flight for b in candidates)
+        if checkpoint:
+            affine = [b for b in candidates if b.has_checkpoint(checkpoint) and b.in_flight <= least + A1111_AFFINITY_SLACK]
+            if affine:
+                candidates = affine
+        lightest = [b for b in candidates if b.in_flight == min(c.in_flight for c in candidates)]
+        # Rotate among equally loaded backends so idle ones share the work
+        self.rotation += 1
+        return lightest[self.rotation % len(lightest)]
+
+    @asynccontextmanager
+    async def acquire(self, checkpoint=None):
+        """Reserve a backend for one request; transport errors mark it unhealthy until the next check"""
+        backend = self.pick(checkpoint)
+        backend.in_flight += 1
+        try:
+            yield backend
+        except httpx.TransportError:
+            backend.healthy = False
+            backend.failures += 1
+            raise
+        finally:
+            backend.in_flight -= 1
+
+    async def request(self, method, path, checkpoint=None, **kwargs):
+        """Send one request to the least-loaded backend"""
+        async with self.acquire(checkpoint) as backend:
+            response = await self.client.request(method, f"{backend.url}{path}", **kwargs)
+            response.raise_for_status()
+            return response
+
+    async def broadcast(self, method, path, **kwargs):
+        """Send a request to every healthy backend (e.g. a global options change)"""
+        targets = [b for b in self.backends if b.healthy] or self.backends
+        responses = await asyncio.gather(*(self.client.request(method, f"{b.url}{path}", **kwargs) for b in targets))
+        for response in responses:
+            response.raise_for_status()
+        return responses
+
+    def idle_checkpoints(self):
+        """Checkpoints loaded on healthy backends with nothing in flight"""
+        return {checkpoint_name(b.checkpoint) for b in self.backends if b.healthy and b.in_flight == 0 and b.checkpoint}
+
+    def shared_checkpoint(self):
+        """Checkpoint loaded on every healthy backend, or None if they differ or none are up"""
+        checkpoints = {checkpoint_name(b.checkpoint) for b in self.backends if b.healthy}
+        return checkpoints.pop() if len(checkpoints) == 1 else None
+
+    def state(self):
+        return [b.state() for b in self.backends]
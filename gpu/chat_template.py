@@ -0,0 +1,103 @@
+"""Chat prompts for llama-server, rendered from the model's own Jinja chat template.
+
+The template llama-server reports in /props is compiled once per model and
+kept. Prompts are pinned across turns: after each reply, the exact text the
+backend now holds for the conversation is remembered, keyed by its messages.
+The next turn reuses that text verbatim and appends only the newly rendered
+tail. Successive prompts therefore share a byte-identical prefix, and
+cache_prompt can reuse the slot's KV cache. This holds even when the template
+renders history differently later, e.g. because of a date from strftime_now.
+"""
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from jinja2.sandbox import ImmutableSandboxedEnvironment
+from jinja2.exceptions import TemplateError
+
+logger = logging.getLogger(__name__)
+
+CHAT_PREFIX_CACHE = int(os.getenv("CHAT_PREFIX_CACHE", "512"))  # conversations whose prompt text is pinned
+
+def raise_exception(message):
+    raise TemplateError(message)
+
+def tojson(value, indent=None, ensure_ascii=False, sort_keys=False):
+    return json.dumps(value, indent=indent, ensure_ascii=ensure_ascii, sort_keys=sort_keys)
+
+def conversation_key(messages):
+    return hashlib.sha256(json.dumps([[m["role"], m["content"]] for m in messages]).encode()).hexdigest()
+
+class ChatTemplate:
+    """A compiled chat template with the model's special tokens"""
+
+    def __init__(self, source, bos_token="", eos_token=""):
+        env = ImmutableSandboxedEnvironment(trim_blocks=True, lstrip_blocks=True, extensions=["jinja2.ext.loopcontrols"])
+        env.filters["tojson"] = tojson
+        env.globals["raise_exception"] = raise_exception
+        env.globals["strftime_now"] = lambda fmt: datetime.now().strftime(fmt)
+        self.template = env.from_string(source)
+        self.bos_token = bos_token or ""
+        self.eos_token = eos_token or ""
+
+    def render(self, messages, add_generation_prompt):
+        text = self.template.render(
+            messages=messages,
+            add_generation_prompt=add_generation_prompt,
+            bos_token=self.bos_token,
+            eos_token=self.eos_token,
+        )
+        # llama-server adds BOS itself when it tokenizes the prompt
+        if self.bos_token and text.startswith(self.bos_token):
+            text = text[len(self.bos_token):]
+        return text
+
+_templates = {}
+
+def compiled_template(model, source, bos_token="", eos_token=""):
+    """ChatTemplate for a model, compiled on first use"""
+    key = (model, hashlib.sha256(source.encode()).hexdigest(), bos_token, eos_token)
+    if key not in _templates:
+        _templates[key] = ChatTemplate(source, bos_token, eos_token)
+        logger.info(f"Compiled chat template for {model}")
+    return _templates[key]
+
+class PromptCache:
+    """Pinned prompt text per conversation prefix, least recently used evicted"""
+
+    def __init__(self, size=CHAT_PREFIX_CACHE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def prompt(self, template, messages):
+        """Prompt for `messages` plus the generation prompt, reusing the pinned text of the longest known prefix"""
+        full = template.render(messages, add_generation_prompt=True)
+        for end in range(len(messages) - 1, 0, -1):
+            key = conversation_key(messages[:end])
+            pinned = self.entries.get(key)
+            if pinned is None:
+                continue
+            rendered = template.render(messages[:end], add_generation_prompt=False)
+            if not full.startswith(rendered):
+                break  # the template rewrites earlier turns once more follow; nothing to pin to
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return pinned + full[len(rendered):]
+        self.misses += 1
+        return full
+
+    def remember(self, template, messages, prompt, reply):
+        """Pin the text the backend holds after generating `reply` for `prompt`"""
+        with_reply = list(messages) + [{"role": "assistant", "content": reply}]
+        rendered = template.render(with_reply, add_generation_prompt=False)
+        asked = template.render(messages, add_generation_prompt=True)
+        # The template's closing of the reply turn (e.g. "<|im_end|>\n"), after the pinned prompt
+        text = prompt + rendered[len(asked):] if rendered.startswith(asked) else rendered
+        self.entries[conversation_key(with_reply)] = text
+        self.entries.move_to_end(conversation_key(with_reply))
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
@@ -0,0 +1,143 @@
+"""Fit prompts into llama-server's context window before they are sent.
+
+When a prompt plus its reply outgrows a slot's context, llama-server shifts the
+context or truncates in the middle of generation, which is slow and degrades
+the output. The llama.cpp worker budgets every completion and chat request
+against the slot's n_ctx from /props instead:
+
+- chat: the oldest turns are dropped, always keeping the leading system
+  messages and the newest message;
+- completion: the prompt keeps its first n_keep tokens (after BOS) and as much
+  of its end as fits, and is sent as token IDs.
+
+Either way n_predict is capped to the space left, so generation never runs
+past the context. Token counts are cached per text, so a conversation's
+history is tokenized once rather than on every turn. A completion prompt is
+only tokenized when its UTF-8 length could exceed the budget (a token is at
+least one byte) or a requested n_predict may not fit, so short prompts cost no
+round trip to /tokenize.
+
+Environment:
+    CONTEXT_POLICY     trim (default), reject (error instead of trimming) or off
+    CONTEXT_RESERVE    tokens kept free for the reply when n_predict is unset (512)
+    TOKEN_COUNT_CACHE  texts whose token count is cached (8192)
+"""
+import os
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_POLICY = os.getenv("CONTEXT_POLICY", "trim").lower()
+CONTEXT_RESERVE = int(os.getenv("CONTEXT_RESERVE", "512"))
+TOKEN_COUNT_CACHE = int(os.getenv("TOKEN_COUNT_CACHE", "8192"))
+MESSAGE_OVERHEAD = 8  # template tokens around a message, for choosing how many turns to drop
+
+class ContextOverflow(Exception):
+    """The prompt cannot be made to fit (policy reject, or nothing left to drop)"""
+
+class ContextBudget:
+    def __init__(self, tokenize, policy=CONTEXT_POLICY, reserve=CONTEXT_RESERVE, cache_size=TOKEN_COUNT_CACHE):
+        self.tokenize = tokenize  # (text, add_special) -> token IDs
+        self.policy = policy
+        self.reserve = reserve
+        self.cache_size = cache_size
+        self.counts = OrderedDict()
+        self.special_prefix = None  # tokens the tokenizer adds to every prompt, e.g. BOS
+        self.counters = {}
+
+    def count(self, text, add_special=False):
+        """Token count of `text`, cached"""
+        key = (hashlib.sha256(text.encode()).digest(), add_special)
+        if key in self.counts:
+            self.counts.move_to_end(key)
+            return self.counts[key]
+        count = len(self.tokenize(text, add_special))
+        self.counts[key] = count
+        while len(self.counts) > self.cache_size:
+            self.counts.popitem(last=False)
+        return count
+
+    def _tally(self, field, amount=1):
+        self.counters[field] = self.counters.get(field, 0) + amount
+
+    def take_counters(self):
+        """Counters since the last call, for metrics:llm"""
+        counters, self.counters = self.counters, {}
+        return counters
+
+    def _prompt_budget(self, n_ctx, n_predict):
+        reply = n_predict if n_predict and n_predict > 0 else self.reserve
+        return n_ctx - min(reply, n_ctx // 2)
+
+    @staticmethod
+    def _cap(n_predict, n_ctx, used):
+        room = n_ctx - used
+        return room if not n_predict or n_predict < 0 else min(n_predict, room)
+
+    def fit_chat(self, messages, render, n_ctx, n_predict=-1):
+        """Drop the oldest turns until render(messages) leaves room for the reply.
+
+        Returns (messages, prompt, dropped message count, n_predict capped to the space left).
+        """
+        if self.policy == "off" or not n_ctx:
+            return messages, render(messages), 0, n_predict
+        budget = self._prompt_budget(n_ctx, n_predict)
+        head = 0
+        while head < len(messages) - 1 and messages[head]["role"] == "system":
+            head += 1
+        kept = messages
+        while True:
+            prompt = render(kept)
+            used = self.count(prompt, add_special=True)
+            if used <= budget:
+                break
+            history = kept[head:-1]
+            if self.policy == "reject" or not history:
+                self._tally("context_rejected_total")
+                raise ContextOverflow(f"Prompt needs {used} tokens, the context allows {budget} with room for the reply")
+            # Drop enough turns to cover the excess by the cached per-message counts, then re-check
+            excess, drop = used - budget, 0
+            while drop < len(history) and excess > 0:
+                excess -= self.count(history[drop]["content"]) + MESSAGE_OVERHEAD
+                drop += 1
+            while drop < len(history) and history[drop]["role"] != "user":
+                drop += 1  # resume on a user turn
+            kept = kept[:head] + history[drop:] + kept[-1:]
+        dropped = len(messages) - len(kept)
+        if dropped:
+            logger.info(f"Context budget: dropped {dropped} of {len(messages)} messages to fit {used}/{n_ctx} tokens")
+            self._tally("context_trimmed_total")
+            self._tally("context_trimmed_messages_total", dropped)
+        return kept, prompt, dropped, self._cap(n_predict, n_ctx, used)
+
+    def fit_prompt(self, prompt, n_ctx, n_predict=-1, n_keep=0):
+        """Cut the middle of an over-long completion prompt, keeping BOS plus n_keep tokens and the end.
+
+        Returns (prompt, dropped token count, n_predict capped to the space left); a cut prompt is token IDs.
+        """
+        if self.policy == "off" or not n_ctx or not isinstance(prompt, str):
+            return prompt, 0, n_predict
+        budget = self._prompt_budget(n_ctx, n_predict)
+        if self.special_prefix is None:
+            self.special_prefix = self.tokenize("", True)
+        bound = len(prompt.encode()) + len(self.special_prefix)  # tokens never outnumber bytes
+        # The byte bound only proves the prompt fits; an unset n_predict stays unset (llama-server
+        # stops at the context) and a set one that may not fit is capped by the real token count
+        if bound <= budget and (not n_predict or n_predict < 0 or n_predict <= n_ctx - bound):
+            return prompt, 0, n_predict
+        tokens = self.tokenize(prompt, True)
+        used = len(tokens)
+        if used <= budget:
+            return prompt, 0, self._cap(n_predict, n_ctx, used)
+        head = len(self.special_prefix) + max(n_keep or 0, 0)
+        if self.policy == "reject" or head >= budget:
+            self._tally("context_rejected_total")
+            raise ContextOverflow(f"Prompt needs {used} tokens, the context allows {budget} with room for the reply")
+        kept = tokens[:head] + tokens[len(tokens) - (budget - head):]
+        dropped = len(tokens) - len(kept)
+        logger.info(f"Context budget: cut {dropped} of {len(tokens)} prompt tokens to fit {len(kept)}/{n_ctx}")
+        self._tally("context_trimmed_total")
+        self._tally("context_trimmed_tokens_total", dropped)
+        return kept, dropped, self._cap(n_predict, n_ctx, len(kept))
@@ -0,0 +1,35 @@
+"""Compact encodings for embedding results, shared by the LLM workers.
+
+Ollama's /embed contract returns `embeddings` as lists of floats, about 20KB of
+JSON text per 1024-dim vector. A request may ask for `encoding_format: "base64"`
+instead: each vector becomes the base64 of its little-endian float32 bytes (or
+float16 with `dtype: "float16"`). That is 3-6x smaller, and the API passes it
+through without parsing floats. `normalize: true` scales vectors to unit length
+first, so clients can rank by dot product.
+"""
+import base64
+import numpy as np
+
+EMBEDDING_DTYPES = {"float32": "<f4", "float16": "<f2"}
+
+def encode_embeddings(result, request_dict):
+    """Apply the request's normalize/encoding_format/dtype to an Ollama-shaped embed result"""
+    encoding_format = request_dict.get("encoding_format") or "float"
+    if encoding_format == "float" and not request_dict.get("normalize"):
+        return result
+
+    vectors = np.asarray(result.get("embeddings") or [], dtype=np.float32)
+    if request_dict.get("normalize") and vectors.size:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+
+    if encoding_format == "base64":
+        dtype = request_dict.get("dtype") or "float32"
+        packed = vectors.astype(EMBEDDING_DTYPES[dtype])
+        result["embeddings"] = [base64.b64encode(row.tobytes()).decode() for row in packed]
+        result["encoding_format"] = "base64"
+        result["dtype"] = dtype
+        result["dimensions"] = int(vectors.shape[1]) if vectors.ndim == 2 else 0
+    else:
+        result["embeddings"] = vectors.tolist()
+    return result
@@ -2,15 +2,23 @@ import os, time, requests, json, logging, asyncio
 from redis import Redis
 import redis.asyncio as redis
 from rq import Worker, Queue, Connection
+from streaming import SSE, NDJSON, StreamWriter, backend_lines, dumps, loads, encode_frame, get_iso_timestamp
+from scheduling import next_task, PreemptionWatch, requeue
+from logsetup import configure_logging, set_request_id, truncate
+from metrics import drop_expired, incr
+from embeddings import encode_embeddings
+from chat_template import PromptCache, compiled_template
+from context_budget import ContextBudget
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("llm")
 logger = logging.getLogger(__name__)
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PASS = os.getenv("REDIS_PASS", "")
 REDIS_URL = f"redis://:{REDIS_PASS}@{REDIS_HOST}:6379"
 LLAMA_SERVER = os.getenv("LLAMA_SERVER_URL", "http://localhost:1337")
+LLAMA_EMBED_BATCH = int(os.getenv("LLAMA_EMBED_BATCH", "64"))  # inputs per /v1/embeddings call
 
 # FastAPI enqueues to this queue via Redis
 conn = Redis.from_url(REDIS_URL)
@@ -25,7 +33,7 @@ def get_template():
         response = requests.post(f"{LLAMA_SERVER}/api/show", json={}, timeout=30)
         response.raise_for_status()
         result = response.json()
-        logger.info(f"Template response: {result}")
+        logger.info(f"Template response: {truncate(result)}", extra={"event": "payload"})
         # Return the template field if available, otherwise return the whole response
         if "template" in result:
             return {"template": result["template"]}
@@ -42,7 +50,7 @@ def get_props():
         response = requests.get(f"{LLAMA_SERVER}/props", timeout=30)
         response.raise_for_status()
         result = response.json()
-        logger.info(f"Props response: {result}")
+        logger.info(f"Props response: {truncate(result)}", extra={"event": "payload"})
         return result
     except Exception as e:
         logger.error(f"Error getting props: {str(e)}")
@@ -59,54 +67,134 @@ def tokenize_text(content: str):
         )
         response.raise_for_status()
         result = response.json()
-        logger.info(f"Tokenize response: {result}")
+        logger.info(f"Tokenize response: {truncate(result)}", extra={"event": "payload"})
         return result
     except Exception as e:
         logger.error(f"Error tokenizing: {str(e)}")
         return {"error": str(e)}
 
+# Prompts are budgeted against the slot's context before they reach llama-server (see context_budget.py)
+_server_props = {}
+
+def server_props():
+    """llama-server /props, fetched once"""
+    if not _server_props:
+        props = get_props()
+        if props.get("error"):
+            raise RuntimeError(f"Could not read server props: {props['error']}")
+        _server_props.update(props)
+    return _server_props
+
+def slot_context():
+    """Context size of one slot, or 0 (no budgeting) if the server can't tell"""
+    try:
+        props = server_props()
+    except RuntimeError as e:
+        logger.warning(f"Context budget disabled for this request: {e}")
+        return 0
+    return (props.get("default_generation_settings") or {}).get("n_ctx") or props.get("n_ctx", 0)
+
+def llama_tokens(content, add_special=False):
+    response = requests.post(f"{LLAMA_SERVER}/tokenize", json={"content": content, "add_special": add_special}, timeout=30)
+    response.raise_for_status()
+    return loads(response.content)["tokens"]
+
+context_budget = ContextBudget(llama_tokens)
+
+def budget_completion(llama_request, request_dict):
+    """Fit a /completion request into the context; returns the number of prompt tokens cut"""
+    llama_request["prompt"], dropped, llama_request["n_predict"] = context_budget.fit_prompt(
+        llama_request["prompt"], slot_context(), llama_request["n_predict"], request_dict.get("n_keep", 0))
+    return dropped
+
+async def flush_context_metrics():
+    for field, amount in context_budget.take_counters().items():
+        await incr(redis_client, "llm", field, amount)
+
+def handle_embed(request_dict):
+    """Embeddings from llama-server (started with --embeddings), in Ollama's /embed shape"""
+    inputs = request_dict["input"]
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    logger.info(f"Processing embed request: {len(inputs)} inputs", extra={"event": "payload"})
+    started = time.time()
+    embeddings = []
+    prompt_tokens = 0
+    try:
+        # llama-server embeds every input of a call in parallel slots; chunks only bound the payload
+        for start in range(0, len(inputs), LLAMA_EMBED_BATCH):
+            response = requests.post(
+                f"{LLAMA_SERVER}/v1/embeddings",
+                json={"input": inputs[start:start + LLAMA_EMBED_BATCH]},
+                timeout=60
+            )
+            response.raise_for_status()
+            body = loads(response.content)
+            embeddings.extend(row["embedding"] for row in sorted(body["data"], key=lambda row: row["index"]))
+            prompt_tokens += body.get("usage", {}).get("prompt_tokens", 0)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error in embed: {str(e)}")
+        return {"error": f"LLaMA server error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Error in embed endpoint: {str(e)}")
+        return {"error": f"Error with embed: {str(e)}"}
+
+    result = {
+        "model": request_dict.get("model"),
+        "embeddings": embeddings,
+        "total_duration": int((time.time() - started) * 1e9),
+        "prompt_eval_count": prompt_tokens,
+    }
+    logger.info(f"LLaMA embed response: {len(embeddings)} embeddings")
+    return encode_embeddings(result, request_dict)
+
+def completion_request(request_dict, stream):
+    """llama-server /completion request for a Unity completion request"""
+    llama_request = {
+        "prompt": request_dict["prompt"],
+        "id_slot": request_dict.get("id_slot", -1),
+        "temperature": request_dict.get("temperature", 0.2),
+        "top_k": request_dict.get("top_k", 40),
+        "top_p": request_dict.get("top_p", 0.9),
+        "min_p": request_dict.get("min_p", 0.05),
+        "n_predict": request_dict.get("n_predict", -1),
+        "stream": stream,
+        "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
+        "repeat_last_n": request_dict.get("repeat_last_n", 64),
+        "penalize_nl": request_dict.get("penalize_nl", True),
+        "presence_penalty": request_dict.get("presence_penalty", 0.0),
+        "frequency_penalty": request_dict.get("frequency_penalty", 0.0),
+        "mirostat": request_dict.get("mirostat", 0),
+        "mirostat_tau": request_dict.get("mirostat_tau", 5.0),
+        "mirostat_eta": request_dict.get("mirostat_eta", 0.1),
+        "seed": request_dict.get("seed", 0),
+        "ignore_eos": request_dict.get("ignore_eos", False),
+        "n_probs": request_dict.get("n_probs", 0),
+        "cache_prompt": request_dict.get("cache_prompt", True)
+    }
+    
+    # Add optional fields if provided
+    if request_dict.get("stop"):
+        llama_request["stop"] = request_dict["stop"]
+    if request_dict.get("grammar"):
+        llama_request["grammar"] = request_dict["grammar"]
+    if request_dict.get("logit_bias"):
+        llama_request["logit_bias"] = request_dict["logit_bias"]
+    if request_dict.get("penalty_prompt"):
+        llama_request["penalty_prompt"] = request_dict["penalty_prompt"]
+    if "n_keep" in request_dict and request_dict["n_keep"] > -1:
+        llama_request["n_keep"] = request_dict["n_keep"]
+    return llama_request
+
 def handle_completion(request_dict):
     """Handle completion requests from Unity"""
     try:
-        logger.info(f"Processing completion request: {request_dict}")
+        logger.info(f"Processing completion request: {truncate(request_dict)}", extra={"event": "payload"})
         
-        # Convert Unity request to LLaMA.cpp format
-        llama_request = {
-            "prompt": request_dict["prompt"],
-            "id_slot": request_dict.get("id_slot", -1),
-            "temperature": request_dict.get("temperature", 0.2),
-            "top_k": request_dict.get("top_k", 40),
-            "top_p": request_dict.get("top_p", 0.9),
-            "min_p": request_dict.get("min_p", 0.05),
-            "n_predict": request_dict.get("n_predict", -1),
-            "stream": False,  # Use non-streaming for Redis queue
-            "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
-            "repeat_last_n": request_dict.get("repeat_last_n", 64),
-            "penalize_nl": request_dict.get("penalize_nl", True),
-            "presence_penalty": request_dict.get("presence_penalty", 0.0),
-            "frequency_penalty": request_dict.get("frequency_penalty", 0.0),
-            "mirostat": request_dict.get("mirostat", 0),
-            "mirostat_tau": request_dict.get("mirostat_tau", 5.0),
-            "mirostat_eta": request_dict.get("mirostat_eta", 0.1),
-            "seed": request_dict.get("seed", 0),
-            "ignore_eos": request_dict.get("ignore_eos", False),
-            "n_probs": request_dict.get("n_probs", 0),
-            "cache_prompt": request_dict.get("cache_prompt", True)
-        }
-        
-        # Add optional fields if provided
-        if request_dict.get("stop"):
-            llama_request["stop"] = request_dict["stop"]
-        if request_dict.get("grammar"):
-            llama_request["grammar"] = request_dict["grammar"]
-        if request_dict.get("logit_bias"):
-            llama_request["logit_bias"] = request_dict["logit_bias"]
-        if request_dict.get("penalty_prompt"):
-            llama_request["penalty_prompt"] = request_dict["penalty_prompt"]
-        if "n_keep" in request_dict and request_dict["n_keep"] > -1:
-            llama_request["n_keep"] = request_dict["n_keep"]
+        llama_request = completion_request(request_dict, stream=False)  # non-streaming for the Redis queue
         
-        logger.info(f"Sending to LLaMA server: {llama_request}")
+        dropped = budget_completion(llama_request, request_dict)
+        logger.info(f"Sending to LLaMA server: {truncate(llama_request)}", extra={"event": "payload"})
         
         # Send request to LLaMA server
         response = requests.post(
@@ -118,17 +206,20 @@ def handle_completion(request_dict):
         
         # Parse JSON response
         result = response.json()
-        logger.info(f"LLaMA server response: {result}")
+        logger.info(f"LLaMA server response: {truncate(result)}", extra={"event": "payload"})
         
         # Convert response for Unity
         unity_result = {
             "content": result.get("content", ""),
             "multimodal": False,
             "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
-            "stop": result.get("stop", True)
+            "stop": result.get("stop", True),
+            "tokens_predicted": result.get("tokens_predicted", 0)
         }
+        if dropped:
+            unity_result["context_trimmed_tokens"] = dropped
         
-        logger.info(f"Returning Unity result: {unity_result}")
+        logger.info(f"Returning Unity result: {truncate(unity_result)}", extra={"event": "payload"})
         return unity_result
                 
     except requests.exceptions.RequestException as e:
@@ -138,58 +229,219 @@ def handle_completion(request_dict):
         logger.error(f"Error in completion endpoint: {str(e)}")
         return {"error": f"Error with completion: {str(e)}"}
 
+async def handle_completion_preemptible(task):
+    """Non-streamed completion of a low-priority task, yielding to interactive tasks (see scheduling.py).
+
+    The reply is streamed from llama-server so it can be aborted between tokens. A preempted task is
+    requeued with its partial output; the continuation sends the prompt plus that output to the same
+    slot, so cache_prompt reuses the KV cache. Returns the result, or None once requeued.
+    """
+    request_dict = task["data"]
+    resume = task.get("resume") or {"content": "", "tokens": 0}
+    try:
+        logger.info(f"Processing preemptible completion request: {truncate(request_dict)}", extra={"event": "payload"})
+        llama_request = completion_request(request_dict, stream=True)
+        if resume["content"]:
+            llama_request["prompt"] = request_dict["prompt"] + resume["content"]
+            if llama_request["n_predict"] > 0:
+                llama_request["n_predict"] = max(1, llama_request["n_predict"] - resume["tokens"])
+            if llama_request["id_slot"] < 0 and resume.get("id_slot") is not None:
+                llama_request["id_slot"] = resume["id_slot"]
+        dropped = budget_completion(llama_request, request_dict)
+
+        watch = PreemptionWatch(redis_client, "gpu_tasks", task)
+        response = requests.post(f"{LLAMA_SERVER}/completion", json=llama_request, stream=True, timeout=300)
+        response.raise_for_status()
+        parts, final, slot = [], {}, resume.get("id_slot")
+        try:
+            async for line in backend_lines(response):
+                if not line.startswith(b"data: ") or line[6:].strip() == b"[DONE]":
+                    continue
+                data = loads(line[6:])
+                slot = data.get("id_slot", slot)
+                if data.get("stop"):
+                    final = data
+                    break
+                parts.append(data.get("content", ""))
+                if await watch.should_yield():
+                    # Closing the connection stops the generation in llama-server
+                    task["resume"] = {"content": resume["content"] + "".join(parts), "tokens": resume["tokens"] + len(parts), "id_slot": slot}
+                    await requeue(redis_client, "gpu_tasks", task)
+                    await incr(redis_client, "llm", "tasks_preempted_total")
+                    await incr(redis_client, "llm", "preempted_tokens_total", len(parts))
+                    logger.info(f"Preempted task {task['id']} after {task['resume']['tokens']} tokens; requeued")
+                    return None
+        finally:
+            response.close()
+
+        unity_result = {
+            "content": resume["content"] + "".join(parts) + final.get("content", ""),
+            "multimodal": False,
+            "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
+            "stop": True,
+            "tokens_predicted": resume["tokens"] + final.get("tokens_predicted", len(parts)),
+        }
+        if task.get("preemptions"):
+            unity_result["preemptions"] = task["preemptions"]
+        if dropped:
+            unity_result["context_trimmed_tokens"] = dropped
+        logger.info(f"Returning Unity result: {truncate(unity_result)}", extra={"event": "payload"})
+        return unity_result
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error in completion: {str(e)}")
+        return {"error": f"LLaMA server error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Error in completion endpoint: {str(e)}")
+        return {"error": f"Error with completion: {str(e)}"}
+
+# Chat: Ollama-style /chat rendered through the model's template (see chat_template.py)
+prompt_cache = PromptCache()
+
+# Ollama option name -> llama-server /completion parameter
+OLLAMA_OPTIONS = {
+    "temperature": "temperature", "top_k": "top_k", "top_p": "top_p", "min_p": "min_p",
+    "typical_p": "typical_p", "num_predict": "n_predict", "num_keep": "n_keep", "seed": "seed",
+    "stop": "stop", "repeat_penalty": "repeat_penalty", "repeat_last_n": "repeat_last_n",
+    "presence_penalty": "presence_penalty", "frequency_penalty": "frequency_penalty",
+    "mirostat": "mirostat", "mirostat_tau": "mirostat_tau", "mirostat_eta": "mirostat_eta",
+}
+
+def chat_template(model):
+    """Compiled template of the served model, from /props"""
+    props = server_props()
+    if not props.get("chat_template"):
+        raise RuntimeError("llama-server reported no chat template")
+    return compiled_template(
+        props.get("model_path") or model,
+        props["chat_template"],
+        props.get("bos_token", ""),
+        props.get("eos_token", ""),
+    )
+
+def chat_request(request_dict, stream):
+    """llama-server /completion request for an Ollama chat request; returns (template, messages, request, dropped)
+
+    The oldest turns are dropped if the conversation doesn't fit the context (see context_budget.py).
+    """
+    messages = [{"role": m["role"], "content": m["content"]} for m in request_dict["messages"]]
+    template = chat_template(request_dict.get("model"))
+    llama_request = {"stream": stream, "cache_prompt": True}
+    for option, value in (request_dict.get("options") or {}).items():
+        if option in OLLAMA_OPTIONS:
+            llama_request[OLLAMA_OPTIONS[option]] = value
+    messages, llama_request["prompt"], dropped, llama_request["n_predict"] = context_budget.fit_chat(
+        messages, lambda kept: prompt_cache.prompt(template, kept), slot_context(), llama_request.get("n_predict", -1))
+    if request_dict.get("format") == "json":
+        llama_request["json_schema"] = {"type": "object"}
+    if request_dict.get("id_slot", -1) >= 0:
+        llama_request["id_slot"] = request_dict["id_slot"]
+    return template, messages, llama_request, dropped
+
+def chat_stats(result, started):
+    """Ollama timing/count fields from a llama-server final chunk"""
+    timings = result.get("timings") or {}
+    return {
+        "total_duration": int((time.time() - started) * 1e9),
+        "prompt_eval_count": result.get("tokens_evaluated", timings.get("prompt_n", 0)),
+        "prompt_eval_duration": int(timings.get("prompt_ms", 0) * 1e6),
+        "eval_count": result.get("tokens_predicted", timings.get("predicted_n", 0)),
+        "eval_duration": int(timings.get("predicted_ms", 0) * 1e6),
+    }
+
+def handle_chat(request_dict):
+    """Handle Ollama-style chat requests on llama.cpp"""
+    try:
+        logger.info(f"Processing chat request: {truncate(request_dict)}", extra={"event": "payload"})
+        started = time.time()
+        template, messages, llama_request, dropped = chat_request(request_dict, stream=False)
+        response = requests.post(f"{LLAMA_SERVER}/completion", json=llama_request, timeout=300)
+        response.raise_for_status()
+        result = loads(response.content)
+        content = result.get("content", "")
+        prompt_cache.remember(template, messages, llama_request["prompt"], content)
+        return {
+            "model": request_dict.get("model"),
+            "created_at": get_iso_timestamp(),
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "done_reason": "length" if result.get("stopped_limit") else "stop",
+            **chat_stats(result, started),
+            **({"context_trimmed_messages": dropped} if dropped else {}),
+        }
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error in chat: {str(e)}")
+        return {"error": f"LLaMA server error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Error in chat endpoint: {str(e)}")
+        return {"error": f"Error with chat: {str(e)}"}
+
+async def handle_chat_streaming(request_dict, task_id, stream_format=NDJSON):
+    """Stream an Ollama-style chat on llama.cpp; the API adds the closing done frame from the result"""
+    try:
+        logger.info(f"Processing streaming chat request: {truncate(request_dict)}", extra={"event": "payload"})
+        started = time.time()
+        template, messages, llama_request, dropped = chat_request(request_dict, stream=True)
+        response = requests.post(f"{LLAMA_SERVER}/completion", json=llama_request, stream=True, timeout=300)
+        response.raise_for_status()
+
+        model = request_dict.get("model")
+        writer = StreamWriter.for_request(redis_client, task_id, request_dict)
+        parts = []
+        final = {}
+        async for line in backend_lines(response):
+            if not line.startswith(b"data: "):
+                continue
+            data = loads(line[6:])
+            if data.get("content"):
+                parts.append(data["content"])
+                await writer.push(encode_frame({
+                    "model": model,
+                    "created_at": get_iso_timestamp(),
+                    "message": {"role": "assistant", "content": data["content"]},
+                    "done": False,
+                }, stream_format))
+            if data.get("stop"):
+                final = data
+                break
+        await writer.close()
+
+        content = "".join(parts)
+        prompt_cache.remember(template, messages, llama_request["prompt"], content)
+        final_result = chat_stats(final, started)
+        if dropped:
+            final_result["context_trimmed_messages"] = dropped
+        if request_dict.get("include_content"):
+            final_result["content"] = content
+        await redis_client.set(f"result:{task_id}", dumps({"data": final_result}), ex=300)
+        logger.info(f"Streaming chat finished for task {task_id}: {writer.frames} frames in {writer.writes} writes")
+
+    except requests.exceptions.RequestException as e:
+        await redis_client.set(f"result:{task_id}", dumps({"error": f"LLaMA server error: {str(e)}"}), ex=300)
+        logger.error(f"Request error in streaming chat: {str(e)}")
+    except Exception as e:
+        await redis_client.set(f"result:{task_id}", dumps({"error": f"Error with streaming chat: {str(e)}"}), ex=300)
+        logger.error(f"Error in streaming chat: {str(e)}")
+
 def handle_slots(request_dict):
     """Handle slot operations (save/restore cache)"""
     try:
-        logger.info(f"Processing slots request: {request_dict}")
+        logger.info(f"Processing slots request: {truncate(request_dict)}", extra={"event": "payload"})
         # For now, return a simple response since we don't have cache functionality
         return {"filename": request_dict.get("filepath", "")}
     except Exception as e:
         logger.error(f"Error in slots handler: {str(e)}")
         return {"error": f"Error in slots: {str(e)}"}
 
-async def handle_completion_streaming(request_dict, task_id):
+async def handle_completion_streaming(request_dict, task_id, stream_format=SSE):
     """Handle streaming completion requests from Unity"""
     try:
-        logger.info(f"Processing streaming completion request: {request_dict}")
-        
-        # Convert Unity request to LLaMA.cpp format
-        llama_request = {
-            "prompt": request_dict["prompt"],
-            "id_slot": request_dict.get("id_slot", -1),
-            "temperature": request_dict.get("temperature", 0.2),
-            "top_k": request_dict.get("top_k", 40),
-            "top_p": request_dict.get("top_p", 0.9),
-            "min_p": request_dict.get("min_p", 0.05),
-            "n_predict": request_dict.get("n_predict", -1),
-            "stream": request_dict.get("stream", True),  # Enable streaming
-            "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
-            "repeat_last_n": request_dict.get("repeat_last_n", 64),
-            "penalize_nl": request_dict.get("penalize_nl", True),
-            "presence_penalty": request_dict.get("presence_penalty", 0.0),
-            "frequency_penalty": request_dict.get("frequency_penalty", 0.0),
-            "mirostat": request_dict.get("mirostat", 0),
-            "mirostat_tau": request_dict.get("mirostat_tau", 5.0),
-            "mirostat_eta": request_dict.get("mirostat_eta", 0.1),
-            "seed": request_dict.get("seed", 0),
-            "ignore_eos": request_dict.get("ignore_eos", False),
-            "n_probs": request_dict.get("n_probs", 0),
-            "cache_prompt": request_dict.get("cache_prompt", True)
-        }
+        logger.info(f"Processing streaming completion request: {truncate(request_dict)}", extra={"event": "payload"})
         
-        # Add optional fields if provided
-        if request_dict.get("stop"):
-            llama_request["stop"] = request_dict["stop"]
-        if request_dict.get("grammar"):
-            llama_request["grammar"] = request_dict["grammar"]
-        if request_dict.get("logit_bias"):
-            llama_request["logit_bias"] = request_dict["logit_bias"]
-        if request_dict.get("penalty_prompt"):
-            llama_request["penalty_prompt"] = request_dict["penalty_prompt"]
-        if "n_keep" in request_dict and request_dict["n_keep"] > -1:
-            llama_request["n_keep"] = request_dict["n_keep"]
+        llama_request = completion_request(request_dict, stream=request_dict.get("stream", True))
         
-        logger.info(f"Sending streaming request to LLaMA server: {llama_request}")
+        dropped = budget_completion(llama_request, request_dict)
+        logger.info(f"Sending streaming request to LLaMA server: {truncate(llama_request)}", extra={"event": "payload"})
         
         # Send streaming request to LLaMA server
         response = requests.post(
@@ -200,52 +452,67 @@ async def handle_completion_streaming(request_dict, task_id):
         )
         response.raise_for_status()
         
-        content = ""
-        for line in response.iter_lines():
+        slot_id = request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0
+        writer = StreamWriter.for_request(redis_client, task_id, request_dict)
+        parts = []  # joined once at the end; += on a str is quadratic for long generations
+        stopped = False
+        final = {}  # the stop chunk, which carries llama-server's token counts
+        async for line in backend_lines(response):
             if line:
-                line_str = line.decode('utf-8')
-                if line_str.startswith('data: '):
-                    data_str = line_str[6:]  # Remove 'data: ' prefix
-                    if data_str.strip() == '[DONE]':
+                if line.startswith(b'data: '):
+                    data_str = line[6:]  # Remove 'data: ' prefix
+                    if data_str.strip() == b'[DONE]':
                         break
                     try:
-                        data = json.loads(data_str)
+                        data = loads(data_str)
                         if 'content' in data:
                             token_content = data['content']
-                            content += token_content
-                            # Stream individual token immediately
+                            parts.append(token_content)
+                            stopped = data.get("stop", False)
+                            if stopped:
+                                final = data
+                            # Frame the token for the client once; the API forwards it verbatim
                             chunk_result = {
                                 "content": token_content,
                                 "multimodal": False,
-                                "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
-                                "stop": data.get("stop", False)
+                                "slot_id": slot_id,
+                                "stop": stopped
                             }
-                            # Send each token immediately to Redis
-                            await redis_client.rpush(f"stream:{task_id}", json.dumps(chunk_result))
-                            
-                            # Set expiration on the stream key (10 minutes)
-                            await redis_client.expire(f"stream:{task_id}", 600)
+                            await writer.push(encode_frame(chunk_result, stream_format))
                     except json.JSONDecodeError:
                         logger.warning(f"Could not parse streaming data: {data_str}")
         
-        # Send final result
+        if not stopped:
+            # The client needs a stop frame even if the server ended the stream without one
+            stop_chunk = {"content": "", "multimodal": False, "slot_id": slot_id, "stop": True}
+            await writer.push(encode_frame(stop_chunk, stream_format))
+        await writer.close()
+        
+        # The client already has every token, so the result only carries metadata;
+        # "streamed" tells the API the stop frame is already in the stream
         final_result = {
-            "content": content,
             "multimodal": False, 
-            "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
-            "stop": True
+            "slot_id": slot_id,
+            "stop": True,
+            "streamed": True,
+            # Chunks are not tokens (the stop chunk is usually empty); fall back to counting them only without one
+            "tokens_predicted": final.get("tokens_predicted", final.get("timings", {}).get("predicted_n", len(parts) - bool(final)))
         }
+        if dropped:
+            final_result["context_trimmed_tokens"] = dropped
+        if request_dict.get("include_content"):
+            final_result["content"] = "".join(parts)
         
-        await redis_client.set(f"result:{task_id}", json.dumps({"data": final_result}), ex=300)
-        logger.info(f"Streaming completion finished for task {task_id}")
+        await redis_client.set(f"result:{task_id}", dumps({"data": final_result}), ex=300)
+        logger.info(f"Streaming completion finished for task {task_id}: {writer.frames} frames in {writer.writes} writes")
         
     except requests.exceptions.RequestException as e:
         error_result = {"error": f"LLaMA server error: {str(e)}"}
-        await redis_client.set(f"result:{task_id}", json.dumps(error_result), ex=300)
+        await redis_client.set(f"result:{task_id}", dumps(error_result), ex=300)
         logger.error(f"Request error in streaming completion: {str(e)}")
     except Exception as e:
         error_result = {"error": f"Error with streaming completion: {str(e)}"}
-        await redis_client.set(f"result:{task_id}", json.dumps(error_result), ex=300)
+        await redis_client.set(f"result:{task_id}", dumps(error_result), ex=300)
         logger.error(f"Error in streaming completion: {str(e)}")
 
 async def process_gpu_tasks():
@@ -255,42 +522,60 @@ async def process_gpu_tasks():
     while True:
         try:
             # Check for new tasks
-            task_data = await redis_client.brpop("gpu_tasks", timeout=1)
-            if task_data:
-                task_json = task_data[1]
-                task = json.loads(task_json)
+            task_json = await next_task(redis_client, "gpu_tasks")
+            if task_json:
+                task = loads(task_json)
                 task_id = task["id"]
                 endpoint = task["endpoint"]
+                set_request_id(task.get("request_id") or task_id)
+                if await drop_expired(redis_client, "llm", task):
+                    continue
                 request_data = task["data"]
                 
                 logger.info(f"Processing task {task_id} for endpoint {endpoint}")
                 
                 if endpoint == "completion":
                     if request_data.get("stream", True):
-                        await handle_completion_streaming(request_data, task_id)
+                        await handle_completion_streaming(request_data, task_id, task.get("stream_format", SSE))
+                    elif task.get("priority") == "low":
+                        result = await handle_completion_preemptible(task)
+                        if result is not None:
+                            await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                     else:
                         # Handle non-streaming completion
                         result = handle_completion(request_data)
-                        await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                        await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
+                    await flush_context_metrics()
+                elif endpoint == "chat":
+                    if request_data.get("stream", False):
+                        await handle_chat_streaming(request_data, task_id, task.get("stream_format", NDJSON))
+                    else:
+                        result = handle_chat(request_data)
+                        await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
+                    await flush_context_metrics()
+                elif endpoint == "embed":
+                    # Handle embeddings request
+                    result = handle_embed(request_data)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "template":
                     # Handle template request
                     result = get_template()
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "props":
                     # Handle props request
                     result = get_props()
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "tokenize":
                     # Handle tokenize request
                     result = tokenize_text(request_data["content"])
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "slots":
                     # Handle slots request
                     result = handle_slots(request_data)
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 else:
                     logger.warning(f"Unknown endpoint: {endpoint}")
-                    await redis_client.set(f"result:{task_id}", json.dumps({"error": f"Unknown endpoint: {endpoint}"}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"error": f"Unknown endpoint: {endpoint}"}), ex=300)
         
         except Exception as e:
             logger.error(f"Error processing GPU task: {e}")
@@ -299,7 +584,7 @@ async def process_gpu_tasks():
     logger.info("GPU task processor stopped")
 
 # Add this to make functions available globally for RQ
-__all__ = ['call_inference', 'get_template', 'get_props', 'tokenize_text', 'handle_completion', 'handle_slots']
+__all__ = ['call_inference', 'get_template', 'get_props', 'tokenize_text', 'handle_completion', 'handle_chat', 'handle_slots']
 
 async def main():
     """Main async function to run both RQ worker and GPU task processor"""
@@ -0,0 +1,168 @@
+"""Queue-backed structured logging for the API and the GPU workers.
+
+Log calls only format a record and put it on an in-memory queue; a listener
+thread does the JSON encoding and the write to stdout, so a slow terminal,
+Docker log driver or promtail never stalls the event loop. When the queue is
+full, records are dropped and counted instead of blocking.
+
+Each record becomes one JSON line with `ts`, `level`, `component`, `logger`,
+`msg`, the current `request_id` and any `extra=` fields, which promtail
+parses into labels (see monitoring/promtail-config.yml).
+
+Environment:
+    LOG_LEVEL        root level (INFO)
+    LOG_FORMAT       json (default) or text
+    LOG_QUEUE_SIZE   records buffered before dropping (10000)
+    LOG_MAX_FIELD    cap in characters for logged bodies and messages (512)
+    LOG_SAMPLE       per-event sampling rates, e.g. "auth=0.01,payload=0.1"
+
+The same file lives in api/ and gpu/ because each image builds from its own
+directory; tests/test_shared_copies.py fails when the copies differ.
+"""
+import os, json, time, queue, atexit, random, logging, contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_MAX_FIELD = int(os.getenv("LOG_MAX_FIELD", "512"))
+
+# Events logged on every request default to sampled; anything at WARNING or above is always kept
+DEFAULT_SAMPLE_RATES = {"auth": 0.01, "payload": 0.05, "progress": 0.1}
+
+def parse_sample_rates(spec):
+    """Parse "event=rate,..." into a dict, on top of the defaults"""
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for item in (spec or "").split(","):
+        if "=" in item:
+            event, rate = item.split("=", 1)
+            try:
+                rates[event.strip()] = max(0.0, min(1.0, float(rate)))
+            except ValueError:
+                pass
+    return rates
+
+LOG_SAMPLE = parse_sample_rates(os.getenv("LOG_SAMPLE", ""))
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else came from extra= and is emitted as a field
+RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName", "color_message"}
+
+def truncate(value, limit=None):
+    """String form of a value capped at LOG_MAX_FIELD characters, for logging bodies"""
+    limit = LOG_MAX_FIELD if limit is None else limit
+    text = value if isinstance(value, str) else str(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+def set_request_id(request_id):
+    """Bind a correlation ID to the current task/context; returns the token for reset"""
+    return request_id_var.set(request_id)
+
+class SamplingFilter(logging.Filter):
+    """Keeps a random fraction of records tagged with extra={"event": name}"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        event = getattr(record, "event", None)
+        if event is None or record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(event, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that never blocks the caller: full queue means the record is dropped"""
+
+    def __init__(self, log_queue, component):
+        super().__init__(log_queue)
+        self.component = component
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and context on the calling thread; the listener formats the rest
+        record.msg = truncate(record.getMessage(), LOG_MAX_FIELD * 8)
+        record.args = None
+        record.component = self.component
+        record.request_id = request_id_var.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, as promtail's json stage expects"""
+
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "component": getattr(record, "component", None),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRS and key not in ("component", "request_id"):
+                entry[key] = value if isinstance(value, (int, float, bool)) or value is None else truncate(value)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextFormatter(logging.Formatter):
+    """Human-readable lines for local runs (LOG_FORMAT=text)"""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(component)s %(name)s [%(request_id)s] %(message)s")
+
+_listener = None
+
+def configure_logging(component):
+    """Route the root logger through a bounded queue; call once at process start"""
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+
+    queue_handler = DroppingQueueHandler(log_queue, component)
+    queue_handler.addFilter(SamplingFilter(LOG_SAMPLE))
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # uvicorn installs its own stream handlers; send its records through the queue too
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+    # httpx logs every request at INFO, including periodic health checks
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = QueueListener(log_queue, stream_handler, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def dropped_records():
+    """Records discarded because the log queue was full"""
+    handler = logging.getLogger().handlers[0] if logging.getLogger().handlers else None
+    return getattr(handler, "dropped", 0)
+
+def stop_logging():
+    """Flush the queue on shutdown"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
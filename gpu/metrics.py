@@ -0,0 +1,33 @@
+"""Worker counters, exported by the API on /metrics.
+
+Each component increments fields of the Redis hash `metrics:{component}`;
+the API renders every such hash as Prometheus counters named
+`velesio_{component}_{field}`. Field names may carry labels, e.g.
+`tasks_dropped_total{endpoint="completion"}`.
+"""
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+async def incr(redis_client, component, field, amount=1):
+    """Add to a counter; floats (e.g. seconds) use HINCRBYFLOAT"""
+    if isinstance(amount, float):
+        await redis_client.hincrbyfloat(f"metrics:{component}", field, amount)
+    else:
+        await redis_client.hincrby(f"metrics:{component}", field, amount)
+
+async def drop_expired(redis_client, component, task):
+    """True if the task's deadline has passed: nobody waits for it any more, so skip the backend.
+
+    The error result is kept briefly for async jobs, whose API side still collects it.
+    """
+    deadline = task.get("deadline")
+    if not deadline or time.time() <= deadline:
+        return False
+    endpoint = task.get("endpoint", "unknown")
+    logger.warning(f"Dropping task {task['id']} ({endpoint}): deadline passed {time.time() - deadline:.1f}s ago")
+    await redis_client.set(f"result:{task['id']}", json.dumps({"error": "Deadline exceeded before the task started"}), ex=60)
+    await incr(redis_client, component, f'tasks_dropped_total{{endpoint="{endpoint}"}}')
+    return True
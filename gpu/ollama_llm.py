@@ -2,9 +2,14 @@ import os, time, requests, json, logging, asyncio
 from redis import Redis
 import redis.asyncio as redis
 from rq import Worker, Queue, Connection
+from streaming import SSE, NDJSON, StreamWriter, backend_lines, dumps, loads, frame, encode_frame
+from scheduling import next_task, PreemptionWatch, requeue
+from logsetup import configure_logging, set_request_id, truncate
+from metrics import drop_expired, incr
+from embeddings import encode_embeddings
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("ollama")
 logger = logging.getLogger(__name__)
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
@@ -42,34 +47,39 @@ def tokenize_text(content: str):
         logger.error(f"Error tokenizing: {str(e)}")
         return {"error": str(e)}
 
+def completion_request(request_dict, stream):
+    """Ollama /api/generate request for a Unity completion request"""
+    ollama_request = {
+        "model": request_dict.get("model", OLLAMA_MODEL),
+        "prompt": request_dict["prompt"],
+        "stream": stream,
+        "options": {
+            "temperature": request_dict.get("temperature", 0.2),
+            "top_k": request_dict.get("top_k", 40),
+            "top_p": request_dict.get("top_p", 0.9),
+            "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
+            "seed": request_dict.get("seed", 0),
+            "num_predict": request_dict.get("n_predict", -1),
+        }
+    }
+    
+    # Add stop sequences if provided
+    if request_dict.get("stop"):
+        stop_sequences = request_dict["stop"]
+        if isinstance(stop_sequences, str):
+            stop_sequences = [stop_sequences]
+        ollama_request["options"]["stop"] = stop_sequences
+    return ollama_request
+
 def handle_completion(request_dict):
     """Handle completion requests from Unity, converting to Ollama format"""
     try:
-        logger.info(f"Processing Ollama completion request: {request_dict}")
+        logger.info(f"Processing Ollama completion request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Convert Unity/LLaMA.cpp request to Ollama format
-        ollama_request = {
-            "model": request_dict.get("model", OLLAMA_MODEL),
-            "prompt": request_dict["prompt"],
-            "stream": False,
-            "options": {
-                "temperature": request_dict.get("temperature", 0.2),
-                "top_k": request_dict.get("top_k", 40),
-                "top_p": request_dict.get("top_p", 0.9),
-                "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
-                "seed": request_dict.get("seed", 0),
-                "num_predict": request_dict.get("n_predict", -1),
-            }
-        }
-        
-        # Add stop sequences if provided
-        if request_dict.get("stop"):
-            stop_sequences = request_dict["stop"]
-            if isinstance(stop_sequences, str):
-                stop_sequences = [stop_sequences]
-            ollama_request["options"]["stop"] = stop_sequences
+        ollama_request = completion_request(request_dict, stream=False)
         
-        logger.info(f"Sending to Ollama server: {ollama_request}")
+        logger.info(f"Sending to Ollama server: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send request to Ollama server
         response = requests.post(
@@ -81,17 +91,18 @@ def handle_completion(request_dict):
         
         # Parse JSON response
         result = response.json()
-        logger.info(f"Ollama server response: {result}")
+        logger.info(f"Ollama server response: {truncate(result)}", extra={"event": "payload"})
         
         # Convert response for Unity (matching LLaMA.cpp format)
         unity_result = {
             "content": result.get("response", ""),
             "multimodal": False,
             "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
-            "stop": result.get("done", True)
+            "stop": result.get("done", True),
+            "tokens_predicted": result.get("eval_count", 0)
         }
         
-        logger.info(f"Returning Unity result: {unity_result}")
+        logger.info(f"Returning Unity result: {truncate(unity_result)}", extra={"event": "payload"})
         return unity_result
                 
     except requests.exceptions.RequestException as e:
@@ -104,7 +115,7 @@ def handle_completion(request_dict):
 def handle_chat(request_dict):
     """Handle Ollama-native chat requests"""
     try:
-        logger.info(f"Processing Ollama chat request: {request_dict}")
+        logger.info(f"Processing Ollama chat request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Request is already in Ollama format, pass through
         ollama_request = {
@@ -123,7 +134,7 @@ def handle_chat(request_dict):
         if request_dict.get("tools"):
             ollama_request["tools"] = request_dict["tools"]
         
-        logger.info(f"Sending to Ollama server: {ollama_request}")
+        logger.info(f"Sending to Ollama server: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send request to Ollama server
         response = requests.post(
@@ -135,7 +146,7 @@ def handle_chat(request_dict):
         
         # Return response in Ollama format
         result = response.json()
-        logger.info(f"Ollama chat response: {result}")
+        logger.info(f"Ollama chat response: {truncate(result)}", extra={"event": "payload"})
         return result
                 
     except requests.exceptions.RequestException as e:
@@ -145,39 +156,44 @@ def handle_chat(request_dict):
         logger.error(f"Error in chat endpoint: {str(e)}")
         return {"error": f"Error with chat: {str(e)}"}
 
+def generate_request(request_dict, stream):
+    """Ollama /api/generate request for an Ollama-native generate request"""
+    ollama_request = {
+        "model": request_dict.get("model", OLLAMA_MODEL),
+        "prompt": request_dict["prompt"],
+        "stream": stream,
+    }
+    
+    # Add optional parameters
+    if request_dict.get("suffix"):
+        ollama_request["suffix"] = request_dict["suffix"]
+    if request_dict.get("images"):
+        ollama_request["images"] = request_dict["images"]
+    if request_dict.get("format"):
+        ollama_request["format"] = request_dict["format"]
+    if request_dict.get("options"):
+        ollama_request["options"] = request_dict["options"]
+    if request_dict.get("system"):
+        ollama_request["system"] = request_dict["system"]
+    if request_dict.get("template"):
+        ollama_request["template"] = request_dict["template"]
+    if request_dict.get("raw"):
+        ollama_request["raw"] = request_dict["raw"]
+    if request_dict.get("keep_alive"):
+        ollama_request["keep_alive"] = request_dict["keep_alive"]
+    if request_dict.get("context"):
+        ollama_request["context"] = request_dict["context"]
+    return ollama_request
+
 def handle_generate(request_dict):
     """Handle Ollama-native generate/completion requests"""
     try:
-        logger.info(f"Processing Ollama generate request: {request_dict}")
+        logger.info(f"Processing Ollama generate request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Request is already in Ollama format, pass through
-        ollama_request = {
-            "model": request_dict.get("model", OLLAMA_MODEL),
-            "prompt": request_dict["prompt"],
-            "stream": False
-        }
+        ollama_request = generate_request(request_dict, stream=False)
         
-        # Add optional parameters
-        if request_dict.get("suffix"):
-            ollama_request["suffix"] = request_dict["suffix"]
-        if request_dict.get("images"):
-            ollama_request["images"] = request_dict["images"]
-        if request_dict.get("format"):
-            ollama_request["format"] = request_dict["format"]
-        if request_dict.get("options"):
-            ollama_request["options"] = request_dict["options"]
-        if request_dict.get("system"):
-            ollama_request["system"] = request_dict["system"]
-        if request_dict.get("template"):
-            ollama_request["template"] = request_dict["template"]
-        if request_dict.get("raw"):
-            ollama_request["raw"] = request_dict["raw"]
-        if request_dict.get("keep_alive"):
-            ollama_request["keep_alive"] = request_dict["keep_alive"]
-        if request_dict.get("context"):
-            ollama_request["context"] = request_dict["context"]
-        
-        logger.info(f"Sending to Ollama server: {ollama_request}")
+        logger.info(f"Sending to Ollama server: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send request to Ollama server
         response = requests.post(
@@ -189,7 +205,7 @@ def handle_generate(request_dict):
         
         # Return response in Ollama format
         result = response.json()
-        logger.info(f"Ollama generate response: {result}")
+        logger.info(f"Ollama generate response: {truncate(result)}", extra={"event": "payload"})
         return result
                 
     except requests.exceptions.RequestException as e:
@@ -199,6 +215,81 @@ def handle_generate(request_dict):
         logger.error(f"Error in generate endpoint: {str(e)}")
         return {"error": f"Error with generate: {str(e)}"}
 
+async def handle_preemptible(task):
+    """Non-streamed completion/generate of a low-priority task, yielding to interactive tasks (see scheduling.py).
+
+    Ollama cannot continue a templated prompt from partial output, so only raw generate requests
+    resume where they stopped; others are requeued to start over and their tokens count as lost.
+    Returns the result, or None once requeued.
+    """
+    request_dict, endpoint = task["data"], task["endpoint"]
+    resume = task.get("resume") or {"content": "", "tokens": 0}
+    try:
+        logger.info(f"Processing preemptible {endpoint} request: {truncate(request_dict)}", extra={"event": "payload"})
+        if endpoint == "completion":
+            ollama_request = completion_request(request_dict, stream=True)
+        else:
+            ollama_request = generate_request(request_dict, stream=True)
+        resumable = bool(ollama_request.get("raw"))
+        if resume["content"]:
+            ollama_request["prompt"] += resume["content"]
+            options = dict(ollama_request.get("options") or {})
+            if options.get("num_predict", -1) > 0:
+                options["num_predict"] = max(1, options["num_predict"] - resume["tokens"])
+            ollama_request["options"] = options
+
+        watch = PreemptionWatch(redis_client, "gpu_tasks", task)
+        response = requests.post(f"{OLLAMA_SERVER}/api/generate", json=ollama_request, stream=True, timeout=300)
+        response.raise_for_status()
+        parts, final = [], {}
+        try:
+            async for line in backend_lines(response):
+                if not line:
+                    continue
+                data = loads(line)
+                if data.get("done"):
+                    final = data
+                    break
+                parts.append(data.get("response", ""))
+                if await watch.should_yield():
+                    # Closing the connection stops the generation in Ollama
+                    if resumable:
+                        task["resume"] = {"content": resume["content"] + "".join(parts), "tokens": resume["tokens"] + len(parts)}
+                    else:
+                        await incr(redis_client, "ollama", "preempted_tokens_lost_total", len(parts))
+                    await requeue(redis_client, "gpu_tasks", task)
+                    await incr(redis_client, "ollama", "tasks_preempted_total")
+                    await incr(redis_client, "ollama", "preempted_tokens_total", len(parts))
+                    logger.info(f"Preempted task {task['id']} after {len(parts)} tokens; requeued{'' if resumable else ' to start over'}")
+                    return None
+        finally:
+            response.close()
+
+        content = resume["content"] + "".join(parts) + final.get("response", "")
+        if endpoint == "completion":
+            result = {
+                "content": content,
+                "multimodal": False,
+                "slot_id": request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0,
+                "stop": True,
+                "tokens_predicted": resume["tokens"] + final.get("eval_count", len(parts)),
+            }
+        else:
+            result = {**final, "response": content}
+            if resume["tokens"]:
+                result["eval_count"] = final.get("eval_count", 0) + resume["tokens"]
+        if task.get("preemptions"):
+            result["preemptions"] = task["preemptions"]
+        logger.info(f"Returning preemptible {endpoint} result: {truncate(result)}", extra={"event": "payload"})
+        return result
+
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request error in {endpoint}: {str(e)}")
+        return {"error": f"Ollama server error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Error in {endpoint} endpoint: {str(e)}")
+        return {"error": f"Error with {endpoint}: {str(e)}"}
+
 def handle_tags():
     """List available models from Ollama server"""
     try:
@@ -226,7 +317,7 @@ def handle_tags():
 def handle_embed(request_dict):
     """Handle embeddings generation requests"""
     try:
-        logger.info(f"Processing Ollama embed request: {request_dict}")
+        logger.info(f"Processing Ollama embed request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Request is already in Ollama format, pass through
         ollama_request = {
@@ -242,7 +333,7 @@ def handle_embed(request_dict):
         if request_dict.get("keep_alive"):
             ollama_request["keep_alive"] = request_dict["keep_alive"]
         
-        logger.info(f"Sending to Ollama server: {ollama_request}")
+        logger.info(f"Sending to Ollama server: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send request to Ollama server
         response = requests.post(
@@ -252,10 +343,10 @@ def handle_embed(request_dict):
         )
         response.raise_for_status()
         
-        # Return response in Ollama format
-        result = response.json()
+        # Return response in Ollama format, packed if the request asked for it
+        result = loads(response.content)
         logger.info(f"Ollama embed response: {len(result.get('embeddings', []))} embeddings")
-        return result
+        return encode_embeddings(result, request_dict)
                 
     except requests.exceptions.RequestException as e:
         logger.error(f"Request error in embed: {str(e)}")
@@ -264,39 +355,19 @@ def handle_embed(request_dict):
         logger.error(f"Error in embed endpoint: {str(e)}")
         return {"error": f"Error with embed: {str(e)}"}
 
-async def handle_generate_streaming(request_dict, task_id):
+def is_final_chunk(raw):
+    """Cheap check for Ollama's closing "done": true line without parsing every token"""
+    return '"done":true' in raw or '"done": true' in raw
+
+async def handle_generate_streaming(request_dict, task_id, stream_format=NDJSON):
     """Handle streaming Ollama generate requests"""
     try:
-        logger.info(f"Processing streaming Ollama generate request: {request_dict}")
+        logger.info(f"Processing streaming Ollama generate request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Request is already in Ollama format
-        ollama_request = {
-            "model": request_dict.get("model", OLLAMA_MODEL),
-            "prompt": request_dict["prompt"],
-            "stream": True
-        }
-        
-        # Add optional parameters
-        if request_dict.get("suffix"):
-            ollama_request["suffix"] = request_dict["suffix"]
-        if request_dict.get("images"):
-            ollama_request["images"] = request_dict["images"]
-        if request_dict.get("format"):
-            ollama_request["format"] = request_dict["format"]
-        if request_dict.get("options"):
-            ollama_request["options"] = request_dict["options"]
-        if request_dict.get("system"):
-            ollama_request["system"] = request_dict["system"]
-        if request_dict.get("template"):
-            ollama_request["template"] = request_dict["template"]
-        if request_dict.get("raw"):
-            ollama_request["raw"] = request_dict["raw"]
-        if request_dict.get("keep_alive"):
-            ollama_request["keep_alive"] = request_dict["keep_alive"]
-        if request_dict.get("context"):
-            ollama_request["context"] = request_dict["context"]
+        ollama_request = generate_request(request_dict, stream=True)
         
-        logger.info(f"Sending streaming generate request to Ollama: {ollama_request}")
+        logger.info(f"Sending streaming generate request to Ollama: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send streaming request to Ollama server
         response = requests.post(
@@ -307,48 +378,49 @@ async def handle_generate_streaming(request_dict, task_id):
         )
         response.raise_for_status()
         
-        # Stream the response tokens back through Redis
+        # Ollama already emits one JSON document per line; forward each line as-is
+        writer = StreamWriter.for_request(redis_client, task_id, request_dict)
         token_count = 0
-        for line in response.iter_lines():
+        async for line in backend_lines(response):
             if line:
-                try:
-                    chunk = json.loads(line)
-                    
-                    # Extract response content for streaming
-                    content = chunk.get("response", "")
-                    
-                    if content:
-                        # Push token to Redis stream
-                        stream_chunk = {
-                            "content": content
-                        }
-                        await redis_client.rpush(f"stream:{task_id}", json.dumps(stream_chunk))
-                        token_count += 1
-                    
-                    # Check if this is the final chunk
-                    if chunk.get("done", False):
-                        logger.info(f"Ollama generate streaming complete: {token_count} tokens")
-                        # Store final result with metadata
-                        final_result = {
-                            "response": "",  # Content already streamed
-                            "context": chunk.get("context", []),
-                            "total_duration": chunk.get("total_duration", 0),
-                            "load_duration": chunk.get("load_duration", 0),
-                            "prompt_eval_count": chunk.get("prompt_eval_count", 0),
-                            "prompt_eval_duration": chunk.get("prompt_eval_duration", 0),
-                            "eval_count": chunk.get("eval_count", token_count),
-                            "eval_duration": chunk.get("eval_duration", 0)
-                        }
-                        await redis_client.set(
-                            f"result:{task_id}",
-                            json.dumps({"data": final_result}),
-                            ex=300
-                        )
-                        break
-                        
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse streaming chunk: {e}")
-                    continue
+                raw = line.decode("utf-8")
+                await writer.push(frame(raw, stream_format))
+                token_count += 1
+                
+                # Only the final chunk needs parsing, for the result metadata
+                if is_final_chunk(raw):
+                    try:
+                        chunk = loads(raw)
+                    except json.JSONDecodeError as e:
+                        logger.error(f"Failed to parse final streaming chunk: {e}")
+                        chunk = {}
+                    await writer.close()
+                    logger.info(f"Ollama generate streaming complete: {token_count} chunks in {writer.writes} writes")
+                    # Store final result with metadata
+                    final_result = {
+                        "response": "",  # Content already streamed
+                        "streamed": True,
+                        "context": chunk.get("context", []),
+                        "total_duration": chunk.get("total_duration", 0),
+                        "load_duration": chunk.get("load_duration", 0),
+                        "prompt_eval_count": chunk.get("prompt_eval_count", 0),
+                        "prompt_eval_duration": chunk.get("prompt_eval_duration", 0),
+                        "eval_count": chunk.get("eval_count", token_count),
+                        "eval_duration": chunk.get("eval_duration", 0)
+                    }
+                    await redis_client.set(
+                        f"result:{task_id}",
+                        dumps({"data": final_result}),
+                        ex=300
+                    )
+                    break
+        else:
+            # The backend closed the stream without a final chunk
+            await redis_client.set(
+                f"result:{task_id}",
+                dumps({"error": "Ollama stream ended before completion"}),
+                ex=300
+            )
         
         logger.info(f"Ollama generate streaming completed for task {task_id}")
         
@@ -357,7 +429,7 @@ async def handle_generate_streaming(request_dict, task_id):
         logger.error(error_msg)
         await redis_client.set(
             f"result:{task_id}",
-            json.dumps({"error": error_msg}),
+            dumps({"error": error_msg}),
             ex=300
         )
     except Exception as e:
@@ -365,14 +437,14 @@ async def handle_generate_streaming(request_dict, task_id):
         logger.error(error_msg)
         await redis_client.set(
             f"result:{task_id}",
-            json.dumps({"error": error_msg}),
+            dumps({"error": error_msg}),
             ex=300
         )
 
-async def handle_chat_streaming(request_dict, task_id):
+async def handle_chat_streaming(request_dict, task_id, stream_format=NDJSON):
     """Handle streaming Ollama chat requests"""
     try:
-        logger.info(f"Processing streaming Ollama chat request: {request_dict}")
+        logger.info(f"Processing streaming Ollama chat request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Request is already in Ollama format
         ollama_request = {
@@ -391,7 +463,7 @@ async def handle_chat_streaming(request_dict, task_id):
         if request_dict.get("tools"):
             ollama_request["tools"] = request_dict["tools"]
         
-        logger.info(f"Sending streaming chat request to Ollama: {ollama_request}")
+        logger.info(f"Sending streaming chat request to Ollama: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send streaming request to Ollama server
         response = requests.post(
@@ -402,49 +474,53 @@ async def handle_chat_streaming(request_dict, task_id):
         )
         response.raise_for_status()
         
-        # Stream the response tokens back through Redis
+        # Ollama already emits one JSON document per line; forward each line as-is
+        writer = StreamWriter.for_request(redis_client, task_id, request_dict)
         token_count = 0
-        for line in response.iter_lines():
+        include_content = request_dict.get("include_content")
+        parts = []
+        async for line in backend_lines(response):
             if line:
-                try:
-                    chunk = json.loads(line)
-                    
-                    # Extract message content for streaming
-                    message = chunk.get("message", {})
-                    content = message.get("content", "")
-                    
-                    if content:
-                        # Push token to Redis stream
-                        stream_chunk = {
-                            "content": content,
-                            "role": message.get("role", "assistant")
-                        }
-                        await redis_client.rpush(f"stream:{task_id}", json.dumps(stream_chunk))
-                        token_count += 1
-                    
-                    # Check if this is the final chunk
-                    if chunk.get("done", False):
-                        logger.info(f"Ollama chat streaming complete: {token_count} tokens")
-                        # Store final result with metadata
-                        final_result = {
-                            "content": "",  # Content already streamed
-                            "total_duration": chunk.get("total_duration", 0),
-                            "load_duration": chunk.get("load_duration", 0),
-                            "prompt_eval_count": chunk.get("prompt_eval_count", 0),
-                            "prompt_eval_duration": chunk.get("prompt_eval_duration", 0),
-                            "eval_count": chunk.get("eval_count", token_count),
-                            "eval_duration": chunk.get("eval_duration", 0)
-                        }
-                        await redis_client.set(
-                            f"result:{task_id}",
-                            json.dumps({"data": final_result}),
-                            ex=300
-                        )
-                        break
-                        
-                except json.JSONDecodeError as e:
-                    logger.error(f"Failed to parse streaming chunk: {e}")
-                    continue
+                raw = line.decode("utf-8")
+                await writer.push(frame(raw, stream_format))
+                token_count += 1
+                if include_content:
+                    # Sessions record the reply, the one case that parses every chunk
+                    parts.append(loads(raw).get("message", {}).get("content", ""))
+                
+                # Only the final chunk needs parsing, for the result metadata
+                if is_final_chunk(raw):
+                    try:
+                        chunk = loads(raw)
+                    except json.JSONDecodeError as e:
+                        logger.error(f"Failed to parse final streaming chunk: {e}")
+                        chunk = {}
+                    await writer.close()
+                    logger.info(f"Ollama chat streaming complete: {token_count} chunks in {writer.writes} writes")
+                    # Store final result with metadata
+                    final_result = {
+                        "content": "".join(parts),  # already streamed; only kept with include_content
+                        "streamed": True,
+                        "total_duration": chunk.get("total_duration", 0),
+                        "load_duration": chunk.get("load_duration", 0),
+                        "prompt_eval_count": chunk.get("prompt_eval_count", 0),
+                        "prompt_eval_duration": chunk.get("prompt_eval_duration", 0),
+                        "eval_count": chunk.get("eval_count", token_count),
+                        "eval_duration": chunk.get("eval_duration", 0)
+                    }
+                    await redis_client.set(
+                        f"result:{task_id}",
+                        dumps({"data": final_result}),
+                        ex=300
+                    )
+                    break
+        else:
+            # The backend closed the stream without a final chunk
+            await redis_client.set(
+                f"result:{task_id}",
+                dumps({"error": "Ollama stream ended before completion"}),
+                ex=300
+            )
         
         logger.info(f"Ollama chat streaming completed for task {task_id}")
         
@@ -453,7 +529,7 @@ async def handle_chat_streaming(request_dict, task_id):
         logger.error(error_msg)
         await redis_client.set(
             f"result:{task_id}",
-            json.dumps({"error": error_msg}),
+            dumps({"error": error_msg}),
             ex=300
         )
     except Exception as e:
@@ -461,48 +537,29 @@ async def handle_chat_streaming(request_dict, task_id):
         logger.error(error_msg)
         await redis_client.set(
             f"result:{task_id}",
-            json.dumps({"error": error_msg}),
+            dumps({"error": error_msg}),
             ex=300
         )
 
 def handle_slots(request_dict):
     """Handle slot operations (save/restore cache) - Ollama doesn't support this"""
     try:
-        logger.info(f"Processing slots request (Ollama mode - not supported): {request_dict}")
+        logger.info(f"Processing slots request (Ollama mode - not supported): {truncate(request_dict)}", extra={"event": "payload"})
         # Return a simple response since Ollama doesn't have cache functionality
         return {"filename": request_dict.get("filepath", ""), "note": "Ollama mode: caching not supported"}
     except Exception as e:
         logger.error(f"Error in slots handler: {str(e)}")
         return {"error": f"Error in slots: {str(e)}"}
 
-async def handle_completion_streaming(request_dict, task_id):
+async def handle_completion_streaming(request_dict, task_id, stream_format=SSE):
     """Handle streaming completion requests from Unity"""
     try:
-        logger.info(f"Processing streaming Ollama completion request: {request_dict}")
+        logger.info(f"Processing streaming Ollama completion request: {truncate(request_dict)}", extra={"event": "payload"})
         
         # Convert Unity request to Ollama format with streaming
-        ollama_request = {
-            "model": request_dict.get("model", OLLAMA_MODEL),
-            "prompt": request_dict["prompt"],
-            "stream": True,
-            "options": {
-                "temperature": request_dict.get("temperature", 0.2),
-                "top_k": request_dict.get("top_k", 40),
-                "top_p": request_dict.get("top_p", 0.9),
-                "repeat_penalty": request_dict.get("repeat_penalty", 1.1),
-                "seed": request_dict.get("seed", 0),
-                "num_predict": request_dict.get("n_predict", -1),
-            }
-        }
-        
-        # Add stop sequences if provided
-        if request_dict.get("stop"):
-            stop_sequences = request_dict["stop"]
-            if isinstance(stop_sequences, str):
-                stop_sequences = [stop_sequences]
-            ollama_request["options"]["stop"] = stop_sequences
+        ollama_request = completion_request(request_dict, stream=True)
         
-        logger.info(f"Sending streaming request to Ollama: {ollama_request}")
+        logger.info(f"Sending streaming request to Ollama: {truncate(ollama_request)}", extra={"event": "payload"})
         
         # Send streaming request to Ollama server
         response = requests.post(
@@ -513,20 +570,31 @@ async def handle_completion_streaming(request_dict, task_id):
         )
         response.raise_for_status()
         
-        # Store the stream key in Redis for client polling
-        stream_key = f"stream:{task_id}"
+        writer = StreamWriter.for_request(redis_client, task_id, request_dict)
+        slot_id = request_dict.get("id_slot", -1) if request_dict.get("id_slot", -1) >= 0 else 0
+        parts = []  # joined once at the end; += on a str is quadratic for long generations
+        done = False
+        final = {}  # the done chunk, which carries Ollama's eval_count
         
-        # Process the streaming response
-        for line in response.iter_lines():
+        # Convert Ollama chunks to Unity frames once; the API forwards them verbatim
+        async for line in backend_lines(response):
             if line:
                 try:
-                    chunk = json.loads(line)
+                    chunk = loads(line)
+                    done = chunk.get("done", False)
+                    token_content = chunk.get("response", "")
+                    parts.append(token_content)
                     
-                    # Store chunk in Redis
-                    await redis_client.rpush(stream_key, json.dumps(chunk))
-                    await redis_client.expire(stream_key, 300)  # 5 min TTL
+                    unity_chunk = {
+                        "content": token_content,
+                        "multimodal": False,
+                        "slot_id": slot_id,
+                        "stop": done
+                    }
+                    await writer.push(encode_frame(unity_chunk, stream_format))
                     
-                    if chunk.get("done", False):
+                    if done:
+                        final = chunk
                         logger.info(f"Streaming completed for task {task_id}")
                         break
                         
@@ -534,18 +602,33 @@ async def handle_completion_streaming(request_dict, task_id):
                     logger.error(f"Failed to parse streaming chunk: {e}")
                     continue
         
-        # Mark as complete
-        await redis_client.set(f"stream:{task_id}:complete", "true", ex=300)
+        if not done:
+            # The client needs a stop frame even if Ollama ended the stream without one
+            stop_chunk = {"content": "", "multimodal": False, "slot_id": slot_id, "stop": True}
+            await writer.push(encode_frame(stop_chunk, stream_format))
+        await writer.close()
+        # The client already has every token, so the result only carries metadata
+        final_result = {
+            "multimodal": False,
+            "slot_id": slot_id,
+            "stop": True,
+            "streamed": True,
+            # Chunks are not tokens (the done chunk is usually empty); fall back to counting them only without one
+            "tokens_predicted": final.get("eval_count", len(parts) - bool(final))
+        }
+        if request_dict.get("include_content"):
+            final_result["content"] = "".join(parts)
+        await redis_client.set(f"result:{task_id}", dumps({"data": final_result}), ex=300)
         
         return {"status": "streaming_complete", "task_id": task_id}
                 
     except requests.exceptions.RequestException as e:
         logger.error(f"Request error in streaming completion: {str(e)}")
-        await redis_client.set(f"stream:{task_id}:error", str(e), ex=300)
+        await redis_client.set(f"result:{task_id}", dumps({"error": f"Ollama streaming error: {str(e)}"}), ex=300)
         return {"error": f"Ollama streaming error: {str(e)}"}
     except Exception as e:
         logger.error(f"Error in streaming completion: {str(e)}")
-        await redis_client.set(f"stream:{task_id}:error", str(e), ex=300)
+        await redis_client.set(f"result:{task_id}", dumps({"error": f"Error with streaming: {str(e)}"}), ex=300)
         return {"error": f"Error with streaming: {str(e)}"}
 
 async def process_gpu_tasks():
@@ -555,60 +638,70 @@ async def process_gpu_tasks():
     while True:
         try:
             # Check for new tasks
-            task_data = await redis_client.brpop("gpu_tasks", timeout=1)
-            if task_data:
-                task_json = task_data[1]
-                task = json.loads(task_json)
+            task_json = await next_task(redis_client, "gpu_tasks")
+            if task_json:
+                task = loads(task_json)
                 task_id = task["id"]
                 endpoint = task["endpoint"]
+                set_request_id(task.get("request_id") or task_id)
+                if await drop_expired(redis_client, "ollama", task):
+                    continue
                 request_data = task["data"]
                 
                 logger.info(f"Processing task {task_id} for endpoint {endpoint}")
                 
                 if endpoint == "completion":
                     if request_data.get("stream", True):
-                        await handle_completion_streaming(request_data, task_id)
+                        await handle_completion_streaming(request_data, task_id, task.get("stream_format", SSE))
+                    elif task.get("priority") == "low":
+                        result = await handle_preemptible(task)
+                        if result is not None:
+                            await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                     else:
                         # Handle non-streaming completion
                         result = handle_completion(request_data)
-                        await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                        await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "chat":
                     if request_data.get("stream", False):
-                        await handle_chat_streaming(request_data, task_id)
+                        await handle_chat_streaming(request_data, task_id, task.get("stream_format", NDJSON))
                     else:
                         # Handle non-streaming chat
                         result = handle_chat(request_data)
-                        await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                        await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "generate":
                     if request_data.get("stream", False):
-                        await handle_generate_streaming(request_data, task_id)
+                        await handle_generate_streaming(request_data, task_id, task.get("stream_format", NDJSON))
+                    elif task.get("priority") == "low":
+                        result = await handle_preemptible(task)
+                        if result is not None:
+                            await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                     else:
                         # Handle non-streaming generate
                         result = handle_generate(request_data)
-                        await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                        await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "tags":
                     # Handle tags (list models) request
                     result = handle_tags()
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "embed":
                     # Handle embeddings request
                     result = handle_embed(request_data)
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "template":
                     # Handle template request
                     result = get_template()
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "tokenize":
                     # Handle tokenize request
                     result = tokenize_text(request_data["content"])
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 elif endpoint == "slots":
                     # Handle slots request
                     result = handle_slots(request_data)
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"data": result}), ex=300)
                 else:
                     logger.warning(f"Unknown endpoint: {endpoint}")
-                    await redis_client.set(f"result:{task_id}", json.dumps({"error": f"Unknown endpoint: {endpoint}"}), ex=300)
+                    await redis_client.set(f"result:{task_id}", dumps({"error": f"Unknown endpoint: {endpoint}"}), ex=300)
         
         except Exception as e:
             logger.error(f"Error processing GPU task: {e}")
@@ -0,0 +1,71 @@
+"""Task intake for the LLM workers, matching the API's SCHEDULER_POLICY.
+
+fifo (default): BRPOP the `gpu_tasks` list. sjf: pop the lowest-scored task
+from the `gpu_tasks:sjf` sorted set, where the API ranks tasks by enqueue time
+plus estimated cost (see api/scheduler.py). Under sjf, anything still pushed to
+the plain list is taken first, so no task is stranded while the API and
+workers switch policy.
+
+Low-priority tasks (batch lines) wait on `gpu_tasks:low` and are only taken
+when no interactive task waits. While one runs, the worker polls for
+interactive arrivals every PREEMPT_CHECK_INTERVAL seconds; when one arrives it
+aborts the generation, keeps the partial output in the envelope's "resume"
+field and pushes the task back to the front of the low lane. After PREEMPT_MAX
+preemptions a task runs to the end, so batches always progress.
+"""
+import os
+import time
+from streaming import dumps
+
+SCHEDULER_POLICY = os.getenv("SCHEDULER_POLICY", "fifo").lower()
+PREEMPT_CHECK_INTERVAL = float(os.getenv("PREEMPT_CHECK_INTERVAL", "0.5"))
+PREEMPT_MAX = int(os.getenv("PREEMPT_MAX", "3"))  # 0 disables preemption
+
+def low_queue(queue):
+    return f"{queue}:low"
+
+async def next_task(redis_client, queue, timeout=1):
+    """Raw JSON of the next task, or None after `timeout` seconds"""
+    if SCHEDULER_POLICY != "sjf":
+        popped = await redis_client.brpop([queue, low_queue(queue)], timeout=timeout)
+        return popped[1] if popped else None
+    task = await redis_client.rpop(queue)
+    if task is not None:
+        return task
+    popped = await redis_client.zpopmin(f"{queue}:sjf")
+    if popped:
+        return popped[0][0]
+    task = await redis_client.rpop(low_queue(queue))
+    if task is not None:
+        return task
+    popped = await redis_client.bzpopmin(f"{queue}:sjf", timeout=timeout)
+    return popped[1] if popped else None
+
+async def interactive_waiting(redis_client, queue) -> bool:
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.llen(queue)
+        pipe.zcard(f"{queue}:sjf")
+        return sum(await pipe.execute()) > 0
+
+def preemptible(task) -> bool:
+    return task.get("priority") == "low" and task.get("preemptions", 0) < PREEMPT_MAX
+
+class PreemptionWatch:
+    """Rate-limited check, during a low-priority generation, for interactive tasks waiting on `queue`"""
+
+    def __init__(self, redis_client, queue, task):
+        self.redis = redis_client
+        self.queue = queue
+        self.enabled = preemptible(task)
+        self.next_check = time.time() + PREEMPT_CHECK_INTERVAL
+
+    async def should_yield(self) -> bool:
+        if not self.enabled or time.time() < self.next_check:
+            return False
+        self.next_check = time.time() + PREEMPT_CHECK_INTERVAL
+        return await interactive_waiting(self.redis, self.queue)
+
+async def requeue(redis_client, queue, task):
+    """Put a preempted task back at the front of the low lane"""
+    task["preemptions"] = task.get("preemptions", 0) + 1
+    await redis_client.rpush(low_queue(queue), dumps(task))
@@ -1,92 +1,350 @@
-import os, json, logging, asyncio, requests, base64
+import os, json, time, logging, asyncio, base64, hashlib
+import httpx
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
 from PIL import Image
 import redis.asyncio as redis
+from a1111_pool import A1111Pool, checkpoint_name, pool_urls
+from metrics import incr, drop_expired
+from logsetup import configure_logging, set_request_id, truncate
 
 # Set up logging
-logging.basicConfig(level=logging.INFO)
+configure_logging("sd")
 logger = logging.getLogger(__name__)
 
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PASS = os.getenv("REDIS_PASS", "")
 REDIS_URL = f"redis://:{REDIS_PASS}@{REDIS_HOST}:6379"
 A1111_URL = os.getenv("A1111_URL", "http://localhost:7860")
+SD_BLOB_TTL = int(os.getenv("SD_BLOB_TTL", "600"))
+IMAGE_ENCODE_WORKERS = int(os.getenv("IMAGE_ENCODE_WORKERS", "2"))
+# Coalescing of compatible txt2img tasks into one A1111 batch
+SD_BATCH_MAX = int(os.getenv("SD_BATCH_MAX", "4"))
+SD_BATCH_WAIT_MS = int(os.getenv("SD_BATCH_WAIT_MS", "0"))  # extra wait for partners; 0 only takes what is already queued
+SD_BATCH_SCAN = int(os.getenv("SD_BATCH_SCAN", "32"))  # queued tasks inspected per look-ahead
+# Checkpoint-aware scheduling: serve tasks for loaded checkpoints first, but never let a task wait longer than this
+SD_SWAP_MAX_AGE = float(os.getenv("SD_SWAP_MAX_AGE", "60"))
 
 redis_client = redis.from_url(REDIS_URL, decode_responses=True)
+blob_client = redis.from_url(REDIS_URL)  # raw image bytes, no decoding
+sd_pool = A1111Pool(pool_urls(A1111_URL))
 
-async def handle_sd_generation(request_dict):
-    """Handle Stable Diffusion generation requests"""
-    try:
-        logger.info(f"Processing SD request: {request_dict}")
-
-        # Default payload for A1111 API
-        payload = {
-            "prompt": "a cat",
-            "negative_prompt": "",
-            "steps": 20,
-            "cfg_scale": 7.0,
-            "width": 512,
-            "height": 512,
-            "sampler_name": "DPM++ 2M Karras",
-            "seed": -1,
-            "batch_size": 1,
-            "n_iter": 1
-        }
-        # Update with provided data
-        payload.update(request_dict)
-
-        logger.info(f"Sending to A1111 server: {payload}")
-
-        response = requests.post(url=f'{A1111_URL}/sdapi/v1/txt2img', json=payload, timeout=300)
-        response.raise_for_status()
-        r = response.json()
-
-        if "images" in r and r["images"]:
-            image_data = r['images'][0]
-            # The result is a base64 encoded string
-            return {"image_base64": image_data, "info": r.get("info", {})}
+async def store_blob(data, media_type="image/png"):
+    """Store image bytes under their SHA-256 and return the reference the API resolves"""
+    digest = hashlib.sha256(data).hexdigest()
+    key = f"blob:{digest}"
+    # Identical images share one key. nx/gt: never lower a TTL the API extended for a job or batch
+    if not await blob_client.set(key, data, ex=SD_BLOB_TTL, nx=True):
+        await blob_client.expire(key, SD_BLOB_TTL, gt=True)
+    return {"blob": digest, "media_type": media_type, "bytes": len(data)}
+
+# Output encoding options; the worker consumes these, A1111 never sees them
+ENCODE_OPTIONS = ("output_format", "quality", "max_size", "thumbnail_size")
+MEDIA_TYPES = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+
+# Encoding a 1024px image takes tens to hundreds of milliseconds of CPU, so it runs out of the event loop
+encode_pool = ProcessPoolExecutor(max_workers=IMAGE_ENCODE_WORKERS)
+
+def encode_image(png_bytes, output_format, quality, max_size, thumbnail_size):
+    """Re-encode A1111's PNG in the requested format and size; returns (image, thumbnail or None)"""
+    image = Image.open(BytesIO(png_bytes))
+    image.load()
+
+    def save(img):
+        out = BytesIO()
+        if output_format == "jpeg":
+            img.convert("RGB").save(out, "JPEG", quality=quality, optimize=True, progressive=True)
+        elif output_format == "webp":
+            img.save(out, "WEBP", quality=quality, method=4)
         else:
-            return {"error": "No images returned from A1111"}
+            img.save(out, "PNG")
+        return out.getvalue()
+
+    thumbnail = None
+    if thumbnail_size:
+        small = image.copy()
+        small.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+        thumbnail = save(small)
+
+    if max_size and max(image.size) > max_size:
+        image.thumbnail((max_size, max_size), Image.LANCZOS)
+        return save(image), thumbnail
+    if output_format == "png":
+        return png_bytes, thumbnail  # A1111 output as-is
+    return save(image), thumbnail
+
+async def encode_outputs(png_bytes, options):
+    """Encode and store the image (and thumbnail) the client asked for"""
+    output_format = (options.get("output_format") or "png").lower().replace("jpg", "jpeg")
+    quality = options.get("quality") or 90
+    max_size = options.get("max_size")
+    thumbnail_size = options.get("thumbnail_size")
+
+    if output_format == "png" and not max_size and not thumbnail_size:
+        return {"image": await store_blob(png_bytes)}
+
+    loop = asyncio.get_running_loop()
+    image, thumbnail = await loop.run_in_executor(encode_pool, encode_image, png_bytes, output_format, quality, max_size, thumbnail_size)
+    outputs = {"image": await store_blob(image, MEDIA_TYPES[output_format])}
+    if thumbnail is not None:
+        outputs["thumbnail"] = await store_blob(thumbnail, MEDIA_TYPES[output_format])
+    return outputs
+
+def sd_payload(request_dict):
+    """A1111 payload for a request, with the worker-only encoding options split off"""
+    request_dict = dict(request_dict)
+    encode_options = {key: request_dict.pop(key, None) for key in ENCODE_OPTIONS}
+
+    # Default payload for A1111 API
+    payload = {
+        "prompt": "a cat",
+        "negative_prompt": "",
+        "steps": 20,
+        "cfg_scale": 7.0,
+        "width": 512,
+        "height": 512,
+        "sampler_name": "DPM++ 2M Karras",
+        "seed": -1,
+        "batch_size": 1,
+        "n_iter": 1
+    }
+    # Update with provided data
+    payload.update(request_dict)
+    return payload, encode_options
+
+def batch_key(payload):
+    """Requests with equal keys can share one A1111 call; None if the request can't be batched.
+
+    The stock txt2img API takes a single prompt and a single seed per call (images get seed,
+    seed+1, ...), so prompts must match and seeded requests only join with consecutive seeds.
+    Other override_settings apply to the whole call, so only a pinned checkpoint can be shared.
+    """
+    overrides = dict(payload.get("override_settings") or {})
+    checkpoint = checkpoint_name(overrides.pop("sd_model_checkpoint", None))
+    if payload.get("batch_size", 1) != 1 or payload.get("n_iter", 1) != 1 or overrides:
+        return None
+    return (payload["prompt"], payload["negative_prompt"], payload["width"], payload["height"],
+            payload["steps"], payload["sampler_name"], payload["cfg_scale"], payload["seed"] == -1, checkpoint)
+
+def requested_checkpoint(task):
+    """Checkpoint a queued task pins via override_settings, or None to run on whatever is loaded"""
+    return checkpoint_name((task.get("data", {}).get("override_settings") or {}).get("sd_model_checkpoint"))
+
+async def switch_checkpoint(backend, checkpoint):
+    """Load a checkpoint explicitly, so the swap is timed and the model stays loaded for the next tasks.
+
+    Leaving it in override_settings would make A1111 swap back after every job.
+    """
+    previous = backend.checkpoint
+    started = time.monotonic()
+    response = await sd_pool.client.post(f"{backend.url}/sdapi/v1/options", json={"sd_model_checkpoint": checkpoint})
+    response.raise_for_status()
+    elapsed = time.monotonic() - started
+    backend.checkpoint = checkpoint
+    logger.info(f"Swapped {backend.url} from {previous} to {checkpoint} in {elapsed:.1f}s")
+    await incr(redis_client, "sd", "checkpoint_swaps_total")
+    await incr(redis_client, "sd", "checkpoint_swap_seconds_total", elapsed)
+
+def split_info(info, index):
+    """Generation info for one image of a batch"""
+    try:
+        parsed = json.loads(info)
+        seed = parsed["all_seeds"][index]
+    except (TypeError, ValueError, KeyError, IndexError):
+        return info
+    parsed.update({"seed": seed, "all_seeds": [seed], "batch_size": 1})
+    return json.dumps(parsed)
+
+async def handle_sd_batch(requests_batch):
+    """Run compatible (payload, encode_options) requests as one A1111 batch; one result per request"""
+    try:
+        payload = dict(requests_batch[0][0])
+        payload["batch_size"] = len(requests_batch)
+        if len(requests_batch) > 1:
+            payload["do_not_save_grid"] = True
+
+        overrides = dict(payload.get("override_settings") or {})
+        pinned = overrides.pop("sd_model_checkpoint", None)
+        if pinned:
+            payload["override_settings"] = overrides
+        async with sd_pool.acquire(pinned) as backend:
+            if pinned and not backend.has_checkpoint(pinned):
+                await switch_checkpoint(backend, pinned)
+            logger.info(f"Sending to A1111 server {backend.url}: {truncate(payload)}", extra={"event": "payload"})
+            response = await sd_pool.client.post(f"{backend.url}/sdapi/v1/txt2img", json=payload)
+            response.raise_for_status()
+            r = response.json()
 
-    except requests.exceptions.RequestException as e:
+        images = r.get("images") or []
+        if len(images) == len(requests_batch) + 1:
+            images = images[1:]  # grid image prepended by A1111's return_grid option
+        if len(images) < len(requests_batch):
+            return [{"error": "No images returned from A1111"}] * len(requests_batch)
+
+        results = []
+        for index, (_, encode_options) in enumerate(requests_batch):
+            # A1111 only speaks base64; decode once and keep raw bytes out of the result JSON
+            outputs = await encode_outputs(base64.b64decode(images[index]), encode_options)
+            info = split_info(r.get("info", {}), index) if len(requests_batch) > 1 else r.get("info", {})
+            results.append({**outputs, "info": info})
+        return results
+
+    except httpx.HTTPError as e:
         logger.error(f"Request error in SD generation: {str(e)}")
-        return {"error": f"A1111 server error: {str(e)}"}
+        return [{"error": f"A1111 server error: {str(e)}"}] * len(requests_batch)
     except Exception as e:
         logger.error(f"Error in SD generation: {str(e)}")
-        return {"error": f"Error with SD generation: {str(e)}"}
+        return [{"error": f"Error with SD generation: {str(e)}"}] * len(requests_batch)
+
+async def collect_batch(task, payload):
+    """Pull queued tasks that can share an A1111 call with `task`, waiting at most SD_BATCH_WAIT_MS"""
+    key = batch_key(payload)
+    batch = [task]
+    if key is None or SD_BATCH_MAX <= 1:
+        return batch
+
+    deadline = time.monotonic() + SD_BATCH_WAIT_MS / 1000
+    try:
+        while True:
+            # Oldest tasks sit at the tail (API LPUSHes, workers BRPOP)
+            for raw in reversed(await redis_client.lrange("sd_tasks", -SD_BATCH_SCAN, -1)):
+                try:
+                    candidate = json.loads(raw)
+                    if candidate.get("endpoint", "sd_generation") != "sd_generation":
+                        continue
+                    candidate_payload, _ = sd_payload(candidate["data"])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue  # malformed; left for the main loop to report
+                if batch_key(candidate_payload) != key:
+                    continue
+                if payload["seed"] != -1 and candidate_payload["seed"] != payload["seed"] + len(batch):
+                    continue
+                # LREM succeeds for exactly one worker, so a task is never run twice
+                if await redis_client.lrem("sd_tasks", 1, raw) and not await drop_expired(redis_client, "sd", candidate):
+                    batch.append(candidate)
+                    if len(batch) >= SD_BATCH_MAX:
+                        return batch
+            if time.monotonic() >= deadline:
+                return batch
+            await asyncio.sleep(0.02)
+    except Exception as e:
+        # Partners claimed so far exist only in this list; run them rather than lose them
+        logger.error(f"Error collecting SD batch, running {len(batch)} claimed tasks: {e}")
+        return batch
+
+async def next_sd_task():
+    """Claim the next task, draining tasks for already-loaded checkpoints before forcing a swap.
+
+    Tasks that pin no checkpoint run anywhere. Otherwise the oldest task whose checkpoint is
+    loaded on an idle backend goes first, unless the oldest task overall has waited longer
+    than SD_SWAP_MAX_AGE, in which case it is served (and the swap paid) for fairness.
+    """
+    queued = await redis_client.lrange("sd_tasks", -SD_BATCH_SCAN, -1)
+    if not queued:
+        task_data = await redis_client.brpop("sd_tasks", timeout=1)
+        return json.loads(task_data[1]) if task_data else None
+
+    loaded = sd_pool.idle_checkpoints()
+    now = time.time()
+    oldest = chosen = None
+    for raw in reversed(queued):  # oldest first (API LPUSHes, workers pop from the tail)
+        try:
+            task = json.loads(raw)
+        except json.JSONDecodeError:
+            chosen = (raw, None)
+            break
+        if oldest is None:
+            oldest = (raw, task)
+            if now - task.get("timestamp", now) > SD_SWAP_MAX_AGE:
+                break
+        wanted = requested_checkpoint(task)
+        if wanted is None or wanted in loaded:
+            chosen = (raw, task)
+            break
+    raw, task = chosen or oldest
+
+    # LREM succeeds for exactly one worker; losing the race just means trying again
+    if not await redis_client.lrem("sd_tasks", 1, raw):
+        return None
+    if task is None:
+        raise json.JSONDecodeError("Malformed SD task", raw, 0)
+    return task
+
+async def fail_tasks(tasks, message):
+    """Store an error result for claimed tasks, so their callers don't wait for the timeout"""
+    for failed in tasks:
+        try:
+            await redis_client.set(f"result:{failed['id']}", json.dumps({"error": message}), ex=600, nx=True)
+        except Exception as e:
+            logger.error(f"Could not store error result for SD task {failed.get('id')}: {e}")
+
+async def run_sd_batch(batch):
+    """Generate a batch on the pool and store one result per task"""
+    try:
+        results = await handle_sd_batch([sd_payload(t["data"]) for t in batch])
+        for batched_task, result in zip(batch, results):
+            await redis_client.set(f"result:{batched_task['id']}", json.dumps({"data": result}), ex=600)
+        await incr(redis_client, "sd", "tasks_total", len(batch))
+        await incr(redis_client, "sd", "batches_total")
+        logger.info(f"SD task {batch[0]['id']} completed and result stored")
+    except Exception as e:
+        logger.error(f"Error processing SD batch: {e}")
+        # nx keeps any result already stored for the tasks before the failure
+        await fail_tasks(batch, f"Error with SD generation: {e}")
 
 async def process_sd_tasks():
-    """Process tasks from the sd_tasks queue"""
+    """Process tasks from the sd_tasks queue, one batch in flight per A1111 backend"""
     logger.info("Starting SD task processor...")
+    sd_pool.start()
+    # Only take a task off the queue when a backend is free, so other workers can have it meanwhile
+    slots = asyncio.Semaphore(len(sd_pool.backends))
+    running_batches = set()
+
+    def batch_done(running):
+        running_batches.discard(running)
+        slots.release()
 
     while True:
+        claimed = []  # tasks taken off the queue and not yet handed to run_sd_batch
         try:
-            task_data = await redis_client.brpop("sd_tasks", timeout=1)
-            if task_data:
-                task_json = task_data[1]
-                task = json.loads(task_json)
+            await slots.acquire()
+            task = await next_sd_task()
+            if not task or await drop_expired(redis_client, "sd", task):
+                slots.release()
+            else:
+                claimed = [task]
                 task_id = task["id"]
                 endpoint = task.get("endpoint", "sd_generation")
+                set_request_id(task.get("request_id") or task_id)
                 request_data = task["data"]
 
                 logger.info(f"Processing task {task_id} for endpoint {endpoint}")
 
                 if endpoint == "sd_generation":
-                    result = await handle_sd_generation(request_data)
-                    await redis_client.set(f"result:{task_id}", json.dumps({"data": result}), ex=600)
-                    logger.info(f"SD task {task_id} completed and result stored")
+                    logger.info(f"Processing SD request: {truncate(request_data)}", extra={"event": "payload"})
+                    batch = claimed = await collect_batch(task, sd_payload(request_data)[0])
+                    if len(batch) > 1:
+                        logger.info(f"Coalesced {len(batch)} SD tasks into one batch: {[t['id'] for t in batch]}")
+                    running = asyncio.create_task(run_sd_batch(batch))
+                    claimed = []
+                    running_batches.add(running)
+                    running.add_done_callback(batch_done)
                 else:
                     logger.warning(f"Unknown endpoint {endpoint} for task {task_id}")
                     await redis_client.set(f"result:{task_id}", json.dumps({"error": f"Unknown endpoint: {endpoint}"}), ex=600)
+                    slots.release()
                     
         except asyncio.CancelledError:
             logger.info("SD task processor cancelled.")
             break
         except json.JSONDecodeError as e:
             logger.error(f"JSON decode error in SD task: {e}")
+            slots.release()
             await asyncio.sleep(1)
         except Exception as e:
             logger.error(f"Error processing SD task: {e}")
+            await fail_tasks(claimed, f"Error with SD generation: {e}")
+            slots.release()
             await asyncio.sleep(1)
 
     logger.info("SD task processor stopped")
@@ -94,7 +352,7 @@ async def process_sd_tasks():
 async def main():
     """Main async function to run the SD task processor"""
     logger.info(f"SD Worker starting. Connecting to Redis at {REDIS_HOST}")
-    logger.info(f"Using A1111 server at {A1111_URL}")
+    logger.info(f"Using A1111 servers: {', '.join(b.url for b in sd_pool.backends)}")
 
     try:
         await redis_client.ping()
@@ -103,14 +361,12 @@ async def main():
         logger.error(f"❌ Async Redis connection failed: {e}")
         return
 
-    try:
-        response = requests.get(f"{A1111_URL}/docs", timeout=10)
-        if response.status_code == 200:
-            logger.info("✅ A1111 server connection successful")
+    await sd_pool.check_all()
+    for backend in sd_pool.backends:
+        if backend.healthy:
+            logger.info(f"✅ A1111 server connection successful: {backend.url} ({backend.checkpoint})")
         else:
-            logger.warning(f"⚠️ A1111 server connection test returned status {response.status_code}")
-    except Exception as e:
-        logger.warning(f"⚠️ A1111 server connection test failed: {e}")
+            logger.warning(f"⚠️ A1111 server connection test failed: {backend.url}")
 
     await process_sd_tasks()
 
@@ -0,0 +1,167 @@
+"""Wire-ready stream frames shared by the LLM workers.
+
+Workers push frames that the API forwards to clients byte-for-byte, so each
+token is serialized exactly once: SSE (`data: {...}\\n\\n`) for Unity clients
+and NDJSON (`{...}\\n`) for Ollama clients. StreamWriter coalesces frames
+into as few Redis writes as the latency budget allows.
+"""
+import os, json, time, asyncio
+from datetime import datetime, timezone
+
+try:
+    import orjson
+
+    def dumps(obj):
+        """Compact JSON encoding"""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    loads = orjson.loads
+except ImportError:  # venvs created before orjson was added to requirements.txt
+    def dumps(obj):
+        """Compact JSON encoding"""
+        return json.dumps(obj, separators=(",", ":"))
+
+    loads = json.loads
+
+SSE = "sse"
+NDJSON = "ndjson"
+
+def get_iso_timestamp():
+    """Generate ISO 8601 timestamp in Ollama format"""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def frame(raw_json, stream_format):
+    """Wrap an already-encoded JSON document in the client's stream framing"""
+    if stream_format == SSE:
+        return f"data: {raw_json}\n\n"
+    return f"{raw_json}\n"
+
+def encode_frame(payload, stream_format):
+    """Encode a payload once and frame it"""
+    return frame(dumps(payload), stream_format)
+
+# Default coalescing window and size; requests can override both
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "40"))
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "2048"))
+STREAM_TTL = 600  # seconds a stream outlives its last write; the API's STREAM_META_TTL matches
+# List entries kept per stream for reconnects and spectators; 0 keeps them all
+STREAM_RESUME_WINDOW = int(os.getenv("STREAM_RESUME_WINDOW", "1024"))
+
+class StreamWriter:
+    """Coalesces frames for `stream:{task_id}` into batched Redis writes.
+
+    The first frame is written immediately so time-to-first-token is unaffected. Later frames
+    are buffered and written as one list entry once the oldest buffered frame is `flush_ms`
+    old or `flush_bytes` have accumulated. A timer enforces the window even when the backend
+    pauses after a burst, so no frame waits longer than `flush_ms`; read the backend with
+    backend_lines() so the event loop is free to run it. When tokens arrive more slowly than
+    the window, batching cannot save writes, so frames go out as they arrive. A window of 0
+    disables coalescing.
+
+    Only the newest STREAM_RESUME_WINDOW entries are kept. The number trimmed from the head is
+    stored as `base` in `stream:{task_id}:meta`, so readers can keep counting entries from the
+    start of the stream.
+    """
+
+    def __init__(self, redis_client, task_id, flush_ms=None, flush_bytes=None, ttl=STREAM_TTL):
+        self.redis = redis_client
+        self.key = f"stream:{task_id}"
+        self.flush_s = (STREAM_FLUSH_MS if flush_ms is None else flush_ms) / 1000
+        self.flush_bytes = STREAM_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self.ttl = ttl
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.oldest = None
+        self.last_frame = None
+        self.gap = None  # moving average of the inter-frame gap
+        self.frames = 0
+        self.writes = 0
+        self.deadline = None  # timer that flushes the buffer when its oldest frame is flush_ms old
+        self.deadline_task = None
+        self.lock = asyncio.Lock()  # keeps timer and inline flushes in order
+
+    @classmethod
+    def for_request(cls, redis_client, task_id, request_dict, ttl=STREAM_TTL):
+        """Writer using the per-request stream_flush_ms / stream_flush_bytes overrides"""
+        return cls(redis_client, task_id, request_dict.get("stream_flush_ms"), request_dict.get("stream_flush_bytes"), ttl)
+
+    async def push(self, data):
+        now = time.monotonic()
+        if self.last_frame is not None:
+            gap = now - self.last_frame
+            self.gap = gap if self.gap is None else 0.8 * self.gap + 0.2 * gap
+        self.last_frame = now
+        self.frames += 1
+
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        if self.oldest is None:
+            self.oldest = now
+
+        if (self.writes == 0
+                or self.buffered_bytes >= self.flush_bytes
+                or now - self.oldest >= self.flush_s
+                or self.gap >= self.flush_s):
+            await self.flush()
+        elif self.deadline is None:
+            self.deadline = asyncio.get_running_loop().call_later(self.flush_s, self._flush_on_deadline)
+
+    def _flush_on_deadline(self):
+        self.deadline = None
+        self.deadline_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        async with self.lock:
+            if not self.buffer:
+                return
+            payload = "".join(self.buffer)
+            self.buffer = []
+            self.buffered_bytes = 0
+            self.oldest = None
+
+            # Entries stay for reconnecting clients and spectators; the TTL is reapplied on
+            # every write (same round trip) so the list outlives the generation by `ttl`.
+            # MULTI keeps the trim and the new base atomic for readers
+            trimmed = self.writes + 1 - STREAM_RESUME_WINDOW
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.rpush(self.key, payload)
+                pipe.expire(self.key, self.ttl)
+                if STREAM_RESUME_WINDOW and trimmed > 0:
+                    pipe.ltrim(self.key, -STREAM_RESUME_WINDOW, -1)
+                    pipe.hset(f"{self.key}:meta", "base", trimmed)
+                    pipe.expire(f"{self.key}:meta", self.ttl)
+                await pipe.execute()
+            self.writes += 1
+
+    async def close(self):
+        """Write whatever is still buffered; call before storing the final result"""
+        await self.flush()
+
+async def backend_lines(response):
+    """Lines of a streamed `requests` response, read on a thread.
+
+    iter_lines() blocks for as long as the backend pauses; reading it off the event loop lets
+    StreamWriter's deadline flush deliver buffered frames in the meantime.
+    """
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+
+    def pump():
+        try:
+            for line in response.iter_lines():
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+        except Exception as e:
+            loop.call_soon_threadsafe(lines.put_nowait, e)
+        loop.call_soon_threadsafe(lines.put_nowait, None)
+
+    loop.run_in_executor(None, pump)
+    try:
+        while (line := await lines.get()) is not None:
+            if isinstance(line, Exception):
+                raise line
+            yield line
+    finally:
+        response.close()  # ends the pump if the caller stopped early
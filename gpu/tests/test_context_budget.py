@@ -0,0 +1,95 @@
+import pytest
+
+from context_budget import ContextBudget, ContextOverflow
+
+BOS = 1
+
+class WordTokenizer:
+    """One token per word, BOS when add_special; records every call"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text, add_special):
+        self.calls.append(text)
+        return ([BOS] if add_special else []) + [100 + i for i, _ in enumerate(text.split())]
+
+def render(messages):
+    return " ".join(f"{m['role']}: {m['content']}" for m in messages)
+
+def words(n, word="w"):
+    return " ".join([word] * n)
+
+def test_short_prompt_is_not_tokenized():
+    tokenizer = WordTokenizer()
+    budget = ContextBudget(tokenizer, policy="trim", reserve=64)
+    prompt, dropped, n_predict = budget.fit_prompt("hello there", n_ctx=256)
+    assert (prompt, dropped, n_predict) == ("hello there", 0, -1)  # unset stays unset
+    assert budget.fit_prompt("hello there", n_ctx=256, n_predict=100) == ("hello there", 0, 100)
+    assert tokenizer.calls == [""]  # only the one-off BOS probe
+
+def test_large_n_predict_is_capped_by_tokens_not_bytes():
+    tokenizer = WordTokenizer()
+    budget = ContextBudget(tokenizer, policy="trim")
+    prompt = words(50)  # 99 bytes, 51 tokens
+    assert budget.fit_prompt(prompt, n_ctx=256, n_predict=200) == (prompt, 0, 200)
+    assert budget.fit_prompt(prompt, n_ctx=256, n_predict=250) == (prompt, 0, 256 - 51)
+
+def test_long_prompt_that_fits_is_tokenized_once():
+    tokenizer = WordTokenizer()
+    budget = ContextBudget(tokenizer, policy="trim", reserve=64)
+    prompt = words(100)  # 199 bytes, 101 tokens
+    assert budget.fit_prompt(prompt, n_ctx=256, n_predict=100) == (prompt, 0, 100)
+    assert tokenizer.calls == ["", prompt]
+
+def test_prompt_cut_keeps_bos_head_and_tail():
+    tokenizer = WordTokenizer()
+    budget = ContextBudget(tokenizer, policy="trim")
+    prompt = words(300)
+    kept, dropped, n_predict = budget.fit_prompt(prompt, n_ctx=256, n_predict=56, n_keep=4)
+    full = tokenizer(prompt, True)
+    assert len(kept) == 200
+    assert kept == full[:5] + full[-195:]
+    assert dropped == len(full) - 200
+    assert n_predict == 56
+    assert tokenizer.calls.count(prompt) == 2  # once by fit_prompt, once above
+    assert budget.take_counters() == {"context_trimmed_total": 1, "context_trimmed_tokens_total": dropped}
+
+def test_prompt_reject_policy():
+    budget = ContextBudget(WordTokenizer(), policy="reject")
+    with pytest.raises(ContextOverflow):
+        budget.fit_prompt(words(300), n_ctx=256, n_predict=56)
+    assert budget.take_counters() == {"context_rejected_total": 1}
+
+def test_prompt_policy_off():
+    tokenizer = WordTokenizer()
+    budget = ContextBudget(tokenizer, policy="off")
+    assert budget.fit_prompt(words(300), n_ctx=256, n_predict=56) == (words(300), 0, 56)
+    assert tokenizer.calls == []
+
+def test_chat_drops_oldest_turns_keeping_system_and_latest():
+    budget = ContextBudget(WordTokenizer(), policy="trim")
+    messages = [{"role": "system", "content": "be brief"}]
+    for turn in range(6):
+        messages.append({"role": "user", "content": words(20, f"q{turn}")})
+        messages.append({"role": "assistant", "content": words(20, f"a{turn}")})
+    messages.append({"role": "user", "content": "last question"})
+    kept, prompt, dropped, n_predict = budget.fit_chat(messages, render, n_ctx=256, n_predict=128)
+    assert kept[0] == messages[0] and kept[-1] == messages[-1]
+    assert kept[1]["role"] == "user"  # resumes on a user turn
+    assert kept[1:-1] == messages[len(messages) - len(kept) + 1:-1]  # the newest history survives
+    assert dropped == len(messages) - len(kept) > 0
+    used = len(prompt.split()) + 1
+    assert used <= 128
+    assert n_predict == 128
+
+def test_chat_that_fits_is_untouched():
+    budget = ContextBudget(WordTokenizer(), policy="trim")
+    messages = [{"role": "user", "content": "hi"}]
+    assert budget.fit_chat(messages, render, n_ctx=256, n_predict=16) == (messages, "user: hi", 0, 16)
+
+def test_chat_overflow_without_history():
+    budget = ContextBudget(WordTokenizer(), policy="trim")
+    messages = [{"role": "system", "content": "rules"}, {"role": "user", "content": words(300)}]
+    with pytest.raises(ContextOverflow):
+        budget.fit_chat(messages, render, n_ctx=256, n_predict=56)
@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import streaming
+from streaming import StreamWriter
+
+def test_writer_trims_to_resume_window(monkeypatch):
+    monkeypatch.setattr(streaming, "STREAM_RESUME_WINDOW", 3)
+    client = fakeredis.aioredis.FakeRedis(decode_responses=True)
+
+    async def run():
+        writer = StreamWriter(client, "t1", flush_ms=0)
+        for i in range(5):
+            await writer.push(f"e{i}\n")
+        await writer.close()
+        return await client.lrange("stream:t1", 0, -1), await client.hget("stream:t1:meta", "base")
+
+    entries, base = asyncio.run(run())
+    assert entries == ["e2\n", "e3\n", "e4\n"]
+    assert base == "2"
@@ -0,0 +1,16 @@
+"""Modules that both the API and the GPU images need.
+
+docker-compose builds each image from its own directory, so these modules are
+kept as copies in api/ and gpu/. Edit both; this check fails when they drift.
+"""
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+SHARED = ["logsetup.py", "a1111_pool.py"]
+
+@pytest.mark.parametrize("name", SHARED)
+def test_copies_match(name):
+    api, gpu = (ROOT / "api" / name).read_bytes(), (ROOT / "gpu" / name).read_bytes()
+    assert api == gpu, f"api/{name} and gpu/{name} differ; apply the same change to both"